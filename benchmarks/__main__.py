@@ -0,0 +1,71 @@
+"""
+Run every benchmark, each in its own process with its own throwaway storage,
+and collect the result lines into one JSON Lines file.
+
+    python -m benchmarks --output results.jsonl
+    python -m benchmarks --quick --only stream_range list_page
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+SUITES = {
+    'stream_range': {
+        'full': ['--file-mb', '256', '--clients', '16', '--requests', '20'],
+        'quick': ['--file-mb', '32', '--clients', '4', '--requests', '5'],
+    },
+    'download': {
+        'full': ['--file-mb', '64', '--bandwidth-mb', '8', '--segments', '4'],
+        'quick': ['--file-mb', '8', '--bandwidth-mb', '16', '--segments', '4'],
+    },
+    'download_faults': {
+        'module': 'download',
+        'full': ['--file-mb', '32', '--bandwidth-mb', '16', '--segments', '4',
+                 '--error-rate', '0.05', '--drop-rate', '0.05'],
+        'quick': ['--file-mb', '4', '--bandwidth-mb', '16', '--segments', '4',
+                  '--error-rate', '0.05', '--drop-rate', '0.05'],
+    },
+    'list_page': {
+        'full': ['--videos', '20000', '--requests', '50', '--pages', '40'],
+        'quick': ['--videos', '10000', '--requests', '10', '--pages', '10'],
+    },
+    'sqlite_contention': {
+        'full': ['--seconds', '10'],
+        'quick': ['--seconds', '3', '--videos', '500'],
+    },
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', help="append results to this file (JSON Lines)")
+    parser.add_argument('--quick', action='store_true', help="small sizes, for a smoke run")
+    parser.add_argument('--only', nargs='+', choices=list(SUITES), help="run only these suites")
+    args = parser.parse_args()
+
+    failed = []
+    for name in args.only or SUITES:
+        suite = SUITES[name]
+        command = [sys.executable, '-m', f"benchmarks.{suite.get('module', name)}",
+                   *suite['quick' if args.quick else 'full']]
+        print(f"# {name}: {' '.join(command[2:])}", file=sys.stderr, flush=True)
+        result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+        if result.returncode != 0:
+            failed.append(name)
+        records = [{**json.loads(line), 'suite': name, 'quick': args.quick} for line in lines]
+        for record in records:
+            print(json.dumps(record, sort_keys=True), flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if failed:
+        print(f"# failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
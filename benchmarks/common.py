@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import subprocess
+from functools import cache
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup(set_prefix=False)
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def make_video_file(name: str, size: int):
+    """Create a completed Video backed by ``size`` bytes of random data."""
+    from django.conf import settings
+    from videos.models import Video
+
+    rel_path = os.path.join('videos', name)
+    abs_path = os.path.join(settings.STORAGE_SERVER_PATH, rel_path)
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    block = os.urandom(1024 * 1024)
+    with open(abs_path, 'wb') as f:
+        written = 0
+        while written < size:
+            n = min(len(block), size - written)
+            f.write(block[:n])
+            written += n
+    video = Video(title=name, download_url=f'http://bench.local/{name}',
+                  status='completed', file_size=size)
+    video.video_file.name = rel_path
+    video.save()
+    return video
+
+
+def http_scope(path: str, headers=(), query_string: bytes = b'', extensions=None) -> dict:
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': query_string,
+        'headers': [(b'host', b'bench.local')] + [(k.lower().encode(), v.encode()) for k, v in headers],
+        'server': ('127.0.0.1', 8000),
+        'client': ('127.0.0.1', 50000),
+        'extensions': extensions or {},
+    }
+
+
+class ASGIClient:
+    """
+    Drives an ASGI application in-process and discards the body into
+    /dev/null, honouring zerocopysend/pathsend the way a server would.
+    """
+    def __init__(self, application):
+        self.application = application
+        self.devnull = os.open(os.devnull, os.O_WRONLY)
+
+    def close(self):
+        os.close(self.devnull)
+
+    async def request(self, scope: dict) -> dict:
+        result = {'status': None, 'bytes': 0, 'ttfb': None}
+        started = time.perf_counter()
+        disconnect = asyncio.Event()
+        sent_request = False
+
+        async def receive():
+            nonlocal sent_request
+            if not sent_request:
+                sent_request = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            kind = message['type']
+            if kind == 'http.response.start':
+                result['status'] = message['status']
+                return
+            if result['ttfb'] is None:
+                result['ttfb'] = time.perf_counter() - started
+            if kind == 'http.response.body':
+                body = message.get('body', b'')
+                if body:
+                    os.write(self.devnull, body)
+                    result['bytes'] += len(body)
+            elif kind == 'http.response.zerocopysend':
+                offset, count = message.get('offset', 0), message.get('count')
+                fd = message['file'].fileno()
+                if count is None:
+                    count = os.fstat(fd).st_size - offset
+                while count > 0:
+                    sent = os.sendfile(self.devnull, fd, offset, count)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    count -= sent
+                    result['bytes'] += sent
+            elif kind == 'http.response.pathsend':
+                with open(message['path'], 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(self.devnull, f.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    result['bytes'] += offset
+
+        try:
+            await self.application(scope, receive, send)
+        finally:
+            disconnect.set()
+        result['elapsed'] = time.perf_counter() - started
+        return result
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+@cache
+def git_revision() -> str | None:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def emit(name: str, results: dict):
+    """Print one machine-readable result line per benchmark."""
+    print(json.dumps({'benchmark': name, 'timestamp': time.time(), 'revision': git_revision(),
+                      'python': platform.python_version(), **results}, sort_keys=True), flush=True)
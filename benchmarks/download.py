@@ -0,0 +1,70 @@
+"""
+Single-stream vs segmented downloads through VideoDownloadManager against a
+local origin that throttles every connection, optionally failing some
+requests and cutting some responses short to exercise retries and resume.
+
+    python -m benchmarks.download --file-mb 64 --bandwidth-mb 8 --segments 4
+    python -m benchmarks.download --file-mb 16 --error-rate 0.1 --drop-rate 0.1
+"""
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+
+from .common import setup_django, emit
+from .origin import Origin
+
+
+def run_download(url: str, segments: int, checksum: str) -> dict:
+    from django.test.utils import override_settings
+    from videos.models import Video
+    from videos.manager import video_manager
+
+    video = Video.objects.create(title=f'bench-{segments}', download_url=url, status='downloading')
+    with override_settings(DOWNLOAD_SEGMENTS=segments, DOWNLOAD_SEGMENT_MIN_SIZE=1024 * 1024):
+        started = time.perf_counter()
+        ok = video_manager._download_thread(video)
+        elapsed = time.perf_counter() - started
+    video.refresh_from_db()
+    return {'ok': ok, 'seconds': round(elapsed, 3), 'bytes': video.file_size,
+            'checksum_ok': video.source_checksum == checksum,
+            'throughput_mb_s': round(video.file_size / elapsed / 1024 / 1024, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file-mb', type=int, default=64)
+    parser.add_argument('--bandwidth-mb', type=float, default=8, help="per-connection limit in MB/s")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of responses cut off part way")
+    parser.add_argument('--no-ranges', action='store_true', help="origin ignores Range headers")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    directory = tempfile.mkdtemp(prefix='streamer-origin-')
+    data = os.urandom(args.file_mb * 1024 * 1024)
+    with open(os.path.join(directory, 'movie.mp4'), 'wb') as f:
+        f.write(data)
+    checksum = hashlib.sha256(data).hexdigest()
+
+    with Origin(directory, bandwidth=int(args.bandwidth_mb * 1024 * 1024), latency=args.latency,
+                ranges=not args.no_ranges, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                seed=args.seed) as origin:
+        for segments in (1, args.segments):
+            name = f'movie.mp4?run={segments}'
+            before = origin.stats()
+            result = run_download(origin.url(name), segments, checksum)
+            after = origin.stats()
+            emit('download', {'segments': segments, 'file_mb': args.file_mb,
+                              'bandwidth_mb_s_per_connection': args.bandwidth_mb,
+                              'error_rate': args.error_rate, 'drop_rate': args.drop_rate,
+                              'ranges': not args.no_ranges, **result,
+                              **{key: after[key] - before[key] for key in after}})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+List page, paging API, stats and search latency against a synthetic library.
+
+    python -m benchmarks.list_page --videos 20000 --requests 50 --pages 40
+"""
+import time
+import random
+import asyncio
+import argparse
+from datetime import timedelta
+
+from .common import setup_django, http_scope, ASGIClient, percentile, emit
+
+WORDS = ('night', 'city', 'river', 'last', 'summer', 'king', 'shadow', 'ocean', 'storm', 'love',
+         'winter', 'dark', 'road', 'house', 'star', 'silent', 'fire', 'garden', 'secret', 'return')
+STATUSES = (('completed', 80), ('pending', 10), ('downloading', 5), ('error', 5))
+
+
+def make_library(count: int, seed: int):
+    from django.utils import timezone
+    from videos.models import Video, LibraryStats
+    from videos.search import rebuild_index
+
+    rng = random.Random(seed)
+    statuses = [status for status, weight in STATUSES for _ in range(weight)]
+    videos = Video.objects.bulk_create([
+        Video(
+            title=' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title() + f' {i}',
+            description=' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 40))),
+            download_url=f'http://bench.local/library/{i}.mp4',
+            status=rng.choice(statuses),
+            file_size=rng.randint(200, 4000) * 1024 * 1024,
+            duration=rng.randint(600, 9000),
+        )
+        for i in range(count)
+    ], batch_size=1000)
+    # bulk_create stamps every row with the same created_at; spread them out like a real library.
+    now = timezone.now()
+    for i, video in enumerate(videos):
+        video.created_at = now - timedelta(minutes=i * 7 + rng.randint(0, 6))
+    Video.objects.bulk_update(videos, ['created_at'], batch_size=1000)
+
+    LibraryStats.rebuild()
+    # bulk_create skips the signals that index new videos; this is the cost of a full rebuild.
+    started = time.perf_counter()
+    rebuild_index()
+    return time.perf_counter() - started
+
+
+def summary(latencies: list) -> dict:
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies, default=0.0) * 1000, 3),
+    }
+
+
+async def run(application, args) -> list[dict]:
+    import json
+
+    client = ASGIClient(application)
+    rng = random.Random(args.seed)
+
+    async def timed(path: str, query: str = '') -> dict:
+        result = await client.request(http_scope(path, query_string=query.encode()))
+        assert result['status'] == 200, (path, query, result)
+        return result
+
+    async def fetch_json(path: str, query: str = '') -> dict:
+        # The in-process client throws bodies away, so ask the view directly for cursors.
+        from django.test import AsyncRequestFactory
+        from videos.views import video_list_api
+        response = await video_list_api(AsyncRequestFactory().get(path, QUERY_STRING=query))
+        return json.loads(response.content)
+
+    results = []
+    endpoints = {
+        'list_first_page': lambda: ('/', ''),
+        'list_status_filter': lambda: ('/', 'status=error'),
+        'api_first_page': lambda: ('/api/videos/', ''),
+        'stats': lambda: ('/api/stats/', ''),
+        'search_prefix': lambda: ('/api/search/', f'q={rng.choice(WORDS)[:3]}'),
+        'search_two_words': lambda: ('/api/search/', f'q={rng.choice(WORDS)}+{rng.choice(WORDS)[:4]}'),
+    }
+    for name, make_request in endpoints.items():
+        await timed(*make_request())  # warm up
+        latencies = []
+        for _ in range(args.requests):
+            latencies.append((await timed(*make_request()))['elapsed'])
+        results.append({'endpoint': name, **summary(latencies)})
+
+    # Scrolling: follow the cursor deep into the library, as the TV does page by page.
+    cursors = ['']
+    after = ''
+    for _ in range(args.pages):
+        page = await fetch_json('/api/videos/', after)
+        if not page['next']:
+            break
+        after = f"after={page['next']}"
+        cursors.append(after)
+    latencies = [(await timed('/api/videos/', cursor))['elapsed'] for cursor in cursors]
+    results.append({'endpoint': 'api_deep_pages', 'deepest_page': len(cursors), **summary(latencies)})
+
+    # Several TVs loading the first page at once.
+    started = time.perf_counter()
+    concurrent = await asyncio.gather(*(timed('/') for _ in range(args.concurrency * 4)))
+    wall = time.perf_counter() - started
+    results.append({'endpoint': 'list_first_page_concurrent', 'concurrency': args.concurrency,
+                    'requests_per_s': round(len(concurrent) / wall, 2),
+                    **summary([result['elapsed'] for result in concurrent])})
+    client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--videos', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--pages', type=int, default=30, help="cursor pages to follow for the deep-page run")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    from django_core.asgi import application
+
+    started = time.perf_counter()
+    index_seconds = make_library(args.videos, args.seed)
+    emit('list_page_setup', {'videos': args.videos, 'seed_s': round(time.perf_counter() - started, 3),
+                             'search_index_s': round(index_seconds, 3)})
+    for result in asyncio.run(run(application, args)):
+        emit('list_page', {'videos': args.videos, **result})
+
+
+if __name__ == '__main__':
+    main()
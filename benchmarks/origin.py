@@ -0,0 +1,158 @@
+"""
+A local stand-in for the sites we download from: serves files from a
+directory with Range support, and can throttle every connection to a fixed
+bandwidth, add latency before each response and inject failures: a share of
+requests answered with 503, and a share of bodies cut off part way (or
+exactly the n-th requests, for tests).
+"""
+import os
+import re
+import sys
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        origin = self.server
+        with origin.lock:
+            origin.requests += 1
+            fail = origin.rng.random() < origin.error_rate or origin.requests in origin.fail_requests
+            drop = origin.rng.random() < origin.drop_rate or origin.requests in origin.drop_requests
+        time.sleep(origin.latency)
+        if fail:
+            with origin.lock:
+                origin.errors_injected += 1
+            self.send_error(503)
+            return
+        path = os.path.join(origin.directory, os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+
+        start, end, status = 0, size - 1, 200
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match and origin.ranges:
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            elif last:
+                start = max(0, size - int(last))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if origin.content_length:
+            self.send_header('Content-Length', str(end - start + 1))
+        else:
+            # The body ends when the connection does.
+            self.close_connection = True
+        if origin.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+
+        with origin.lock:
+            origin.connections += 1
+        length = end - start + 1
+        if drop:
+            # Announce the whole range but hang up somewhere in the middle of it.
+            with origin.lock:
+                origin.drops_injected += 1
+                cut = origin.rng.randrange(0, max(1, length // 2))
+            self.close_connection = True
+        else:
+            cut = length
+        try:
+            self._send_body(path, start, cut)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_body(self, path, start, length):
+        origin = self.server
+        block = 64 * 1024
+        started = time.perf_counter()
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while sent < length:
+                data = f.read(min(block, length - sent))
+                if not data:
+                    break
+                self.wfile.write(data)
+                sent += len(data)
+                with origin.lock:
+                    origin.bytes_sent += len(data)
+                if origin.bandwidth:
+                    # Per-connection throttle: sleep until we're back on schedule.
+                    ahead = sent / origin.bandwidth - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+class Origin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory: str, bandwidth: int = 0, latency: float = 0.0, ranges: bool = True,
+                 error_rate: float = 0.0, drop_rate: float = 0.0, seed: int | None = None,
+                 content_length: bool = True, fail_requests=(), drop_requests=()):
+        super().__init__(('127.0.0.1', 0), OriginHandler)
+        self.directory = directory
+        self.bandwidth = bandwidth  # bytes/s per connection, 0 = unlimited
+        self.latency = latency
+        self.ranges = ranges
+        self.error_rate = error_rate  # share of requests answered with 503
+        self.drop_rate = drop_rate  # share of responses cut off part way through the body
+        self.content_length = content_length
+        self.fail_requests = set(fail_requests)  # numbers (from 1) of the requests to answer with 503
+        self.drop_requests = set(drop_requests)  # and of those to cut off
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self.errors_injected = 0
+        self.drops_injected = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'origin_requests': self.requests,
+                'origin_bytes_sent': self.bytes_sent,
+                'origin_errors_injected': self.errors_injected,
+                'origin_drops_injected': self.drops_injected,
+            }
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on kept-alive connections is routine here.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def url(self, name: str) -> str:
+        return f'http://127.0.0.1:{self.server_port}/{name}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
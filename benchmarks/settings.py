@@ -0,0 +1,37 @@
+"""
+Settings for the benchmarks: the project settings pointed at a throwaway
+storage directory so nothing touches the real library or database.
+"""
+import os
+import tempfile
+
+from django_core.settings import *  # noqa: F401,F403
+
+STORAGE_SERVER_PATH = os.environ.get('BENCH_STORAGE_PATH') or tempfile.mkdtemp(prefix='streamer-bench-')
+MEDIA_ROOT = os.path.join(STORAGE_SERVER_PATH, 'media')
+STATIC_ROOT = os.path.join(STORAGE_SERVER_PATH, 'static')
+DOWNLOAD_STAGING_PATH = os.path.join(STORAGE_SERVER_PATH, 'staging')
+HLS_ROOT = os.path.join(STORAGE_SERVER_PATH, 'hls')
+os.makedirs(STATIC_ROOT, exist_ok=True)
+
+DATABASES = {
+    'default': {
+        **DATABASES['default'],
+        'NAME': os.path.join(STORAGE_SERVER_PATH, 'bench.db'),
+    }
+}
+if os.environ.get('BENCH_SQLITE_LEGACY'):
+    # Rollback journal and deferred transactions, as before WAL was turned on.
+    DATABASES['default']['OPTIONS'] = {'timeout': 30}
+
+DEBUG = False
+DOWNLOAD_WORKERS_IN_WEB = False
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'null': {'class': 'logging.NullHandler'}},
+    'loggers': {
+        'django': {'handlers': ['null'], 'propagate': False},
+        'videos': {'handlers': ['null'], 'propagate': False},
+    },
+}
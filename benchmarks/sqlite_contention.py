@@ -0,0 +1,176 @@
+"""
+SQLite write contention: N downloader threads writing progress, heartbeats
+and status changes the way the download workers do, against M reader
+threads loading list pages and stream lookups. Runs once with the project's
+database settings (WAL, immediate transactions) and once with the old
+rollback-journal setup, each in its own process.
+
+    python -m benchmarks.sqlite_contention --downloaders 4 --readers 8 --seconds 10
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import subprocess
+
+from .common import setup_django, percentile, emit
+
+SLOW_MS = 100
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'write': [], 'read': []}
+        self.locked = {'write': 0, 'read': 0}
+
+    def timed(self, kind, operation):
+        from django.db import OperationalError
+        started = time.perf_counter()
+        try:
+            operation()
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            with self.lock:
+                self.locked[kind] += 1
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.latencies[kind].append(elapsed)
+
+    def summary(self, kind: str) -> dict:
+        values = self.latencies[kind]
+        return {
+            f'{kind}_ops': len(values),
+            f'{kind}_p50_ms': round(percentile(values, 50), 3),
+            f'{kind}_p99_ms': round(percentile(values, 99), 3),
+            f'{kind}_max_ms': round(max(values, default=0.0), 3),
+            # Mostly time spent waiting for the database lock.
+            f'{kind}_over_{SLOW_MS}ms': sum(1 for value in values if value >= SLOW_MS),
+            f'{kind}_lock_errors': self.locked[kind],
+        }
+
+
+def downloader(video_ids, recorder, stop):
+    from django.db import connection, transaction
+    from django.utils import timezone
+    from videos.models import Video, DownloadJob
+
+    rng = random.Random()
+    downloaded = 0
+    try:
+        while not stop.is_set():
+            video_id = rng.choice(video_ids)
+            downloaded += 65536
+
+            # ProgressTracker.flush
+            recorder.timed('write', lambda: Video.objects.filter(pk=video_id).update(
+                downloaded_bytes=downloaded, progress_updated_at=timezone.now(),
+            ))
+            # DownloadQueue.heartbeat
+            recorder.timed('write', lambda: DownloadJob.objects.filter(video_id=video_id).update(
+                heartbeat_at=timezone.now(),
+            ))
+            if rng.random() < 0.1:
+                # Status change with a row lock, as the download error path does.
+                def transition():
+                    with transaction.atomic():
+                        video = Video.objects.select_for_update().get(pk=video_id)
+                        video.status = 'completed' if video.status != 'completed' else 'downloading'
+                        video.file_size = rng.randint(1, 1 << 30)
+                        video.save()
+                recorder.timed('write', transition)
+            time.sleep(0.002)
+    finally:
+        connection.close()
+
+
+def reader(video_ids, recorder, stop):
+    from django.db import connection
+    from videos.models import Video, LibraryStats
+    from videos.views import LIST_FIELDS
+
+    rng = random.Random()
+    try:
+        while not stop.is_set():
+            if rng.random() < 0.5:
+                # List page: one keyset page plus the totals.
+                def list_page():
+                    list(Video.objects.only(*LIST_FIELDS).order_by('-created_at', '-id')[:25])
+                    LibraryStats.totals()
+                recorder.timed('read', list_page)
+            else:
+                # Stream lookup
+                recorder.timed('read', lambda: Video.objects.get(pk=rng.choice(video_ids)))
+    finally:
+        connection.close()
+
+
+def run(args) -> dict:
+    from django.db import connection
+    from videos.models import Video, DownloadJob, LibraryStats
+
+    videos = Video.objects.bulk_create([
+        Video(title=f'bench-{i}', download_url=f'http://bench.local/{i}.mp4', status='downloading')
+        for i in range(args.videos)
+    ])
+    DownloadJob.objects.bulk_create([DownloadJob(video=video, status='running') for video in videos])
+    LibraryStats.rebuild()
+    video_ids = [video.pk for video in videos]
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        journal_mode = cursor.fetchone()[0]
+
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [threading.Thread(target=downloader, args=(video_ids, recorder, stop)) for _ in range(args.downloaders)]
+    threads += [threading.Thread(target=reader, args=(video_ids, recorder, stop)) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'journal_mode': journal_mode,
+        'downloaders': args.downloaders,
+        'readers': args.readers,
+        'seconds': args.seconds,
+        **recorder.summary('write'),
+        **recorder.summary('read'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--downloaders', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--videos', type=int, default=2000)
+    parser.add_argument('--mode', choices=['both', 'tuned', 'legacy'], default='both')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        setup_django()
+        emit('sqlite_contention', {'mode': args.mode, **run(args)})
+        return
+
+    # Database settings are fixed once Django is set up, so each mode gets its own process.
+    for mode in (['tuned', 'legacy'] if args.mode == 'both' else [args.mode]):
+        env = dict(os.environ)
+        env.pop('BENCH_STORAGE_PATH', None)
+        if mode == 'legacy':
+            env['BENCH_SQLITE_LEGACY'] = '1'
+        command = [sys.executable, '-m', 'benchmarks.sqlite_contention', '--child', '--mode', mode,
+                   '--downloaders', str(args.downloaders), '--readers', str(args.readers),
+                   '--seconds', str(args.seconds), '--videos', str(args.videos)]
+        subprocess.run(command, env=env, check=True)
+
+
+if __name__ == '__main__':
+    main()
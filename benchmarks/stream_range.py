@@ -0,0 +1,83 @@
+"""
+Compare the chunk-generator and zero-copy paths of ``stream_video`` under
+concurrent Range requests.
+
+    python -m benchmarks.stream_range --clients 16 --requests 20 --range-mb 4
+"""
+import time
+import random
+import asyncio
+import argparse
+
+from .common import setup_django, make_video_file, http_scope, ASGIClient, percentile, emit
+
+
+async def run_mode(application, video, mode: str, args) -> dict:
+    from videos.streaming import ZEROCOPYSEND
+
+    extensions = {ZEROCOPYSEND: {}} if mode == 'zero_copy' else {}
+    client = ASGIClient(application)
+    path = f'/video/{video.id}/stream/'
+    range_size = args.range_mb * 1024 * 1024
+    rng = random.Random(args.seed)
+    ttfbs, latencies, stream_rates = [], [], []
+    total_bytes = 0
+
+    async def worker():
+        nonlocal total_bytes
+        for _ in range(args.requests):
+            start = rng.randrange(0, max(1, video.file_size - range_size))
+            end = min(video.file_size - 1, start + range_size - 1)
+            scope = http_scope(path, headers=[('Range', f'bytes={start}-{end}')], extensions=extensions)
+            result = await client.request(scope)
+            assert result['status'] == 206, result
+            ttfbs.append(result['ttfb'])
+            latencies.append(result['elapsed'])
+            stream_rates.append(result['bytes'] / result['elapsed'] / 1024 / 1024)
+            total_bytes += result['bytes']
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.clients)))
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    client.close()
+    requests = args.clients * args.requests
+
+    return {
+        'mode': mode,
+        'clients': args.clients,
+        'requests': requests,
+        'bytes': total_bytes,
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'throughput_mb_s': round(total_bytes / wall / 1024 / 1024, 2),
+        'cpu_s_per_gb': round(cpu / max(total_bytes, 1) * 1024 ** 3, 4),
+        'cpu_ms_per_stream': round(cpu / requests * 1000, 3),
+        'stream_mb_s_p50': round(percentile(stream_rates, 50), 2),
+        'stream_mb_s_p1': round(percentile(stream_rates, 1), 2),
+        'ttfb_p50_ms': round(percentile(ttfbs, 50) * 1000, 3),
+        'ttfb_p99_ms': round(percentile(ttfbs, 99) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file-mb', type=int, default=256)
+    parser.add_argument('--range-mb', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    from django_core.asgi import application
+
+    video = make_video_file('bench_range.mp4', args.file_mb * 1024 * 1024)
+    for mode in ('generator', 'zero_copy'):
+        emit('stream_range', asyncio.run(run_mode(application, video, mode, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_core.settings')
+django.setup(set_prefix=False)
+
+# Same as get_asgi_application(), but hands video files to the server through
+# the pathsend / zerocopysend extensions when it supports them.
+from django.conf import settings
+from videos.manager import video_manager
+from videos.streaming import ZeroCopyASGIHandler
+
+application = ZeroCopyASGIHandler()
+
+if settings.DOWNLOAD_WORKERS_IN_WEB:
+    video_manager.start_workers()
 
-application = get_asgi_application()
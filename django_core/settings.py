@@ -89,10 +89,33 @@ DATABASES = {
         'NAME': os.path.join(STORAGE_SERVER_PATH, 'databases', 'media_server.db'),
         'OPTIONS': {
             'timeout': 30,
+            # WAL lets the list page and streams read while a download thread
+            # writes; NORMAL sync is safe under WAL. 256MB mmap, 32MB page cache.
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA mmap_size=268435456;'
+                'PRAGMA cache_size=-32000;'
+                'PRAGMA temp_store=MEMORY;'
+            ),
+            # Transactions take the write lock up front (BEGIN IMMEDIATE), so
+            # read-then-write blocks wait for the busy timeout instead of
+            # failing with "database is locked" when they try to upgrade.
+            'transaction_mode': 'IMMEDIATE',
         }
     }
 }
 
+# Shared by every process on this machine (the ASGI app and `manage.py
+# download_worker`): downloads see through it that videos are being streamed.
+# Workers on other machines need a cache they share with the web server.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(STORAGE_SERVER_PATH, 'cache'),
+    }
+}
+
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
@@ -155,6 +178,159 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 X_FRAME_OPTIONS = 'ALLOWALL'
 
+# Streaming
+# Let the ASGI server send video files itself (http.response.zerocopysend for
+# ranges, http.response.pathsend for whole files) when it advertises support.
+STREAM_ZERO_COPY = True
+# Fallback reader: reads start at STREAM_CHUNK_MIN and double (up to
+# STREAM_CHUNK_MAX) while the client drains each chunk in under
+# STREAM_CHUNK_GROW_BELOW seconds; they halve past STREAM_CHUNK_SHRINK_ABOVE.
+STREAM_CHUNK_MIN = 64 * 1024  # 64KB
+STREAM_CHUNK_MAX = 4 * 1024 * 1024  # 4MB
+STREAM_CHUNK_GROW_BELOW = 0.05
+STREAM_CHUNK_SHRINK_ABOVE = 0.5
+# Completed videos are sent as public, so a caching proxy in front of the
+# server can answer repeat Range requests itself. Their URLs don't change
+# when the file does (deleted files, evictions, re-transcodes), so by default
+# (0) the proxy revalidates every time, a cheap 304. A max-age in seconds
+# skips that at the risk of serving an outdated file for that long.
+STREAM_CACHE_MAX_AGE = 0
+# Resolved files (path, size, mtime, type, ETag) kept per video so repeated
+# Range requests skip the database; re-checked on disk at most this often.
+STREAM_DESCRIPTOR_CACHE_SIZE = 1024
+STREAM_DESCRIPTOR_REVALIDATE_SECONDS = 5
+# Outgoing streams share STREAM_TOTAL_RATE (bytes/s, the uplink; 0 = not split)
+# fairly per client. Playback is paced to STREAM_PACING_MULTIPLE x the video's
+# bitrate once STREAM_PACING_READAHEAD_SECONDS of it have been sent (0 = never);
+# ?download requests weigh STREAM_DOWNLOAD_WEIGHT of a playback stream and, while
+# something plays, share at most STREAM_DOWNLOAD_RATE_WHILE_PLAYING.
+# Whole-file responses that no limit can apply to when they start (no
+# STREAM_TOTAL_RATE, no known bitrate, nothing playing) still go out through
+# zero-copy pathsend, and are then never slowed down later on.
+STREAM_SCHEDULING = True
+STREAM_TOTAL_RATE = 0
+STREAM_PACING_MULTIPLE = 2.0
+STREAM_PACING_READAHEAD_SECONDS = 30
+STREAM_DOWNLOAD_WEIGHT = 0.25
+STREAM_DOWNLOAD_RATE_WHILE_PLAYING = 4 * 1024 * 1024  # 4MB/s
+
+# Cards per page on the list page; more are fetched as the user scrolls down.
+VIDEO_LIST_PAGE_SIZE = 24
+# Full-text search (SQLite FTS5) results for the list page and the admin.
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_ADMIN_LIMIT = 1000
+
+# Prometheus metrics at /metrics (per process). Open to these client addresses
+# and to logged-in staff. `download_worker --metrics-port` serves its own.
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Downloads
+# Jobs live in the database (DownloadJob) and are run by a pool of
+# DOWNLOAD_WORKERS threads in every process that starts workers: the ASGI app
+# when DOWNLOAD_WORKERS_IN_WEB is on, and `manage.py download_worker`.
+DOWNLOAD_WORKERS = 2
+DOWNLOAD_WORKERS_IN_WEB = True
+DOWNLOAD_LEASE_SECONDS = 60
+DOWNLOAD_POLL_SECONDS = 2
+DOWNLOAD_MAX_ATTEMPTS = 3
+# Downloads and conversions are written here, one directory per video, and
+# renamed into storage when done. Keep it on the same filesystem as
+# STORAGE_SERVER_PATH so finishing a download doesn't copy the file.
+DOWNLOAD_STAGING_PATH = os.path.join(STORAGE_SERVER_PATH, 'staging')
+# Fetch files over several connections when the origin supports Range
+# requests. Segments are never smaller than DOWNLOAD_SEGMENT_MIN_SIZE.
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 * 1024  # 16MB
+DOWNLOAD_SEGMENT_RETRIES = 5
+# Skip downloads of a link (compared normalized, see videos/dedupe.py) that is
+# already stored for another video, and share the stored file (hard-linked)
+# when a download turns out to have the same bytes as one already kept.
+DOWNLOAD_DEDUPE = True
+# `manage.py import_videos` and the admin's list import create videos and
+# queue their downloads this many at a time.
+IMPORT_BATCH_SIZE = 500
+# Bandwidth limits in bytes/s, 0 = unlimited. DOWNLOAD_MAX_RATE caps all
+# downloads together; DOWNLOAD_RATE_SCHEDULE entries ('HH:MM', 'HH:MM', rate)
+# replace it during their window (windows may wrap past midnight), e.g.
+# [('01:00', '07:00', 0)] for full speed overnight. While videos are being
+# streamed (and for STREAM_ACTIVITY_GRACE seconds after) downloads are held
+# to DOWNLOAD_RATE_WHILE_STREAMING.
+DOWNLOAD_MAX_RATE = 0
+DOWNLOAD_MAX_RATE_PER_DOWNLOAD = 0
+DOWNLOAD_RATE_SCHEDULE = []
+DOWNLOAD_RATE_WHILE_STREAMING = 2 * 1024 * 1024  # 2MB/s
+STREAM_ACTIVITY_GRACE = 10
+# Storage quota (off unless enabled with a STORAGE_QUOTA_BYTES): before each
+# download (and with `manage.py enforce_quota`), if the library's video files
+# and partial downloads would pass STORAGE_HIGH_WATER of STORAGE_QUOTA_BYTES, files of the least
+# recently watched unpinned videos are deleted until they are under
+# STORAGE_LOW_WATER; the videos go back to pending. Nothing is deleted if that
+# mark can't be reached. Downloads whose size the origin doesn't give are
+# counted as STORAGE_DOWNLOAD_RESERVE_BYTES.
+STORAGE_QUOTA_ENABLED = False
+STORAGE_QUOTA_BYTES = 0
+STORAGE_HIGH_WATER = 0.90
+STORAGE_LOW_WATER = 0.80
+STORAGE_DOWNLOAD_RESERVE_BYTES = 1024 * 1024 * 1024  # 1GB
+
+# Download/transcode progress is tracked in memory and saved to the Video row
+# at most this often.
+PROGRESS_FLUSH_SECONDS = 5
+# Last-played time and bytes served, likewise, from stream_video.
+PLAYBACK_FLUSH_SECONDS = 30
+
+# Watch-while-downloading: an in-flight video can be played once its first
+# bytes show it plays as is (or from the fragmented MP4 a conversion writes).
+# Players reading ahead of the writer wait up to PROGRESSIVE_WAIT_SECONDS.
+PROGRESSIVE_STREAMING = True
+PROGRESSIVE_PROBE_BYTES = 4 * 1024 * 1024
+PROGRESSIVE_WAIT_SECONDS = 30
+PROGRESSIVE_POLL_SECONDS = 0.5
+
+# What Android 4.4 can play. Downloads are probed with ffprobe and only
+# re-encoded as far as needed: kept, remuxed into MP4 (-c copy), audio
+# re-encoded, or fully transcoded to H.264/AAC.
+ANDROID_VIDEO_CODECS = ['h264']
+ANDROID_H264_PROFILES = ['Constrained Baseline', 'Baseline', 'Main', 'High']
+ANDROID_H264_MAX_LEVEL = 41
+ANDROID_PIX_FMTS = ['yuv420p', 'yuvj420p']
+ANDROID_AUDIO_CODECS = ['aac', 'mp3']
+ANDROID_WEBM_VIDEO_CODECS = ['vp8']
+
+# Conversions are run by a per-process scheduler: at most TRANSCODE_MAX_JOBS
+# ffmpeg processes at once, each with TRANSCODE_THREADS encoder threads, under
+# `nice -n TRANSCODE_NICE` and `ionice -c TRANSCODE_IONICE_CLASS` (3 = idle,
+# 2 = best-effort at TRANSCODE_IONICE_LEVEL; None to skip). Titles requested
+# from the list page are converted before bulk downloads.
+TRANSCODE_MAX_JOBS = 1
+TRANSCODE_THREADS = 2
+TRANSCODE_NICE = 10
+TRANSCODE_IONICE_CLASS = 3
+TRANSCODE_IONICE_LEVEL = 7
+
+# Poster and seek preview sprite, extracted after each download (and by the
+# `extract_metadata` command for older titles) with one keyframe seek per
+# frame. The poster is taken POSTER_POSITION of the way into the video.
+POSTER_POSITION = 0.1
+POSTER_HEIGHT = 360
+SPRITE_FRAMES = 25
+SPRITE_COLUMNS = 5
+SPRITE_FRAME_WIDTH = 160
+METADATA_WORKERS = 4
+METADATA_BATCH_SIZE = 50
+
+# Optional HLS packaging after a download: MPEG-TS segments (HLS v3, which
+# Android 4.4 plays) at every rung of the ladder no taller than the source,
+# so the player can drop to a lower bitrate instead of stalling on weak Wi-Fi.
+HLS_ENABLED = False
+HLS_ROOT = os.path.join(STORAGE_SERVER_PATH, 'hls')
+HLS_SEGMENT_SECONDS = 6
+HLS_LADDER = [
+    {'name': '360p', 'height': 360, 'video_bitrate': 700_000, 'audio_bitrate': 96_000, 'profile': 'baseline', 'level': '3.0'},
+    {'name': '480p', 'height': 480, 'video_bitrate': 1_200_000, 'audio_bitrate': 128_000, 'profile': 'main', 'level': '3.1'},
+    {'name': '720p', 'height': 720, 'video_bitrate': 2_500_000, 'audio_bitrate': 128_000, 'profile': 'main', 'level': '3.1'},
+]
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
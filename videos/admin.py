@@ -1,27 +1,46 @@
+from django import forms
+from django.conf import settings
 from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import path, reverse
 from django.db import transaction
-from django.shortcuts import redirect
+from django.db.models import Q
+from django.shortcuts import redirect, render
 from django.contrib import messages
-from .models import Video
+from django.core.exceptions import PermissionDenied
+from .models import Video, DownloadJob
 from .manager import video_manager
+from .search import search
+from .importer import import_videos, FORMATS
+
+# Rejected rows listed in the admin after an import; the command prints them all.
+IMPORT_REJECTED_SHOWN = 20
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(help_text="Text, CSV or JSON Lines")
+    format = forms.ChoiceField(choices=[('', 'Detect')] + [(name, name) for name in FORMATS], required=False)
+    download = forms.BooleanField(initial=True, required=False, label="Queue downloads")
 
 @admin.register(Video)
 class VideoAdmin(admin.ModelAdmin):
-    list_display = ('title', 'status_badge', 'file_size_display', 'created_at', 'video_actions')
-    list_filter = ('status', 'created_at')
+    list_display = ('title', 'status_badge', 'file_size_display', 'created_at', 'last_played_at', 'video_actions')
+    list_filter = ('status', 'pinned', 'created_at')
+    change_list_template = 'admin/videos/video/change_list.html'
     search_fields = ('title', 'download_url')
-    readonly_fields = ('status', 'file_size', 'created_at', 'updated_at', 'video_preview')
+    readonly_fields = ('status', 'file_size', 'media_info', 'conversion_mode', 'hls_renditions', 'created_at', 'updated_at', 'last_played_at', 'bytes_served', 'video_preview')
     fieldsets = (
         ('Video Information', {
             'fields': ('title', 'description', 'download_url')
         }),
         ('Video File', {
-            'fields': ('video_file', 'thumbnail', 'video_preview')
+            'fields': ('video_file', 'thumbnail', 'sprite', 'video_preview')
         }),
         ('Metadata', {
-            'fields': ('status', 'file_size', 'duration', 'error_message')
+            'fields': ('status', 'file_size', 'duration', 'media_info', 'conversion_mode', 'hls_renditions', 'error_message')
+        }),
+        ('Playback', {
+            'fields': ('pinned', 'last_played_at', 'bytes_served')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -29,8 +48,32 @@ class VideoAdmin(admin.ModelAdmin):
         }),
     )
     
-    actions = ['download_selected_videos', 'delete_files_selected']
+    actions = ['download_selected_videos', 'cancel_selected_downloads', 'delete_files_selected',
+               'pin_selected', 'unpin_selected']
     
+    def get_search_results(self, request, queryset, search_term):
+        # Words go through the full-text index, which doesn't hold URLs: hosts and
+        # URL fragments still match download_url.
+        if search_term and '/' not in search_term:
+            ids = search(search_term, limit=settings.SEARCH_ADMIN_LIMIT)
+            if ids is not None:
+                return queryset.filter(Q(pk__in=ids) | Q(download_url__icontains=search_term.strip())), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        # One snapshot for the whole page instead of a status lookup per row and column.
+        snapshot = video_manager.status_snapshot(changelist.result_list)
+        for video in changelist.result_list:
+            video.download_status = snapshot.get(video.pk)
+        return changelist
+
+    def download_status(self, obj):
+        status_info = getattr(obj, 'download_status', None)
+        if status_info is None:
+            status_info = video_manager.get_download_status(obj.id)
+        return status_info
+
     def status_badge(self, obj):
         colors = {
             'pending': 'gray',
@@ -40,9 +83,13 @@ class VideoAdmin(admin.ModelAdmin):
         }
         thread_info = ""
         if obj.status == 'downloading':
-            status_info = video_manager.get_download_status(obj.id)
-            if status_info.get('thread_alive'):
-                thread_info = ' (active)'
+            status_info = self.download_status(obj)
+            if status_info.get('job_alive'):
+                percent = status_info.get('progress', {}).get('percent')
+                if percent is not None:
+                    thread_info = f" ({status_info.get('job_status')} {percent:.0f}%)"
+                else:
+                    thread_info = f" ({status_info.get('job_status')})"
             else:
                 thread_info = ' (stalled)'
                 return format_html(
@@ -65,8 +112,8 @@ class VideoAdmin(admin.ModelAdmin):
         buttons = []
         is_stalled = False
         if obj.status == 'downloading':
-            status_info = video_manager.get_download_status(obj.id)
-            if not status_info.get('thread_alive'):
+            status_info = self.download_status(obj)
+            if not status_info.get('job_alive'):
                 is_stalled = True
         if obj.status in ['pending', 'error'] or is_stalled:
             btn_label = "Retry Download" if is_stalled else "Download"
@@ -128,29 +175,47 @@ class VideoAdmin(admin.ModelAdmin):
     video_preview.short_description = 'Video Preview'
     
     def download_selected_videos(self, request, queryset):
+        ids = queryset.filter(status__in=['pending', 'error', 'downloading']).values_list('pk', flat=True)
+        count = video_manager.download_videos(ids)
+        self.message_user(request, f"Queued download for {count} videos")
+    download_selected_videos.short_description = "Download selected videos"
+    
+    def cancel_selected_downloads(self, request, queryset):
         count = 0
         for video in queryset:
-            if video.status in ['pending', 'error', 'downloading']:
-                video.status = 'pending'
-                video.save()
-                if video_manager.download_video(video):
-                    count += 1
-        self.message_user(request, f"Started download for {count} videos")
-    download_selected_videos.short_description = "Download selected videos"
+            if video_manager.cancel_download(video.id):
+                count += 1
+        self.message_user(request, f"Cancelled {count} downloads")
+    cancel_selected_downloads.short_description = "Cancel downloads/conversions of selected videos"
     
     def delete_files_selected(self, request, queryset):
         deleted_count = 0
         for video in queryset:
             if video.delete_video_file():
+                video.delete_sprite_file()
+                video.delete_hls_files()
                 video.video_file = None
                 video.thumbnail = None
+                video.sprite = None
+                video.hls_renditions = []
                 video.status = 'pending'
+                video.file_size = 0
                 video.save()
                 deleted_count += 1
         
         self.message_user(request, f"Deleted files for {deleted_count} videos")
     delete_files_selected.short_description = "Delete files from selected videos"
 
+    def pin_selected(self, request, queryset):
+        count = queryset.update(pinned=True)
+        self.message_user(request, f"Pinned {count} videos, they won't be evicted to free space")
+    pin_selected.short_description = "Pin selected videos (never evict)"
+
+    def unpin_selected(self, request, queryset):
+        count = queryset.update(pinned=False)
+        self.message_user(request, f"Unpinned {count} videos")
+    unpin_selected.short_description = "Unpin selected videos"
+
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)
         should_download = False
@@ -173,6 +238,9 @@ class VideoAdmin(admin.ModelAdmin):
             path('<uuid:video_id>/delete-files/', 
                  self.admin_site.admin_view(self.delete_files_view), 
                  name='videos_video_delete_files'),
+            path('import/',
+                 self.admin_site.admin_view(self.import_view),
+                 name='videos_video_import'),
         ]
         return custom_urls + urls
     
@@ -182,23 +250,51 @@ class VideoAdmin(admin.ModelAdmin):
             video.status = 'pending'
             video.save()
             
-        success = video_manager.download_video(video)
+        success = video_manager.download_video(video, priority=DownloadJob.PRIORITY_USER)
         
         if success:
-            messages.success(request, f'Started download for "{video.title}"')
+            messages.success(request, f'Queued download for "{video.title}"')
         else:
             messages.warning(request, f'Could not start download for "{video.title}" (Check logs)')
             
         return redirect('admin:videos_video_changelist')
     
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            lines = upload.read().decode('utf-8-sig', errors='replace').splitlines()
+            report = import_videos(lines, format=form.cleaned_data['format'], name=upload.name,
+                                   download=form.cleaned_data['download'])
+            messages.success(request, report.summary())
+            for number, value, reason in report.rejected[:IMPORT_REJECTED_SHOWN]:
+                messages.warning(request, f"Line {number}: {reason}: {value}")
+            if len(report.rejected) > IMPORT_REJECTED_SHOWN:
+                messages.warning(request, f"... and {len(report.rejected) - IMPORT_REJECTED_SHOWN} more rejected rows")
+            return redirect('admin:videos_video_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import videos',
+            'form': form,
+        }
+        return render(request, 'admin/videos/video/import.html', context)
+
     def delete_files_view(self, request, video_id):
         video = Video.objects.get(id=video_id)
         video_deleted = video.delete_video_file()
         thumbnail_deleted = video.delete_thumbnail_file()
+        sprite_deleted = video.delete_sprite_file()
+        hls_deleted = video.delete_hls_files()
         
-        if video_deleted or thumbnail_deleted:
+        if video_deleted or thumbnail_deleted or sprite_deleted or hls_deleted:
             video.video_file = None
             video.thumbnail = None
+            video.sprite = None
+            video.hls_renditions = []
             video.status = 'pending'
             video.file_size = 0
             video.save()
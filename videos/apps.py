@@ -2,4 +2,10 @@ from django.apps import AppConfig
 
 
 class VideosConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
     name = 'videos'
+
+    def ready(self):
+        # Signal receivers that keep the stream cache and search index in sync,
+        # and time database writes.
+        from . import descriptors, search, metrics  # noqa: F401
@@ -0,0 +1,180 @@
+import time
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+STREAM_ACTIVITY_KEY = 'videos:stream-activity'
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. ``consume`` takes tokens up front and sleeps off
+    any debt outside the lock, so concurrent callers share the rate fairly.
+    """
+    def __init__(self, burst_seconds: float = 0.5):
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int, rate: int) -> float:
+        if not rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            burst = max(rate * self.burst_seconds, amount)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateMeter:
+    """Bytes per second over a short sliding window, kept in small time bins."""
+    def __init__(self, window: float = 5.0, resolution: float = 0.5):
+        self.window = window
+        self.resolution = resolution
+        self.bins = deque()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount: int):
+        now = time.monotonic()
+        with self.lock:
+            self.total += amount
+            if self.bins and now - self.bins[-1][0] < self.resolution:
+                self.bins[-1][1] += amount
+            else:
+                self.bins.append([now, amount])
+            while self.bins and self.bins[0][0] < now - self.window:
+                self.bins.popleft()
+
+    def rate(self) -> float:
+        cutoff = time.monotonic() - self.window
+        with self.lock:
+            recent = sum(amount for at, amount in self.bins if at >= cutoff)
+        return recent / self.window
+
+
+def _parse_clock(value: str):
+    return datetime.strptime(value, '%H:%M').time()
+
+
+class BandwidthGovernor:
+    """
+    Shared limit on download bandwidth: a total bucket every download draws
+    from plus one bucket per download. The total limit follows
+    DOWNLOAD_RATE_SCHEDULE and drops to DOWNLOAD_RATE_WHILE_STREAMING while
+    videos are being streamed, so playback keeps the NIC and disk it needs.
+
+    Stream activity is also written to the Django cache, so download workers
+    in other processes back off too when the cache is shared.
+    """
+    def __init__(self):
+        self.total_bucket = TokenBucket()
+        self.total_meter = RateMeter()
+        self.downloads = {}
+        self.lock = threading.Lock()
+        self.active_streams = 0
+        self._activity_written = 0.0
+        self._limit_cache = (0.0, None)
+
+    # Limits
+
+    def scheduled_rate(self) -> int:
+        now = timezone.localtime().time() if settings.USE_TZ else datetime.now().time()
+        for start, end, rate in settings.DOWNLOAD_RATE_SCHEDULE:
+            start, end = _parse_clock(start), _parse_clock(end)
+            if start <= end:
+                if start <= now < end:
+                    return rate
+            elif now >= start or now < end:
+                # Window wraps past midnight, e.g. 23:00-07:00.
+                return rate
+        return settings.DOWNLOAD_MAX_RATE
+
+    def streaming(self) -> bool:
+        if self.active_streams:
+            return True
+        return (cache.get(STREAM_ACTIVITY_KEY) or 0) > time.time()
+
+    def total_rate_limit(self) -> int:
+        # Re-evaluated once a second; consume() is called for every chunk.
+        checked_at, limit = self._limit_cache
+        now = time.monotonic()
+        if limit is not None and now - checked_at < 1.0:
+            return limit
+        limit = self.scheduled_rate()
+        backoff = settings.DOWNLOAD_RATE_WHILE_STREAMING
+        if backoff and self.streaming():
+            limit = min(limit, backoff) if limit else backoff
+        self._limit_cache = (now, limit)
+        return limit
+
+    # Downloads
+
+    @contextmanager
+    def download(self, key):
+        with self.lock:
+            self.downloads[key] = {'bucket': TokenBucket(), 'meter': RateMeter()}
+        try:
+            yield lambda amount: self.consume(key, amount)
+        finally:
+            with self.lock:
+                self.downloads.pop(key, None)
+
+    def consume(self, key, amount: int):
+        entry = self.downloads.get(key)
+        if entry is not None:
+            entry['bucket'].consume(amount, settings.DOWNLOAD_MAX_RATE_PER_DOWNLOAD)
+            entry['meter'].add(amount)
+        self.total_bucket.consume(amount, self.total_rate_limit())
+        self.total_meter.add(amount)
+
+    # Streams
+
+    def stream_started(self):
+        with self.lock:
+            self.active_streams += 1
+        self.note_stream_activity(force=True)
+
+    def stream_finished(self):
+        with self.lock:
+            self.active_streams = max(0, self.active_streams - 1)
+
+    def note_stream_activity(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._activity_written < 1.0:
+            return
+        self._activity_written = now
+        try:
+            cache.set(STREAM_ACTIVITY_KEY, now + settings.STREAM_ACTIVITY_GRACE, settings.STREAM_ACTIVITY_GRACE)
+        except Exception as e:
+            logger.warning(f"Could not record stream activity: {e}")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            downloads = {str(key): round(entry['meter'].rate()) for key, entry in self.downloads.items()}
+        return {
+            'total_limit': self.total_rate_limit(),
+            'per_download_limit': settings.DOWNLOAD_MAX_RATE_PER_DOWNLOAD,
+            'scheduled_limit': self.scheduled_rate(),
+            'streaming': self.streaming(),
+            'active_streams': self.active_streams,
+            'total_rate': round(self.total_meter.rate()),
+            'total_bytes': self.total_meter.total,
+            'downloads': downloads,
+        }
+
+
+governor = BandwidthGovernor()
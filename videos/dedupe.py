@@ -0,0 +1,56 @@
+import os
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Query parameters that only say where a link was shared, not what it points
+# to: these exact names, and any starting with utm_.
+TRACKING_PARAMS = {'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref'}
+TRACKING_PREFIX = 'utm_'
+
+
+def normalize_url(url: str) -> str:
+    """
+    The form of a download URL used to spot the same link added twice:
+    lowercase scheme and host, no default port, no fragment, no tracking
+    parameters, the rest of the query sorted.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    if parts.username:
+        host = f'{parts.username}{":" + parts.password if parts.password else ""}@{host}'
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIX)
+    )
+    return urlunsplit((scheme, host, parts.path or '/', urlencode(query), ''))
+
+
+def stored_original(video):
+    """
+    A completed video with a file on disk that ``video`` is a copy of: same
+    normalized URL, or (once downloaded) the same source checksum.
+    """
+    from django.db.models import Q
+    from .models import Video
+
+    match = Q(normalized_url=video.normalized_url)
+    if video.source_checksum:
+        match |= Q(source_checksum=video.source_checksum)
+    candidates = (
+        Video.objects.filter(match, status='completed')
+        .exclude(pk=video.pk)
+        .exclude(Q(video_file='') | Q(video_file=None))
+        .order_by('created_at')
+    )
+    for candidate in candidates:
+        if os.path.exists(candidate.get_absolute_path()):
+            return candidate
+    return None
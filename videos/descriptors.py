@@ -0,0 +1,89 @@
+import os
+import time
+import mimetypes
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+from .ranges import make_etag
+
+
+class StreamDescriptor:
+    """Everything a Range request needs to know about a file, without asking the database."""
+    __slots__ = ('path', 'size', 'mtime', 'mtime_ns', 'content_type', 'etag', 'cacheable', 'byte_rate', 'checked_at')
+
+    def __init__(self, path: str, stat: os.stat_result, cacheable: bool, content_type: str | None = None,
+                 byte_rate: int = 0):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.mtime_ns = stat.st_mtime_ns
+        self.content_type = content_type or mimetypes.guess_type(path)[0] or 'video/mp4'
+        self.etag = make_etag(self.size, self.mtime_ns)
+        self.cacheable = cacheable
+        self.byte_rate = byte_rate
+        self.checked_at = time.monotonic()
+
+    @classmethod
+    def from_path(cls, path: str, cacheable: bool, content_type: str | None = None, byte_rate: int = 0):
+        return cls(path, os.stat(path), cacheable, content_type, byte_rate)
+
+    @property
+    def filename(self) -> str:
+        return os.path.basename(self.path)
+
+    def still_valid(self) -> bool:
+        """Re-stat at most every STREAM_DESCRIPTOR_REVALIDATE_SECONDS; False if the file changed or went away."""
+        now = time.monotonic()
+        if now - self.checked_at < settings.STREAM_DESCRIPTOR_REVALIDATE_SECONDS:
+            return True
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if stat.st_size != self.size or stat.st_mtime_ns != self.mtime_ns:
+            return False
+        self.checked_at = now
+        return True
+
+
+class DescriptorCache:
+    """
+    LRU of stream descriptors by video id, for this process. Dropped on
+    Video save/delete; a changed file is noticed by ``still_valid``.
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, video_id) -> StreamDescriptor | None:
+        with self.lock:
+            descriptor = self.entries.get(video_id)
+            if descriptor is not None:
+                self.entries.move_to_end(video_id)
+            return descriptor
+
+    def put(self, video_id, descriptor: StreamDescriptor):
+        with self.lock:
+            self.entries[video_id] = descriptor
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > settings.STREAM_DESCRIPTOR_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, video_id):
+        with self.lock:
+            self.entries.pop(video_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+descriptors = DescriptorCache()
+
+
+@receiver(post_save, sender='videos.Video')
+@receiver(post_delete, sender='videos.Video')
+def invalidate_descriptor(sender, instance, **kwargs):
+    descriptors.invalidate(instance.pk)
@@ -0,0 +1,142 @@
+import os
+import re
+import shutil
+import logging
+from django.conf import settings
+from .media import summarize
+from .transcoder import scheduler
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_NAME = 'index.m3u8'
+# \Z, not $: $ also matches before a trailing newline.
+HLS_FILE_RE = re.compile(r'^[\w-]+\.(m3u8|ts)\Z')
+H264_PROFILE_IDC = {'baseline': '42e0', 'main': '4d40', 'high': '6400'}
+
+
+def hls_dir(video_id) -> str:
+    return os.path.join(settings.HLS_ROOT, str(video_id))
+
+
+def remove_hls(video_id):
+    shutil.rmtree(hls_dir(video_id), ignore_errors=True)
+
+
+def ladder_for(info: dict | None) -> list[dict]:
+    """The renditions worth making for a source: none taller than it, but at least the smallest."""
+    ladder = sorted(settings.HLS_LADDER, key=lambda rendition: rendition['height'])
+    height = summarize(info)['height'] if info else None
+    if not height:
+        return ladder
+    return [rendition for rendition in ladder if rendition['height'] <= height] or ladder[:1]
+
+
+def rendition_size(rendition: dict, info: dict | None) -> tuple[int, int]:
+    summary = summarize(info) if info else {}
+    height = rendition['height']
+    if summary.get('width') and summary.get('height'):
+        # Keep the source aspect ratio; x264 wants even dimensions.
+        return round(summary['width'] * height / summary['height'] / 2) * 2, height
+    return round(height * 16 / 9 / 2) * 2, height
+
+
+def codecs(rendition: dict) -> str:
+    profile = H264_PROFILE_IDC.get(rendition.get('profile', 'main'), '4d40')
+    level = int(float(rendition.get('level', '3.1')) * 10)
+    return f'avc1.{profile}{level:02x},mp4a.40.2'
+
+
+def rendition_command(source_path: str, rendition: dict, output_dir: str) -> list[str]:
+    seconds = settings.HLS_SEGMENT_SECONDS
+    video_bitrate = rendition['video_bitrate']
+    return [
+        'ffmpeg', '-y',
+        '-i', source_path,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f"scale=-2:{rendition['height']}",
+        '-c:v', 'libx264',
+        '-profile:v', rendition.get('profile', 'main'), '-level', rendition.get('level', '3.1'),
+        '-pix_fmt', 'yuv420p',
+        '-b:v', str(video_bitrate),
+        '-maxrate', str(int(video_bitrate * 1.1)),
+        '-bufsize', str(video_bitrate * 2),
+        # A keyframe on every segment boundary, so each segment starts clean.
+        '-force_key_frames', f'expr:gte(t,n_forced*{seconds})', '-sc_threshold', '0',
+        '-c:a', 'aac', '-b:a', str(rendition['audio_bitrate']), '-ac', '2',
+        '-f', 'hls',
+        '-hls_time', str(seconds),
+        '-hls_playlist_type', 'vod',
+        '-hls_list_size', '0',
+        '-hls_segment_type', 'mpegts',
+        '-hls_segment_filename', os.path.join(output_dir, 'segment_%05d.ts'),
+        os.path.join(output_dir, PLAYLIST_NAME),
+    ]
+
+
+def package_hls(video_id, source_path: str, info: dict | None, priority: int = 0, cancel_event=None) -> list[dict]:
+    """
+    Cut ``source_path`` into HLS v3 (MPEG-TS segments) at every rung of the
+    ladder that fits the source. The renditions are built next to the live
+    directory and swapped in at the end, so players never see half a ladder.
+    Returns what the master playlist needs to know about each rendition.
+    """
+    work_dir = hls_dir(video_id) + '.tmp'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    renditions = []
+    try:
+        for rendition in ladder_for(info):
+            output_dir = os.path.join(work_dir, rendition['name'])
+            os.makedirs(output_dir)
+            logger.info(f"Packaging HLS {rendition['name']} for {video_id}")
+            command = rendition_command(source_path, rendition, output_dir)
+            job = scheduler.run(f'hls:{video_id}', command, priority=priority, cancel_event=cancel_event,
+                                kind='hls')
+            if job.returncode != 0 or not os.path.exists(os.path.join(output_dir, PLAYLIST_NAME)):
+                raise RuntimeError(f"ffmpeg failed for {rendition['name']}: {job.stderr}")
+
+            width, height = rendition_size(rendition, info)
+            renditions.append({
+                'name': rendition['name'],
+                'width': width,
+                'height': height,
+                # Peak rate, as HLS asks for: the encoder may go 10% over the target.
+                'bandwidth': int((rendition['video_bitrate'] + rendition['audio_bitrate']) * 1.1),
+                'codecs': codecs(rendition),
+            })
+
+        remove_hls(video_id)
+        os.replace(work_dir, hls_dir(video_id))
+        return renditions
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def master_playlist(renditions: list[dict], playlist_url) -> str:
+    """HLS v3 master playlist; ``playlist_url(name)`` gives each rendition's media playlist."""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    # Lowest first: players that don't measure bandwidth start with the first entry.
+    for rendition in sorted(renditions, key=lambda r: r['bandwidth']):
+        lines.append(
+            f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']},"
+            f"RESOLUTION={rendition['width']}x{rendition['height']},"
+            f"CODECS=\"{rendition['codecs']}\""
+        )
+        lines.append(playlist_url(rendition['name']))
+    return '\n'.join(lines) + '\n'
+
+
+def share_hls(source_id, video_id) -> bool:
+    """Give ``video_id`` the renditions already packaged for ``source_id``, hard-linked where possible."""
+    destination = hls_dir(video_id)
+    shutil.rmtree(destination, ignore_errors=True)
+    try:
+        try:
+            shutil.copytree(hls_dir(source_id), destination, copy_function=os.link)
+        except shutil.Error:
+            shutil.rmtree(destination, ignore_errors=True)
+            shutil.copytree(hls_dir(source_id), destination)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not share HLS renditions of {source_id}: {e}")
+        shutil.rmtree(destination, ignore_errors=True)
+        return False
@@ -0,0 +1,195 @@
+import os
+import csv
+import json
+import time
+import logging
+from itertools import chain
+from urllib.parse import urlparse
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.db.models import Q
+from .models import Video, DownloadJob, LibraryStats
+from .dedupe import normalize_url
+from .search import index_videos
+from .manager import video_manager
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('text', 'csv', 'jsonl')
+URL_COLUMNS = ('url', 'download_url')
+validate_url = URLValidator(schemes=['http', 'https'])
+
+
+def detect_format(name: str, first_line: str) -> str:
+    extension = os.path.splitext(name or '')[1].lower()
+    if extension in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    if extension == '.txt':
+        return 'text'
+    first_line = first_line.lstrip()
+    if first_line.startswith(('{', '"')):
+        return 'jsonl'
+    if ',' in first_line:
+        return 'csv'
+    return 'text'
+
+
+def text_rows(lines):
+    """One URL per line, optionally followed by a title; blank lines and # comments are skipped."""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, *title = line.split(None, 1)
+        yield number, {'url': url, 'title': ''.join(title)}, None
+
+
+def csv_rows(lines):
+    """url,title,description columns, or any columns under a header naming a url (or download_url) one."""
+    reader = csv.reader(lines)
+    columns = ['url', 'title', 'description']
+    for cells in reader:
+        if not any(cell.strip() for cell in cells):
+            continue
+        names = [cell.strip().lower() for cell in cells]
+        if reader.line_num == 1 and set(names) & set(URL_COLUMNS):
+            columns = names
+            continue
+        row = dict(zip(columns, (cell.strip() for cell in cells)))
+        url = next((row[name] for name in URL_COLUMNS if row.get(name)), '')
+        yield reader.line_num, {**row, 'url': url}, None
+
+
+def jsonl_rows(lines):
+    """An object with url (or download_url), title and description per line, or just a URL string."""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as e:
+            yield number, line, f"not JSON: {e}"
+            continue
+        if isinstance(value, str):
+            value = {'url': value}
+        if not isinstance(value, dict):
+            yield number, line, "not a JSON object"
+            continue
+        url = next((value[name] for name in URL_COLUMNS if isinstance(value.get(name), str)), '')
+        yield number, {**value, 'url': url}, None
+
+
+ROW_READERS = {'text': text_rows, 'csv': csv_rows, 'jsonl': jsonl_rows}
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.queued = 0
+        self.duplicates = 0
+        self.rejected = []  # (line number, URL or line, reason)
+        self.seconds = 0.0
+
+    def reject(self, number: int, row, reason: str):
+        self.rejected.append((number, row.get('url') if isinstance(row, dict) else row, reason))
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Imported {self.created} videos ({self.queued} queued) from {self.rows} rows "
+            f"in {self.seconds:.2f}s ({self.rows_per_second:.0f} rows/s); "
+            f"{len(self.rejected)} rejected, {self.duplicates} of them duplicates"
+        )
+
+
+def import_videos(lines, format: str = '', name: str = '', download: bool = True,
+                  priority: int = DownloadJob.PRIORITY_NORMAL) -> ImportReport:
+    """
+    Add a video for every new URL in ``lines`` (text, CSV or JSON Lines, see
+    the *_rows readers; detected from ``name`` and the first line unless
+    ``format`` is given) and queue their downloads. URLs already in the
+    library, or earlier in the list, are rejected as duplicates.
+    """
+    started = time.perf_counter()
+    report = ImportReport()
+    lines = iter(lines)
+    first_line = next(lines, '')
+    rows = ROW_READERS[format or detect_format(name, first_line)](chain([first_line], lines))
+
+    seen = {}
+    batch = []
+    for number, row, error in rows:
+        report.rows += 1
+        if error:
+            report.reject(number, row, error)
+            continue
+        url = str(row['url']).strip()
+        try:
+            if len(url) > Video._meta.get_field('download_url').max_length:
+                raise ValidationError("too long")
+            validate_url(url)
+        except ValidationError:
+            report.reject(number, row, "not a valid http(s) URL")
+            continue
+        normalized = normalize_url(url)
+        if normalized in seen:
+            report.duplicates += 1
+            report.reject(number, row, f"same URL as line {seen[normalized]}")
+            continue
+        seen[normalized] = number
+
+        title = str(row.get('title') or '').strip() or os.path.basename(urlparse(url).path) or url
+        batch.append((number, row, Video(
+            title=title[:Video._meta.get_field('title').max_length],
+            description=str(row.get('description') or '').strip(),
+            download_url=url,
+            normalized_url=normalized,
+        )))
+        if len(batch) >= settings.IMPORT_BATCH_SIZE:
+            create_batch(batch, report, download, priority)
+            batch = []
+    if batch:
+        create_batch(batch, report, download, priority)
+
+    report.rejected.sort(key=lambda rejected: rejected[0])
+    report.seconds = time.perf_counter() - started
+    logger.info(report.summary())
+    return report
+
+
+def create_batch(batch: list, report: ImportReport, download: bool, priority: int):
+    urls = [video.download_url for _, _, video in batch]
+    normalized = [video.normalized_url for _, _, video in batch]
+    existing = set()
+    for download_url, normalized_url in Video.objects.filter(
+            Q(normalized_url__in=normalized) | Q(download_url__in=urls)).values_list('download_url', 'normalized_url'):
+        # Rows from before normalized_url was stored have it blank.
+        existing.add(normalized_url or normalize_url(download_url))
+
+    videos = []
+    for number, row, video in batch:
+        if video.normalized_url in existing:
+            report.duplicates += 1
+            report.reject(number, row, "already in the library")
+        else:
+            videos.append(video)
+    if not videos:
+        return
+
+    # bulk_create skips Video.save() and the signals: keep the stats and the search index in step here.
+    with transaction.atomic():
+        Video.objects.bulk_create(videos)
+        LibraryStats.add('pending', len(videos))
+        index_videos(videos)
+    report.created += len(videos)
+    if download:
+        report.queued += video_manager.download_videos([video.pk for video in videos], priority=priority)
@@ -0,0 +1,213 @@
+import os
+import uuid
+import socket
+import logging
+import threading
+from datetime import timedelta
+from django.db import transaction, close_old_connections
+from django.db.models import F, Q, Count, Sum
+from django.conf import settings
+from django.utils import timezone
+from .models import Video, DownloadJob, LibraryStats
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadQueue:
+    """
+    Download jobs stored in the database so they survive restarts and can be
+    shared by several processes. A worker claims a job with a single UPDATE
+    and then holds a lease on it, renewed by heartbeats; a job whose lease
+    runs out is handed to the next worker that asks for work.
+    """
+    def __init__(self):
+        self.wakeup = threading.Event()
+
+    @property
+    def lease_seconds(self):
+        return settings.DOWNLOAD_LEASE_SECONDS
+
+    def enqueue(self, video, priority: int = DownloadJob.PRIORITY_NORMAL):
+        now = timezone.now()
+        with transaction.atomic():
+            active = DownloadJob.objects.filter(video_id=video.pk, status__in=DownloadJob.ACTIVE_STATUSES)
+            if any(job.is_alive for job in active):
+                return None
+            # Whatever is left is a running job whose worker has gone away.
+            active.update(status='failed', error_message='Lease expired', finished_at=now)
+
+            if not Video.set_status(video.pk, 'downloading', exclude=('completed',)):
+                return None
+            job = DownloadJob.objects.create(video_id=video.pk, priority=priority)
+
+        self.wakeup.set()
+        return job
+
+    def enqueue_many(self, video_ids, priority: int = DownloadJob.PRIORITY_NORMAL) -> int:
+        """
+        enqueue() for a batch of videos in one transaction and a handful of
+        queries. Returns how many jobs were created.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            active = DownloadJob.objects.filter(video_id__in=video_ids, status__in=DownloadJob.ACTIVE_STATUSES)
+            busy = {job.video_id for job in active if job.is_alive}
+            active.exclude(video_id__in=busy).update(status='failed', error_message='Lease expired', finished_at=now)
+
+            videos = Video.objects.filter(pk__in=video_ids).exclude(status='completed').exclude(pk__in=busy)
+            ids = list(videos.values_list('pk', flat=True))
+            moving = videos.exclude(status='downloading').order_by().values('status').annotate(
+                videos=Count('pk'), size=Sum('file_size'))
+            for row in moving:
+                LibraryStats.add(row['status'], -row['videos'], -(row['size'] or 0))
+                LibraryStats.add('downloading', row['videos'], row['size'] or 0)
+            Video.objects.filter(pk__in=ids).update(status='downloading')
+            DownloadJob.objects.bulk_create([DownloadJob(video_id=pk, priority=priority) for pk in ids])
+
+        if ids:
+            self.wakeup.set()
+        return len(ids)
+
+    def claim(self, owner: str):
+        """Atomically lease the most urgent available job, or return None."""
+        now = timezone.now()
+        self._fail_exhausted(now)
+
+        available = (
+            Q(status='queued')
+            | Q(status='running', lease_expires_at__lt=now)
+        ) & Q(attempts__lt=settings.DOWNLOAD_MAX_ATTEMPTS)
+        candidate = DownloadJob.objects.filter(available).order_by('-priority', 'created_at').values('pk')[:1]
+
+        token = uuid.uuid4()
+        claimed = DownloadJob.objects.filter(available, pk__in=candidate).update(
+            status='running',
+            lease_owner=owner,
+            lease_token=token,
+            lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+            heartbeat_at=now,
+            started_at=now,
+            attempts=F('attempts') + 1,
+        )
+        if not claimed:
+            return None
+        return DownloadJob.objects.select_related('video').get(lease_token=token)
+
+    def heartbeat(self, job) -> bool:
+        """Extend the lease; False means another worker or an admin took the job away."""
+        now = timezone.now()
+        return bool(DownloadJob.objects.filter(pk=job.pk, status='running', lease_token=job.lease_token).update(
+            heartbeat_at=now,
+            lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+        ))
+
+    def finish(self, job, success: bool, error: str = ''):
+        DownloadJob.objects.filter(pk=job.pk, lease_token=job.lease_token).update(
+            status='done' if success else 'failed',
+            error_message=error,
+            lease_expires_at=None,
+            finished_at=timezone.now(),
+        )
+
+    def cancel(self, video_id) -> int:
+        return DownloadJob.objects.filter(video_id=video_id, status__in=DownloadJob.ACTIVE_STATUSES).update(
+            status='cancelled',
+            lease_expires_at=None,
+            finished_at=timezone.now(),
+        )
+
+    def latest_job(self, video_id):
+        return DownloadJob.objects.filter(video_id=video_id).order_by('-created_at').first()
+
+    def _fail_exhausted(self, now):
+        DownloadJob.objects.filter(
+            status='running',
+            lease_expires_at__lt=now,
+            attempts__gte=settings.DOWNLOAD_MAX_ATTEMPTS,
+        ).update(status='failed', error_message='Lease expired too many times', finished_at=now)
+
+
+class DownloadWorkerPool:
+    """
+    A fixed number of threads that claim jobs from the queue and hand them to
+    ``handler(job, cancel_event)``. A heartbeat thread per running job keeps
+    its lease alive and sets ``cancel_event`` if the lease is lost.
+    """
+    def __init__(self, queue: DownloadQueue, handler):
+        self.queue = queue
+        self.handler = handler
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self, workers: int | None = None):
+        workers = settings.DOWNLOAD_WORKERS if workers is None else workers
+        with self.lock:
+            if self.threads:
+                return
+            for number in range(workers):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f'download-worker-{number}',
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+        logger.info(f"Started {workers} download workers")
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.wakeup.set()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _worker_loop(self):
+        owner = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        while not self.stopping.is_set():
+            job = None
+            try:
+                job = self.queue.claim(owner)
+                if job is not None:
+                    self._run(job)
+            except Exception as e:
+                logger.error(f"Download worker error: {e}")
+            finally:
+                close_old_connections()
+
+            if job is None:
+                self.queue.wakeup.wait(settings.DOWNLOAD_POLL_SECONDS)
+                self.queue.wakeup.clear()
+
+    def _run(self, job):
+        cancel_event = threading.Event()
+        done = threading.Event()
+
+        def beat():
+            while not done.wait(self.queue.lease_seconds / 3):
+                try:
+                    if not self.queue.heartbeat(job):
+                        logger.warning(f"Lost lease on download job {job.pk}")
+                        cancel_event.set()
+                        return
+                except Exception as e:
+                    logger.error(f"Heartbeat failed for download job {job.pk}: {e}")
+                finally:
+                    close_old_connections()
+
+        heartbeat = threading.Thread(target=beat, name=f'download-heartbeat-{job.pk}', daemon=True)
+        heartbeat.start()
+        success, error = False, ''
+        try:
+            success = self.handler(job, cancel_event)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Download job {job.pk} crashed: {e}")
+        finally:
+            done.set()
+            heartbeat.join()
+            if not cancel_event.is_set():
+                if not success and not error:
+                    error = Video.objects.filter(pk=job.video_id).values_list('error_message', flat=True).first() or ''
+                self.queue.finish(job, success, error)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from videos.manager import video_manager
+from videos import metrics
+
+
+class Command(BaseCommand):
+    help = "Run download workers that take jobs from the shared download queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of worker threads (default: settings.DOWNLOAD_WORKERS)")
+        parser.add_argument('--metrics-port', type=int, default=None,
+                            help="Serve Prometheus metrics of this process on this port")
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            metrics.serve(options['metrics_port'])
+        video_manager.start_workers(options['workers'])
+        self.stdout.write(self.style.SUCCESS("Download workers running, press Ctrl+C to stop."))
+        try:
+            video_manager.pool.join()
+        except KeyboardInterrupt:
+            video_manager.pool.stop()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from videos.quota import quota, InsufficientStorage
+
+
+class Command(BaseCommand):
+    help = "Evict least recently watched videos if storage is past the high-water mark."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only list what would be evicted")
+
+    def handle(self, *args, **options):
+        if not quota.enabled:
+            raise CommandError("No storage quota: set STORAGE_QUOTA_ENABLED and STORAGE_QUOTA_BYTES")
+        used, capacity = quota.usage()
+        self.stdout.write(f"Using {used} of {capacity} bytes ({used / capacity:.0%})")
+        try:
+            evicted = quota.ensure_space(dry_run=options['dry_run'])
+        except InsufficientStorage as e:
+            raise CommandError(str(e))
+        verb = "Would evict" if options['dry_run'] else "Evicted"
+        for video in evicted:
+            self.stdout.write(f"  {verb} {video.title} ({video.file_size_human}), last watched {video.last_watched}")
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(evicted)} videos"))
@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+from videos.models import Video
+from videos.metadata import extract_metadata
+
+
+class Command(BaseCommand):
+    help = "Fill in duration, poster and seek preview sprite for downloaded videos that are missing them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Re-extract everything, not only what is missing")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Videos processed at once (default: settings.METADATA_WORKERS)")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Videos loaded per query (default: settings.METADATA_BATCH_SIZE)")
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.METADATA_WORKERS
+        batch_size = options['batch_size'] or settings.METADATA_BATCH_SIZE
+
+        queryset = Video.objects.filter(status='completed').exclude(Q(video_file='') | Q(video_file=None))
+        if not options['force']:
+            queryset = queryset.filter(
+                Q(duration=0) | Q(thumbnail='') | Q(thumbnail=None) | Q(sprite='') | Q(sprite=None)
+            )
+        ids = list(queryset.order_by('created_at').values_list('pk', flat=True))
+        self.stdout.write(f"{len(ids)} videos to process with {workers} workers")
+
+        started = time.monotonic()
+        updated = failed = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='metadata') as pool:
+            for offset in range(0, len(ids), batch_size):
+                batch = list(Video.objects.filter(pk__in=ids[offset:offset + batch_size]))
+                for result in pool.map(lambda video: self.process(video, options['force']), batch):
+                    if result is None:
+                        failed += 1
+                    elif result:
+                        updated += 1
+                self.stdout.write(f"  {min(offset + batch_size, len(ids))}/{len(ids)} "
+                                  f"({time.monotonic() - started:.0f}s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated {updated}, failed {failed}, in {time.monotonic() - started:.1f}s"
+        ))
+
+    def process(self, video, force):
+        try:
+            return extract_metadata(video, force=force)
+        except Exception as e:
+            self.stderr.write(f"{video.title}: {e}")
+            return None
+        finally:
+            close_old_connections()
@@ -0,0 +1,28 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from videos.importer import import_videos, FORMATS
+from videos.models import DownloadJob
+
+
+class Command(BaseCommand):
+    help = "Add videos from a list of URLs (text, CSV or JSON Lines) and queue their downloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="file to read, or - for stdin")
+        parser.add_argument('--format', choices=FORMATS, help="default: from the file name or first line")
+        parser.add_argument('--no-download', action='store_true', help="add the videos without queueing downloads")
+        parser.add_argument('--priority', type=int, default=DownloadJob.PRIORITY_NORMAL)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            f = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        except OSError as e:
+            raise CommandError(str(e))
+        with f:
+            report = import_videos(f, format=options['format'] or '', name='' if path == '-' else path,
+                                   download=not options['no_download'], priority=options['priority'])
+
+        for number, value, reason in report.rejected:
+            self.stdout.write(f"  line {number}: {reason}: {value}")
+        self.stdout.write(self.style.SUCCESS(report.summary()))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+from videos.search import search_available, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index over video titles and descriptions."
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError("This database has no FTS5 support")
+        rebuild_index()
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from videos.models import LibraryStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the library statistics table from the videos table."
+
+    def handle(self, *args, **options):
+        before = LibraryStats.totals()
+        LibraryStats.rebuild()
+        after = LibraryStats.totals()
+        for key in ('total_videos', 'completed_videos', 'total_size'):
+            if before[key] != after[key]:
+                self.stdout.write(f"  {key}: {before[key]} -> {after[key]}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{after['total_videos']} videos, {after['completed_videos']} completed, {after['total_size']} bytes"
+        ))
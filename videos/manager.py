@@ -1,126 +1,324 @@
 import os
+import re
 import time
+import hashlib
 import shlex
 import logging
 import requests
 import threading
 import subprocess
+from django.conf import settings
 from django.db import transaction
-from django.core.files import File
 from urllib.parse import urlparse
-from .models import Video
+from .models import Video, DownloadJob
+from .jobs import DownloadQueue, DownloadWorkerPool
+from .bandwidth import governor
+from .progress import progress
+from .transcoder import scheduler, TranscodeCancelled
+from .media import probe, summarize, plan_conversion, conversion_args, KEEP, TRANSCODE
+from .staging import staging_dir, remove_staging_dir, commit_to_storage, share_stored_file, file_sha256, HashingWriter
+from .segmented import SegmentedDownloader, RangesNotSupported, remove_partial
+from .hls import package_hls, share_hls
+from .dedupe import stored_original
+from .metadata import extract_metadata
+from . import metrics
+from .quota import quota
 
 logger = logging.getLogger(__name__)
 
+FFMPEG_DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+# How often (in bytes) a single-stream download reports its write position.
+PROGRESSIVE_PUBLISH_BYTES = 1024 * 1024
+# The columns a download writes. It holds its Video for hours, so saving the
+# whole row would undo what happened meanwhile: pinning, playback counts and
+# title or description edits in the admin.
+DOWNLOAD_FIELDS = ['status', 'progress_stage', 'video_file', 'file_size', 'duration', 'media_info',
+                   'conversion_mode', 'source_checksum']
+
 class VideoDownloadManager:
     def __init__(self):
         self.active_downloads = {}
         self.lock = threading.Lock()
+        self.queue = DownloadQueue()
+        self.pool = DownloadWorkerPool(self.queue, self._run_job)
     
-    def download_video(self, video_instance):
-        try:
-            with transaction.atomic():
-                video = Video.objects.select_for_update().get(pk=video_instance.pk)
-                if video.status == 'completed':
-                    return False  # Already downloaded
-                if video.status == 'downloading':
-                    return False  # Already downloading
-                
-                video.status = 'downloading'
-                video.save()
+    def start_workers(self, workers=None):
+        self.pool.start(workers)
 
-            thread = threading.Thread(
-                target=self._download_thread,
-                args=(video_instance,)
-            )
-            thread.daemon = True
-            thread.start()
-            
-            with self.lock:
-                self.active_downloads[video_instance.id] = {
-                    'thread': thread,
-                    'started_at': time.time(),
-                    'video': video_instance
-                }
+    def download_video(self, video_instance, priority=DownloadJob.PRIORITY_NORMAL):
+        try:
+            job = self.queue.enqueue(video_instance, priority=priority)
+            if job is None:
+                return False  # Already downloaded or queued
 
-            
-            logger.info(f"Download thread started for: {video_instance.title}")
+            logger.info(f"Download queued for: {video_instance.title} (priority {priority})")
             return True
             
         except Exception as e:
-            logger.error(f"Failed to start download: {e}")
+            logger.error(f"Failed to queue download: {e}")
             return False
 
+    def download_videos(self, video_ids, priority=DownloadJob.PRIORITY_NORMAL) -> int:
+        """Queue many videos, IMPORT_BATCH_SIZE per transaction. Returns how many were queued."""
+        video_ids = list(video_ids)
+        queued = 0
+        for start in range(0, len(video_ids), settings.IMPORT_BATCH_SIZE):
+            queued += self.queue.enqueue_many(video_ids[start:start + settings.IMPORT_BATCH_SIZE], priority)
+        if queued:
+            logger.info(f"Download queued for {queued} videos (priority {priority})")
+        return queued
+
+    def cancel_download(self, video_id):
+        cancelled = self.queue.cancel(video_id)
+        with self.lock:
+            entry = self.active_downloads.get(video_id)
+        if entry is not None:
+            entry['cancel_event'].set()
+        # A worker in another process notices at its next heartbeat.
+        scheduler.cancel(video_id)
+        Video.set_status(video_id, 'pending', only_from=('downloading',))
+        return bool(cancelled or entry)
+
     def get_download_status(self, video_id):
         try:
             video = Video.objects.get(id=video_id)
-            if video_id in self.active_downloads:
-                thread_info = self.active_downloads[video_id]
-                if thread_info['thread'].is_alive():
-                    return {
-                        'status': 'downloading',
-                        'thread_alive': True,
-                        'started_at': thread_info['started_at'],
-                        'duration': time.time() - thread_info['started_at']
-                    }
-            
-            return {
-                'status': video.status,
-                'thread_alive': False,
-                'file_exists': bool(video.video_file and video.video_file.path)
-            }
-            
+            return self._status_info(video, self.queue.latest_job(video_id))
         except Exception as e:
             logger.error(f"Error checking download status: {e}")
             return {'status': 'error', 'error': str(e)}
+
+    def status_snapshot(self, videos) -> dict:
+        """
+        get_download_status for a page of already loaded videos: one query for
+        the active jobs of all of them, progress and transcode state from memory.
+        """
+        downloading = [video for video in videos if video.status == 'downloading']
+        if not downloading:
+            return {}
+        jobs = {}
+        active = DownloadJob.objects.filter(
+            video_id__in=[video.pk for video in downloading],
+            status__in=DownloadJob.ACTIVE_STATUSES,
+        ).order_by('created_at')
+        for job in active:
+            jobs[job.video_id] = job  # Latest one wins
+        return {video.pk: self._status_info(video, jobs.get(video.pk)) for video in downloading}
+
+    def _status_info(self, video, job):
+        if job and job.status in DownloadJob.ACTIVE_STATUSES:
+            info = {
+                'status': video.status,
+                'job_status': job.status,
+                'job_alive': job.is_alive,
+                'priority': job.priority,
+                'attempts': job.attempts,
+                'worker': job.lease_owner,
+                'progress': progress.snapshot(video),
+                'transcode': scheduler.status(video.id),
+            }
+            if job.started_at:
+                info['started_at'] = job.started_at.timestamp()
+                info['duration'] = time.time() - job.started_at.timestamp()
+            return info
         
-    def _convert_to_mp4(self, input_path: str):
+        return {
+            'status': video.status,
+            'job_status': job.status if job else None,
+            'job_alive': False,
+            'file_exists': bool(video.video_file and video.video_file.path)
+        }
+
+    def _run_job(self, job, cancel_event):
+        with self.lock:
+            self.active_downloads[job.video_id] = {
+                'job_id': job.pk,
+                'started_at': time.time(),
+                'video': job.video,
+                'cancel_event': cancel_event,
+            }
+        try:
+            progress.start(job.video_id)
+            with governor.download(job.video_id):
+                return self._download_thread(job.video, cancel_event, priority=job.priority)
+        finally:
+            progress.finish(job.video_id)
+            with self.lock:
+                self.active_downloads.pop(job.video_id, None)
+        
+    def _convert_to_mp4(self, input_path: str, video_id=None, mode=TRANSCODE, media_info=None,
+                        priority=DownloadJob.PRIORITY_NORMAL, cancel_event=None):
         try:
             output_path = os.path.splitext(input_path)[0] + ".mp4"
-            logger.info(f"Converting {input_path} to {output_path}...")
+            if output_path == input_path:
+                output_path = os.path.splitext(input_path)[0] + ".converted.mp4"
+            # Write a fragmented MP4 first so it can be watched while it's being written.
+            fragmented = settings.PROGRESSIVE_STREAMING and video_id is not None
+            target_path = os.path.splitext(output_path)[0] + ".progressive.mp4" if fragmented else output_path
+            logger.info(f"Converting ({mode}) {input_path} to {target_path}...")
             
             command = [
                 'ffmpeg', '-y',
+                '-nostats', '-progress', 'pipe:1',
                 '-i', input_path,
-                '-c:v', 'libx264',
-                '-c:a', 'aac',
-                '-movflags', '+faststart',
-                output_path
+                *conversion_args(mode, media_info, fragmented=fragmented),
+                target_path
             ]
             
-            process = subprocess.run(
-                command, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE,
-                check=True
+            def on_stdout(line):
+                key, _, value = line.strip().partition('=')
+                if key == 'out_time_us' and value.isdigit():
+                    progress.transcode(video_id, seconds=int(value) / 1_000_000)
+                elif key == 'speed':
+                    progress.transcode(video_id, speed=value)
+                elif key == 'progress' and fragmented and os.path.exists(target_path):
+                    progress.publish_stream(video_id, target_path, os.path.getsize(target_path))
+
+            def on_stderr(line):
+                match = FFMPEG_DURATION_RE.search(line)
+                if match:
+                    hours, minutes, seconds = match.groups()
+                    progress.transcode(video_id, duration=int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+
+            job = scheduler.run(
+                video_id or input_path, command,
+                priority=priority,
+                on_stdout=on_stdout,
+                on_stderr=on_stderr,
+                cancel_event=cancel_event,
             )
+            if job.returncode != 0:
+                raise subprocess.CalledProcessError(job.returncode, command, stderr=job.stderr)
+
+            if fragmented and os.path.exists(target_path):
+                size = os.path.getsize(target_path)
+                progress.publish_stream(video_id, target_path, size, size)
+                return self._faststart(target_path, output_path, video_id, priority, cancel_event)
             
             if os.path.exists(output_path):
                 return output_path
             return None
             
+        except TranscodeCancelled:
+            raise
         except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg conversion failed: {e.stderr.decode()}")
+            logger.error(f"FFmpeg conversion failed: {e.stderr}")
             return None
         except Exception as e:
             logger.error(f"Conversion error: {e}")
             return None
-    
-    def _download_thread(self, video_instance):
+
+    def _faststart(self, fragmented_path, output_path, video_id, priority, cancel_event=None):
+        """
+        Rewrite a fragmented MP4 as a regular one with the index up front
+        (stream copy, no re-encoding), which is what the TV seeks best in.
+        Keeps the fragmented file if that fails, it plays too.
+        """
+        command = [
+            'ffmpeg', '-y',
+            '-i', fragmented_path,
+            '-c', 'copy', '-movflags', '+faststart',
+            output_path
+        ]
+        job = scheduler.run(video_id, command, priority=priority, cancel_event=cancel_event, kind='faststart')
+        if job.returncode != 0 or not os.path.exists(output_path):
+            logger.warning(f"Faststart remux failed, keeping fragmented MP4: {job.stderr}")
+            return fragmented_path
+
+        size = os.path.getsize(output_path)
+        progress.publish_stream(video_id, output_path, size, size)
+        os.remove(fragmented_path)
+        return output_path
+
+    def _package_hls(self, video, media_info, priority=DownloadJob.PRIORITY_NORMAL, cancel_event=None):
+        # The MP4 is already playable; a failure here only means no HLS ladder.
+        progress.set_stage(video.id, 'packaging')
+        try:
+            renditions = package_hls(video.id, video.get_absolute_path(), media_info,
+                                     priority=priority, cancel_event=cancel_event)
+            Video.objects.filter(pk=video.pk).update(hls_renditions=renditions)
+            logger.info(f"HLS ready for {video.title}: {', '.join(r['name'] for r in renditions)}")
+        except Exception as e:
+            logger.error(f"HLS packaging failed for {video.title}: {e!r}")
+        finally:
+            progress.set_stage(video.id, 'completed')
+
+    def _adopt_stored_file(self, video, original, host, priority=DownloadJob.PRIORITY_NORMAL, cancel_event=None):
+        """Complete ``video`` with the file already stored for ``original`` instead of a copy of its own."""
+        with transaction.atomic():
+            original = Video.objects.select_for_update().filter(pk=original.pk, status='completed').first()
+            if original is None or not original.video_file:
+                return False  # Evicted or deleted in the meantime
+            share_stored_file(video.video_file, original.video_file)
+            video.file_size = original.file_size
+            video.duration = original.duration
+            video.media_info = original.media_info
+            video.conversion_mode = original.conversion_mode
+            video.source_checksum = original.source_checksum
+            video.status = 'completed'
+            video.progress_stage = 'completed'
+            video.save(update_fields=DOWNLOAD_FIELDS)
+        remove_staging_dir(video.id)
+
+        metrics.downloads.inc(host=host, result='deduplicated')
+        logger.info(f"{video.title} is the same as {original.title}, sharing its file {original.video_file.name}")
+        try:
+            extract_metadata(video)
+        except Exception as e:
+            logger.error(f"Metadata extraction failed for {video.title}: {e}")
+        if original.hls_renditions and share_hls(original.id, video.id):
+            Video.objects.filter(pk=video.pk).update(hls_renditions=original.hls_renditions)
+        elif settings.HLS_ENABLED:
+            self._package_hls(video, video.media_info or None, priority=priority, cancel_event=cancel_event)
+        return True
+
+    def _segmented_download(self, url, temp_path, cancel_event=None, on_bytes=None, on_size=None, on_written=None):
+        part_path = temp_path + '.part'
+        downloader = SegmentedDownloader(
+            url, part_path,
+            segments=settings.DOWNLOAD_SEGMENTS,
+            min_segment_size=settings.DOWNLOAD_SEGMENT_MIN_SIZE,
+            max_retries=settings.DOWNLOAD_SEGMENT_RETRIES,
+            cancel_event=cancel_event,
+            on_bytes=on_bytes,
+            on_size=on_size,
+            on_contiguous=(lambda available: on_written(part_path, available, downloader.ranges[-1][1] + 1))
+            if on_written else None,
+        )
+        try:
+            size = downloader.run()
+        except (RangesNotSupported, requests.exceptions.RequestException) as e:
+            if cancel_event is not None and cancel_event.is_set():
+                raise
+            logger.info(f"Segmented download not possible ({e}), falling back to a single stream")
+            remove_partial(part_path)
+            return False
+        # Otherwise (cancelled, lease lost, worker stopped) the part file and its
+        # saved positions stay, and the next attempt resumes them.
+
+        os.replace(part_path, temp_path)
+        if on_written is not None:
+            on_written(temp_path, size, size)
+        return True
+
+    def _download_thread(self, video_instance, cancel_event=None, priority=DownloadJob.PRIORITY_NORMAL):
         max_retries = 10
         mode = 'wb'
         headers = {}
+        host = urlparse(video_instance.download_url).hostname or 'unknown'
         
         try:
             logger.info(f"=== DOWNLOAD STARTED: {video_instance.title} ===")
             logger.info(f"URL: {video_instance.download_url}")
             
-            with transaction.atomic():
-                video = Video.objects.select_for_update().get(pk=video_instance.pk)
-                if video.status == 'completed':
-                    return
-                video.status = 'downloading'
-                video.save()
+            video = Video.objects.get(pk=video_instance.pk)
+            if video.status == 'completed':
+                return True
+            if settings.DOWNLOAD_DEDUPE:
+                # The same link was already downloaded for another video.
+                original = stored_original(video)
+                if original is not None and self._adopt_stored_file(video, original, host, priority, cancel_event):
+                    return True
+            quota.preflight(video)
             
             logger.info(f"Starting download: {video.title}")
             
@@ -129,14 +327,53 @@ class VideoDownloadManager:
             if not filename:
                 filename = f"video_{video.id}.mp4"
             
-            temp_path = f"/tmp/{filename}"
-            
+            temp_path = os.path.join(staging_dir(video.id), filename)
+
+            transfer = {'bytes': 0, 'started': time.monotonic()}
+
+            def on_bytes(amount):
+                governor.consume(video.id, amount)
+                progress.advance(video.id, amount)
+                transfer['bytes'] += amount
+                metrics.download_bytes.inc(amount, host=host)
+
+            playable = {}
+            playable_lock = threading.Lock()
+
+            def on_written(path, available, size=0):
+                # Offer the file for watching while downloading, once its first
+                # bytes show it will play as is (e.g. MP4 with the index up front).
+                # Segment threads call this concurrently: probe once, never go backwards.
+                if not settings.PROGRESSIVE_STREAMING:
+                    return
+                with playable_lock:
+                    if 'keep' not in playable:
+                        if available < min(settings.PROGRESSIVE_PROBE_BYTES, size or settings.PROGRESSIVE_PROBE_BYTES):
+                            return
+                        info = probe(path)
+                        playable['keep'] = info is not None and plan_conversion(temp_path, info) == KEEP
+                    if not playable['keep'] or playable.get('published') == path and available < playable['available']:
+                        return
+                    playable['published'], playable['available'] = path, available
+                    progress.publish_stream(video.id, path, available, size)
+
+            if not os.path.exists(temp_path) and settings.DOWNLOAD_SEGMENTS > 1:
+                if not self._segmented_download(video.download_url, temp_path, cancel_event, on_bytes=on_bytes,
+                                                on_size=lambda size: progress.set_expected(video.id, size),
+                                                on_written=on_written):
+                    progress.clear_stream(video.id)
+
+            downloaded_size = 0
+            hasher = hashlib.sha256()
             if os.path.exists(temp_path):
                 downloaded_size = os.path.getsize(temp_path)
                 if downloaded_size > 0:
                     headers['Range'] = f'bytes={downloaded_size}-'
                     mode = 'ab'
                     logger.info(f"Resuming download from {downloaded_size} bytes")
+                    # Bytes already on disk (resumed or fetched in segments)
+                    file_sha256(temp_path, hasher)
+            progress.reset(video.id, downloaded_size)
             
             retries = 0
             while retries < max_retries:
@@ -149,29 +386,68 @@ class VideoDownloadManager:
                             logger.warning("Server doesn't support resume, restarting download")
                             mode = 'wb'
                             headers = {}
+                            downloaded_size = 0
+                            hasher = hashlib.sha256()
+                            progress.reset(video.id, 0)
                         
                         response.raise_for_status()
+                        content_length = int(response.headers.get('Content-Length') or 0)
+                        expected_size = downloaded_size + content_length if content_length else 0
+                        if expected_size:
+                            progress.set_expected(video.id, expected_size)
                         
-                        with open(temp_path, mode) as f:
+                        with open(temp_path, mode) as raw_file:
+                            f = HashingWriter(raw_file, hasher)
+                            written = published = downloaded_size
                             for chunk in response.iter_content(chunk_size=8192):
+                                if cancel_event is not None and cancel_event.is_set():
+                                    raise Exception("Download cancelled")
                                 if chunk:
                                     f.write(chunk)
+                                    on_bytes(len(chunk))
+                                    written += len(chunk)
+                                    if written - published >= PROGRESSIVE_PUBLISH_BYTES or written == expected_size:
+                                        # Readers open the file themselves; make the bytes visible first.
+                                        raw_file.flush()
+                                        on_written(temp_path, written, expected_size)
+                                        published = written
                         break
                 
                 except (requests.exceptions.RequestException, requests.exceptions.Timeout) as e:
                     retries += 1
+                    metrics.download_retries.inc(host=host, kind='stream')
                     logger.warning(f"Network error: {e}. Retrying ({retries}/{max_retries})...")
                     time.sleep(2 * retries)
                     if os.path.exists(temp_path):
                         downloaded_size = os.path.getsize(temp_path)
                         headers['Range'] = f'bytes={downloaded_size}-'
                         mode = 'ab'
+                        progress.reset(video.id, downloaded_size)
             
+            transfer_seconds = time.monotonic() - transfer['started']
             if os.path.exists(temp_path):
+                if transfer['bytes'] and transfer_seconds > 0:
+                    metrics.download_throughput.observe(transfer['bytes'] / transfer_seconds, host=host)
+                video.source_checksum = hasher.hexdigest()
+                if settings.DOWNLOAD_DEDUPE:
+                    # Another mirror of something already stored: no conversion, no second file.
+                    original = stored_original(video)
+                    if original is not None and self._adopt_stored_file(video, original, host, priority, cancel_event):
+                        return True
                 final_path = temp_path
-                file_ext = os.path.splitext(temp_path)[1].lower()
-                if file_ext not in ['.mp4', '.webm', '.avi']:
-                    converted_path = self._convert_to_mp4(temp_path)
+                progress.set_stage(video.id, 'probing')
+                media_info = probe(temp_path)
+                conversion = plan_conversion(temp_path, media_info)
+                if media_info is not None:
+                    video.media_info = summarize(media_info)
+                    video.duration = int(video.media_info['duration'])
+                video.conversion_mode = conversion
+                logger.info(f"Conversion plan for {video.title}: {conversion}")
+
+                if conversion != KEEP:
+                    progress.set_stage(video.id, 'converting')
+                    converted_path = self._convert_to_mp4(temp_path, video.id, conversion, media_info,
+                                                          priority=priority, cancel_event=cancel_event)
                     if converted_path and os.path.exists(converted_path):
                         final_path = converted_path
                         filename = os.path.splitext(filename)[0] + ".mp4"
@@ -179,16 +455,24 @@ class VideoDownloadManager:
                             os.remove(temp_path)
                 
                 if os.path.exists(final_path):
-                    with open(final_path, 'rb') as f:
-                        video.video_file.save(filename, File(f))
-                    
+                    progress.set_stage(video.id, 'saving')
                     video.file_size = os.path.getsize(final_path)
+                    commit_to_storage(video.video_file, final_path, filename)
+                    
                     video.status = 'completed'
-                    video.save()
-                    if os.path.exists(final_path):
-                        os.remove(final_path)
+                    video.progress_stage = 'completed'
+                    video.save(update_fields=DOWNLOAD_FIELDS)
+                    remove_staging_dir(video.id)
                     
+                    metrics.downloads.inc(host=host, result='completed')
                     logger.info(f"Download completed: {video.title} ({video.file_size_human})")
+                    try:
+                        extract_metadata(video)
+                    except Exception as e:
+                        logger.error(f"Metadata extraction failed for {video.title}: {e}")
+                    if settings.HLS_ENABLED:
+                        self._package_hls(video, media_info, priority=priority, cancel_event=cancel_event)
+                    return True
                 else:
                     raise Exception("Final file not found after conversion")
             else:
@@ -196,19 +480,21 @@ class VideoDownloadManager:
 
                 
         except Exception as e:
+            if cancel_event is not None and cancel_event.is_set():
+                # The job now belongs to someone else; leave the video alone.
+                metrics.downloads.inc(host=host, result='cancelled')
+                logger.warning(f"Download stopped for {video_instance.title}: {e}")
+                return False
+            metrics.downloads.inc(host=host, result='error')
             logger.error(f"Download failed for {video_instance.title}: {e}")
             try:
                 with transaction.atomic():
                     video = Video.objects.select_for_update().get(pk=video_instance.pk)
                     video.status = 'error'
                     video.error_message = str(e)
-                    video.save()
+                    video.save(update_fields=['status', 'error_message'])
             except Exception as db_error:
                 logger.error(f"Failed to update video status: {db_error}")
-        
-        finally:
-            with self.lock:
-                if video_instance.id in self.active_downloads:
-                    del self.active_downloads[video_instance.id]
+            return False
 
 video_manager = VideoDownloadManager()
\ No newline at end of file
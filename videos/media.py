@@ -0,0 +1,119 @@
+import os
+import json
+import logging
+import subprocess
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# What the conversion step has to do with a downloaded file.
+KEEP = 'keep'            # already plays on the TV as is
+REMUX = 'remux'          # streams are fine, only the container changes
+AUDIO = 'audio'          # copy video, re-encode audio
+TRANSCODE = 'transcode'  # re-encode video (and audio if needed)
+
+
+def probe(path: str) -> dict | None:
+    """Run ffprobe and return its JSON (format + streams), or None if it fails."""
+    command = [
+        'ffprobe', '-v', 'error',
+        '-print_format', 'json',
+        '-show_format', '-show_streams',
+        path,
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=120)
+        return json.loads(result.stdout)
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logger.warning(f"ffprobe failed for {path}: {e}")
+        return None
+
+
+def first_stream(info: dict, codec_type: str) -> dict | None:
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == codec_type and not stream.get('disposition', {}).get('attached_pic'):
+            return stream
+    return None
+
+
+def summarize(info: dict) -> dict:
+    """The parts of a probe worth keeping on the Video row."""
+    video = first_stream(info, 'video') or {}
+    audio = first_stream(info, 'audio') or {}
+    fmt = info.get('format', {})
+    try:
+        duration = float(fmt.get('duration') or video.get('duration') or 0)
+    except ValueError:
+        duration = 0.0
+    return {
+        'container': fmt.get('format_name', ''),
+        'duration': duration,
+        'bit_rate': int(fmt.get('bit_rate') or 0),
+        'video_codec': video.get('codec_name', ''),
+        'video_profile': video.get('profile', ''),
+        'video_level': video.get('level'),
+        'pix_fmt': video.get('pix_fmt', ''),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'audio_codec': audio.get('codec_name', ''),
+        'audio_channels': audio.get('channels'),
+    }
+
+
+def video_compatible(summary: dict) -> bool:
+    if summary['video_codec'] not in settings.ANDROID_VIDEO_CODECS:
+        return False
+    if summary['video_codec'] == 'h264':
+        if summary['video_profile'] not in settings.ANDROID_H264_PROFILES:
+            return False
+        level = summary['video_level']
+        if level is not None and level > settings.ANDROID_H264_MAX_LEVEL:
+            return False
+    return summary['pix_fmt'] in settings.ANDROID_PIX_FMTS
+
+
+def audio_compatible(summary: dict) -> bool:
+    # A silent video needs no audio work.
+    return not summary['audio_codec'] or summary['audio_codec'] in settings.ANDROID_AUDIO_CODECS
+
+
+def plan_conversion(path: str, info: dict | None) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if info is None:
+        # Couldn't probe: fall back to judging by the extension.
+        return KEEP if ext in ['.mp4', '.webm', '.avi'] else TRANSCODE
+
+    summary = summarize(info)
+    if ext == '.webm' and summary['video_codec'] in settings.ANDROID_WEBM_VIDEO_CODECS:
+        return KEEP
+    if not summary['video_codec']:
+        return TRANSCODE
+    if not video_compatible(summary):
+        return TRANSCODE
+    if not audio_compatible(summary):
+        return AUDIO
+    if 'mp4' in summary['container'].split(',') and ext in ['.mp4', '.m4v']:
+        return KEEP
+    return REMUX
+
+
+def conversion_args(mode: str, info: dict | None, fragmented: bool = False) -> list[str]:
+    """
+    ffmpeg codec arguments for a conversion mode (output is always MP4).
+    A fragmented MP4 can be played while ffmpeg is still writing it.
+    """
+    audio_ok = info is not None and audio_compatible(summarize(info))
+    if mode == REMUX:
+        args = ['-c:v', 'copy', '-c:a', 'copy']
+    elif mode == AUDIO:
+        args = ['-c:v', 'copy', '-c:a', 'aac']
+    else:
+        args = [
+            '-c:v', 'libx264',
+            '-profile:v', 'high', '-level', '4.1',
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'copy' if audio_ok else 'aac',
+        ]
+    # First video and audio stream only; subtitle/data streams don't fit in MP4.
+    movflags = 'frag_keyframe+empty_moov+default_base_moof' if fragmented else '+faststart'
+    return ['-map', '0:v:0', '-map', '0:a:0?'] + args + ['-movflags', movflags]
@@ -0,0 +1,112 @@
+import io
+import math
+import logging
+import subprocess
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from .models import Video
+from .media import probe, summarize
+
+logger = logging.getLogger(__name__)
+
+
+def grab_frame(path: str, seconds: float, scale: str) -> bytes | None:
+    """
+    One JPEG frame at ``seconds``. ``-ss`` goes before ``-i`` so ffmpeg seeks
+    to the nearest keyframe instead of decoding everything up to that point.
+    """
+    command = [
+        'ffmpeg', '-v', 'error',
+        '-ss', f'{seconds:.3f}',
+        '-i', path,
+        '-frames:v', '1',
+        '-vf', f'scale={scale}',
+        '-f', 'image2', '-c:v', 'mjpeg', '-q:v', '3',
+        'pipe:1',
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=60)
+        return result.stdout or None
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not grab frame at {seconds:.1f}s of {path}: {e}")
+        return None
+
+
+def make_sprite(path: str, duration: float) -> tuple[bytes, dict] | None:
+    """
+    A sheet of SPRITE_FRAMES evenly spaced thumbnails for seek previews, and
+    where each one sits on it.
+    """
+    count = settings.SPRITE_FRAMES
+    interval = duration / count
+    frames = []
+    for index in range(count):
+        # Middle of each interval, so the first frame isn't a black intro frame.
+        data = grab_frame(path, interval * (index + 0.5), f"{settings.SPRITE_FRAME_WIDTH}:-2")
+        if data is None:
+            return None
+        frames.append(Image.open(io.BytesIO(data)).convert('RGB'))
+
+    width, height = frames[0].size
+    columns = min(settings.SPRITE_COLUMNS, count)
+    rows = math.ceil(count / columns)
+    sheet = Image.new('RGB', (columns * width, rows * height))
+    for index, frame in enumerate(frames):
+        sheet.paste(frame.resize((width, height)), ((index % columns) * width, (index // columns) * height))
+
+    output = io.BytesIO()
+    sheet.save(output, format='JPEG', quality=75)
+    return output.getvalue(), {
+        'frames': count,
+        'columns': columns,
+        'rows': rows,
+        'frame_width': width,
+        'frame_height': height,
+        'interval': round(interval, 3),
+    }
+
+
+def extract_metadata(video: Video, info: dict | None = None, force: bool = False) -> bool:
+    """
+    Fill in duration/codecs, the poster thumbnail and the seek preview sprite
+    of a downloaded video. Skips what is already there unless ``force``.
+    """
+    path = video.get_absolute_path()
+    if not path:
+        return False
+
+    update_fields = []
+    if force or info is not None or not video.media_info:
+        info = info or probe(path)
+        if info is None:
+            return False
+        video.media_info = summarize(info)
+        video.duration = int(video.media_info['duration'])
+        update_fields += ['media_info', 'duration']
+
+    duration = video.media_info.get('duration') or 0
+    if duration <= 0:
+        logger.warning(f"No duration for {video.title}, skipping thumbnails")
+        if update_fields:
+            video.save(update_fields=update_fields)
+        return bool(update_fields)
+
+    if force or not video.thumbnail:
+        poster = grab_frame(path, duration * settings.POSTER_POSITION, f"-2:{settings.POSTER_HEIGHT}")
+        if poster is not None:
+            video.delete_thumbnail_file()
+            video.thumbnail.save(f'{video.id}.jpg', ContentFile(poster), save=False)
+            update_fields.append('thumbnail')
+
+    if force or not video.sprite:
+        sprite = make_sprite(path, duration)
+        if sprite is not None:
+            data, video.sprite_info = sprite
+            video.delete_sprite_file()
+            video.sprite.save(f'{video.id}.jpg', ContentFile(data), save=False)
+            update_fields += ['sprite', 'sprite_info']
+
+    if update_fields:
+        video.save(update_fields=update_fields)
+    return bool(update_fields)
@@ -0,0 +1,243 @@
+"""
+In-process counters, gauges and histograms, rendered in the Prometheus text
+format at /metrics. Each metric has its own lock and holds it only to bump a
+number, so they can be updated from the async views and the download and
+transcode threads alike. Values are per process.
+"""
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from django.db import OperationalError, close_old_connections
+from django.dispatch import receiver
+from django.db.backends.signals import connection_created
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+RATE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return '+Inf' if value == float('inf') else repr(value)
+    return str(value)
+
+
+def format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.register(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f'{self.name}{format_labels(self.labels, key)} {format_value(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down; with ``collect`` it is read fresh on every scrape instead."""
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.collect is not None:
+            # collect() returns {label values: value}, or a bare number without labels.
+            values = self.collect()
+            with self.lock:
+                self.values = values if isinstance(values, dict) else {(): values}
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per bucket (not cumulative) counts, plus one for +Inf, then sum and count.
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = format_labels(self.labels, key, f'le="{format_value(float(bound))}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {count}'
+
+
+def client_stream_rates() -> dict:
+    from .pacing import stream_scheduler
+    return {(client,): entry['rate'] for client, entry in stream_scheduler.snapshot().items()}
+
+
+def download_jobs_by_status() -> dict:
+    from django.db.models import Count
+    from .models import DownloadJob
+
+    counts = {(status,): 0 for status in DownloadJob.ACTIVE_STATUSES}
+    for row in DownloadJob.objects.filter(status__in=DownloadJob.ACTIVE_STATUSES).values('status').annotate(n=Count('id')):
+        counts[(row['status'],)] = row['n']
+    return counts
+
+
+def transcode_queue_length() -> int:
+    from .transcoder import scheduler
+    return scheduler.queue_length()
+
+
+active_streams = Gauge('streamer_active_streams', "Responses currently sending video or images", ['mode'])
+stream_bytes = Counter('streamer_stream_bytes_total', "Bytes of files sent to clients", ['mode'])
+stream_requests = Counter('streamer_stream_requests_total', "File requests by how they were answered",
+                          ['source', 'kind'])
+client_stream_rate = Gauge('streamer_client_stream_rate_bytes_per_second', "Rate each client is being sent at",
+                           ['client'], collect=client_stream_rates)
+stream_ttfb = Histogram('streamer_stream_ttfb_seconds', "Time from request to the first byte of the file", ['mode'])
+
+download_bytes = Counter('streamer_download_bytes_total', "Bytes downloaded from origins", ['host'])
+download_retries = Counter('streamer_download_retries_total', "Download requests retried after an error",
+                           ['host', 'kind'])
+downloads = Counter('streamer_downloads_total', "Finished download attempts", ['host', 'result'])
+download_throughput = Histogram('streamer_download_throughput_bytes_per_second',
+                                "Average transfer rate of each finished download", ['host'], buckets=RATE_BUCKETS)
+download_jobs = Gauge('streamer_download_jobs', "Download jobs waiting or running", ['status'],
+                      collect=download_jobs_by_status)
+
+transcode_queue = Gauge('streamer_transcode_queue_depth', "ffmpeg jobs waiting for a transcode slot",
+                        collect=transcode_queue_length)
+ffmpeg_jobs = Counter('streamer_ffmpeg_jobs_total', "ffmpeg jobs run", ['kind', 'result'])
+ffmpeg_wall_seconds = Histogram('streamer_ffmpeg_wall_seconds', "Wall time of each ffmpeg job", ['kind'],
+                                buckets=JOB_BUCKETS)
+ffmpeg_cpu_seconds = Histogram('streamer_ffmpeg_cpu_seconds', "User + system CPU time of each ffmpeg job", ['kind'],
+                               buckets=JOB_BUCKETS)
+
+db_write_seconds = Histogram('streamer_db_write_seconds',
+                             "Time spent in INSERT/UPDATE/DELETE statements, mostly waiting for the write lock")
+db_lock_errors = Counter('streamer_db_lock_errors_total', "Statements that gave up with 'database is locked'")
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+
+
+def time_writes(execute, sql, params, many, context):
+    if sql.lstrip()[:6].upper() not in WRITE_STATEMENTS:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    except OperationalError as e:
+        if 'locked' in str(e):
+            db_lock_errors.inc()
+        raise
+    finally:
+        db_write_seconds.observe(time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def install_db_timing(sender, connection, **kwargs):
+    # Fired again on every reconnect of the same wrapper.
+    if time_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_writes)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        try:
+            body = registry.render().encode()
+        finally:
+            close_old_connections()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port: int, address: str = '') -> ThreadingHTTPServer:
+    """Serve /metrics for a process without the web app, e.g. a download worker."""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -1,9 +1,15 @@
 import os
 import uuid
+import shutil
 import logging
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Sum, Count
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
 from django.core.files.storage import FileSystemStorage
+from .dedupe import normalize_url
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +30,7 @@ class Video(models.Model):
     title = models.CharField(max_length=200)
     description = models.TextField(blank=True)
     download_url = models.URLField(max_length=1000)
+    normalized_url = models.CharField(max_length=1000, blank=True, db_index=True)  # see dedupe.normalize_url
     video_file = models.FileField(
         upload_to='videos/',
         storage=VideoStorage(),
@@ -36,18 +43,46 @@ class Video(models.Model):
         null=True,
         blank=True
     )
+    sprite = models.ImageField(  # seek preview sheet, laid out as described by sprite_info
+        upload_to='sprites/',
+        storage=VideoStorage(),
+        null=True,
+        blank=True
+    )
+    sprite_info = models.JSONField(default=dict, blank=True)
     
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     file_size = models.BigIntegerField(default=0)  # in bytes
     duration = models.IntegerField(default=0)  # in seconds
     error_message = models.TextField(blank=True)
+    source_checksum = models.CharField(max_length=64, blank=True, db_index=True)  # sha256 of the downloaded bytes
+    media_info = models.JSONField(default=dict, blank=True)  # ffprobe summary of the download
+    conversion_mode = models.CharField(max_length=20, blank=True)  # keep / remux / audio / transcode
+    hls_renditions = models.JSONField(default=list, blank=True)  # packaged HLS ladder, see hls.py
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # Last progress flushed by the download worker (see progress.py)
+    progress_stage = models.CharField(max_length=20, blank=True)
+    downloaded_bytes = models.BigIntegerField(default=0)
+    expected_size = models.BigIntegerField(default=0)
+    transcode_percent = models.FloatField(default=0)
+    progress_updated_at = models.DateTimeField(null=True, blank=True)
+    # File that can be streamed while it's still being written (see progress.py)
+    progressive_path = models.CharField(max_length=1000, blank=True)
+    progressive_bytes = models.BigIntegerField(default=0)  # written so far, from the start
+    progressive_size = models.BigIntegerField(default=0)  # final size, 0 if not known yet
+    # Playback, flushed now and then from stream_video (see playback.py); the
+    # quota manager evicts the least recently watched files first, never pinned ones.
+    last_played_at = models.DateTimeField(null=True, blank=True)
+    bytes_served = models.BigIntegerField(default=0)
+    pinned = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['-created_at', '-id']),  # keyset pagination of the list page
         ]
     
     def __str__(self):
@@ -65,6 +100,10 @@ class Video(models.Model):
     
     def delete_video_file(self):
         if self.video_file:
+            if Video.objects.filter(video_file=self.video_file.name).exclude(pk=self.pk).exists():
+                # Shared with a duplicate (see dedupe.py); the last one to go removes it.
+                logger.info(f"Kept video file still used by another video: {self.video_file.name}")
+                return True
             try:
                 file_path = self.get_absolute_path()
                 if os.path.exists(file_path):
@@ -87,15 +126,74 @@ class Video(models.Model):
                 logger.error(f"Error deleting thumbnail: {e}")
         return False
     
+    def delete_sprite_file(self):
+        if self.sprite:
+            try:
+                sprite_path = os.path.join(settings.STORAGE_SERVER_PATH, self.sprite.name)
+                if os.path.exists(sprite_path):
+                    os.remove(sprite_path)
+                    logger.info(f"Deleted sprite: {sprite_path}")
+                    return True
+            except Exception as e:
+                logger.error(f"Error deleting sprite: {e}")
+        return False
+    
+    def delete_hls_files(self):
+        hls_path = os.path.join(settings.HLS_ROOT, str(self.id))
+        if os.path.isdir(hls_path):
+            try:
+                shutil.rmtree(hls_path)
+                logger.info(f"Deleted HLS renditions: {hls_path}")
+                return True
+            except Exception as e:
+                logger.error(f"Error deleting HLS renditions: {e}")
+        return False
+    
     def save(self, *args, **kwargs):
         if not self.title and self.download_url:
             self.title = os.path.basename(self.download_url)
+        self.normalized_url = normalize_url(self.download_url)
         
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'status', 'file_size'} & set(update_fields):
+            super().save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            old = None
+            if not self._state.adding:
+                old = Video.objects.filter(pk=self.pk).values('status', 'file_size').first()
+            super().save(*args, **kwargs)
+            if old is not None:
+                LibraryStats.move(old['status'], old['file_size'], self.status, self.file_size)
+            else:
+                LibraryStats.add(self.status, 1, self.file_size)
+    
+    @classmethod
+    def set_status(cls, pk, status: str, only_from=None, exclude=()) -> bool:
+        """
+        Change one video's status with an UPDATE (no full save), keeping
+        LibraryStats in step. Only from a status in ``only_from`` if given,
+        never from one in ``exclude``. True if the video now has ``status``.
+        """
+        with transaction.atomic():
+            row = cls.objects.filter(pk=pk).values('status', 'file_size').first()
+            if row is None or row['status'] in exclude:
+                return False
+            if row['status'] == status:
+                return True
+            if only_from is not None and row['status'] not in only_from:
+                return False
+            # Conditional on the status we read, in case another process got there first.
+            if not cls.objects.filter(pk=pk, status=row['status']).update(status=status):
+                return False
+            LibraryStats.move(row['status'], row['file_size'], status, row['file_size'])
+            return True
     
     def delete(self, using=None, keep_parents=False):
         self.delete_video_file()
         self.delete_thumbnail_file()
+        self.delete_sprite_file()
+        self.delete_hls_files()
         super().delete(using=using, keep_parents=keep_parents)
     
     @property
@@ -124,4 +222,123 @@ class Video(models.Model):
         elif minutes > 0:
             return f"{minutes}m {seconds}s"
         else:
-            return f"{seconds}s"
\ No newline at end of file
+            return f"{seconds}s"
+
+    @property
+    def byte_rate(self) -> int:
+        """Average bytes per second of the stored file, 0 if unknown."""
+        if self.duration and self.file_size:
+            return self.file_size // self.duration
+        return (self.media_info or {}).get('bit_rate', 0) // 8
+
+
+@receiver(post_delete, sender=Video)
+def remove_from_library_stats(sender, instance, **kwargs):
+    # Signal rather than Video.delete(), so queryset (admin bulk) deletes count too.
+    LibraryStats.add(instance.status, -1, -instance.file_size)
+
+
+class LibraryStats(models.Model):
+    """
+    Number of videos and their total size per status, adjusted in the same
+    transaction as every change to a video, so the list page reads totals
+    from a handful of rows instead of aggregating the whole table.
+    ``manage.py reconcile_stats`` rebuilds it from scratch.
+    """
+    status = models.CharField(max_length=20, unique=True)
+    videos = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.status}: {self.videos} videos, {self.total_size} bytes"
+
+    @classmethod
+    def add(cls, status: str, videos: int = 0, size: int = 0):
+        if not videos and not size:
+            return
+        with transaction.atomic():
+            cls.objects.get_or_create(status=status)
+            cls.objects.filter(status=status).update(
+                videos=F('videos') + videos,
+                total_size=F('total_size') + (size or 0),
+            )
+
+    @classmethod
+    def move(cls, old_status: str, old_size: int, new_status: str, new_size: int):
+        if old_status == new_status:
+            cls.add(new_status, 0, (new_size or 0) - (old_size or 0))
+            return
+        with transaction.atomic():
+            cls.add(old_status, -1, -(old_size or 0))
+            cls.add(new_status, 1, new_size or 0)
+
+    @classmethod
+    def rebuild(cls):
+        with transaction.atomic():
+            cls.objects.all().delete()
+            rows = Video.objects.order_by().values('status').annotate(videos=Count('pk'), total_size=Sum('file_size'))
+            cls.objects.bulk_create([
+                cls(status=row['status'], videos=row['videos'], total_size=row['total_size'] or 0)
+                for row in rows
+            ])
+
+    @classmethod
+    def totals(cls) -> dict:
+        rows = list(cls.objects.all())
+        if not rows and Video.objects.exists():
+            # Library from before the stats table existed.
+            cls.rebuild()
+            rows = list(cls.objects.all())
+        by_status = {row.status: {'videos': row.videos, 'total_size': row.total_size} for row in rows}
+        return {
+            'total_videos': sum(row.videos for row in rows),
+            'completed_videos': by_status.get('completed', {}).get('videos', 0),
+            'total_size': sum(row.total_size for row in rows),
+            'by_status': by_status,
+        }
+
+
+class DownloadJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    PRIORITY_NORMAL = 0
+    PRIORITY_USER = 10
+
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='download_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    priority = models.IntegerField(default=PRIORITY_NORMAL)
+    attempts = models.IntegerField(default=0)
+    lease_owner = models.CharField(max_length=200, blank=True)
+    lease_token = models.UUIDField(null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-priority', 'created_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'created_at']),
+            models.Index(fields=['video', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.video_id} ({self.get_status_display()})"
+
+    @property
+    def is_alive(self):
+        """Queued jobs are waiting; running jobs are alive while their lease is."""
+        if self.status == 'queued':
+            return True
+        if self.status == 'running' and self.lease_expires_at:
+            return self.lease_expires_at > timezone.now()
+        return False
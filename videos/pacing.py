@@ -0,0 +1,193 @@
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from django.conf import settings
+from .bandwidth import RateMeter
+
+PLAYBACK = 'playback'
+DOWNLOAD = 'download'
+# Bursts allowed on top of a paced stream's rate, in seconds of that rate.
+BURST_SECONDS = 1.0
+# Longest single wait before a paced stream looks at its rate again.
+MAX_SLEEP_SECONDS = 1.0
+
+
+class StreamTicket:
+    """
+    One outgoing stream. Call ``sent`` after every chunk; it sleeps as long as
+    the stream is ahead of the rate the scheduler gave it.
+    """
+    def __init__(self, scheduler, client: str, kind: str, byte_rate: int):
+        self.scheduler = scheduler
+        self.client = client
+        self.kind = kind
+        self.byte_rate = byte_rate
+        self.sent_bytes = 0
+        self.paced = False
+        self.rate = 0  # bytes/s, 0 = not limited
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.meter = RateMeter()
+
+    async def sent(self, amount: int):
+        self.sent_bytes += amount
+        self.meter.add(amount)
+        if (not self.paced and self.kind == PLAYBACK and self.byte_rate
+                and self.sent_bytes >= self.byte_rate * settings.STREAM_PACING_READAHEAD_SECONDS):
+            # The player has a good buffer now; from here on it only needs to keep up.
+            self.paced = True
+            self.scheduler.rebalance()
+
+        self._refill()
+        if not self.rate:
+            return
+        self.tokens -= amount
+        # In steps, so a rate raised by a rebalance takes effect soon; less
+        # than a byte behind counts as on time.
+        while self.tokens < -1 and self.rate:
+            await asyncio.sleep(min(-self.tokens / self.rate, MAX_SLEEP_SECONDS))
+            self._refill()
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.rate
+        if not rate:
+            self.tokens = 0.0
+        else:
+            self.tokens = min(rate * BURST_SECONDS, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+def fair_shares(capacity: float, weights: dict, caps: dict) -> dict:
+    """
+    Weighted max-min fair split of ``capacity``: nobody gets more than their
+    cap, and what capped streams leave over goes to the others by weight.
+    Weight 0 only gets what everyone else leaves over, split evenly.
+    """
+    shares = {}
+    remaining = dict(weights)
+    while remaining:
+        total = sum(remaining.values())
+        if not total:
+            remaining = dict.fromkeys(remaining, 1.0)
+            continue
+        unit = max(0.0, capacity) / total
+        capped = [key for key, weight in remaining.items() if caps[key] <= weight * unit]
+        if not capped:
+            shares.update((key, weight * unit) for key, weight in remaining.items())
+            break
+        for key in capped:
+            shares[key] = caps[key]
+            capacity -= caps[key]
+            del remaining[key]
+    return shares
+
+
+class StreamScheduler:
+    """
+    Shares the uplink between outgoing streams, per client first and then
+    per stream. Playback streams are paced to STREAM_PACING_MULTIPLE times
+    the video's bitrate once they have sent STREAM_PACING_READAHEAD_SECONDS
+    of it; ``?download`` grabs get STREAM_DOWNLOAD_WEIGHT of a client's share
+    and, while anything is playing, at most STREAM_DOWNLOAD_RATE_WHILE_PLAYING
+    between them.
+    """
+    def __init__(self):
+        self.tickets = set()
+        self.lock = threading.Lock()
+
+    @asynccontextmanager
+    async def stream(self, client: str, kind: str, byte_rate: int = 0):
+        ticket = StreamTicket(self, client, kind, byte_rate)
+        with self.lock:
+            self.tickets.add(ticket)
+        self.rebalance()
+        try:
+            yield ticket
+        finally:
+            with self.lock:
+                self.tickets.discard(ticket)
+            self.rebalance()
+
+    def may_limit(self, pacing: tuple | None) -> bool:
+        """
+        Whether a stream for ``pacing`` could be given a rate at all. Those
+        that can't are better handed to the server as a whole file.
+        """
+        if pacing is None:
+            return False
+        client, kind, byte_rate = pacing
+        if settings.STREAM_TOTAL_RATE:
+            return True
+        if kind == PLAYBACK:
+            return bool(byte_rate and settings.STREAM_PACING_MULTIPLE)
+        # A ?download is only held back while something plays; one started
+        # before that keeps going at full speed.
+        with self.lock:
+            playing = any(ticket.kind == PLAYBACK for ticket in self.tickets)
+        return playing and bool(settings.STREAM_DOWNLOAD_RATE_WHILE_PLAYING)
+
+    def caps(self, tickets) -> dict:
+        unlimited = float('inf')
+        downloads = [ticket for ticket in tickets if ticket.kind == DOWNLOAD]
+        playing = len(downloads) < len(tickets)
+        caps = {}
+        for ticket in tickets:
+            cap = unlimited
+            if ticket.paced and settings.STREAM_PACING_MULTIPLE:
+                cap = ticket.byte_rate * settings.STREAM_PACING_MULTIPLE
+            if ticket.kind == DOWNLOAD and playing and settings.STREAM_DOWNLOAD_RATE_WHILE_PLAYING:
+                cap = min(cap, settings.STREAM_DOWNLOAD_RATE_WHILE_PLAYING / len(downloads))
+            caps[ticket] = cap
+        return caps
+
+    def rebalance(self):
+        with self.lock:
+            tickets = list(self.tickets)
+        caps = self.caps(tickets)
+        if settings.STREAM_TOTAL_RATE and tickets:
+            per_client = {}
+            for ticket in tickets:
+                per_client[ticket.client] = per_client.get(ticket.client, 0) + 1
+            weights = {
+                ticket: (settings.STREAM_DOWNLOAD_WEIGHT if ticket.kind == DOWNLOAD else 1.0) / per_client[ticket.client]
+                for ticket in tickets
+            }
+            rates = fair_shares(settings.STREAM_TOTAL_RATE, weights, caps)
+        else:
+            rates = caps
+        for ticket in tickets:
+            rate = rates[ticket]
+            ticket.rate = 0 if rate == float('inf') else max(1, int(rate))
+
+    def snapshot(self) -> dict:
+        """Current rate per client, with the streams behind it."""
+        with self.lock:
+            tickets = list(self.tickets)
+        clients = {}
+        for ticket in tickets:
+            entry = clients.setdefault(ticket.client, {'rate': 0, 'streams': []})
+            rate = round(ticket.meter.rate())
+            entry['rate'] += rate
+            entry['streams'].append({
+                'kind': ticket.kind,
+                'rate': rate,
+                'limit': ticket.rate,
+                'paced': ticket.paced,
+                'sent': ticket.sent_bytes,
+            })
+        return clients
+
+
+stream_scheduler = StreamScheduler()
+
+
+@asynccontextmanager
+async def stream_ticket(pacing: tuple | None):
+    """A scheduler ticket for ``pacing`` = (client, kind, byte_rate); None for streams not scheduled."""
+    if pacing is None:
+        yield None
+        return
+    async with stream_scheduler.stream(*pacing) as ticket:
+        yield ticket
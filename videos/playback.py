@@ -0,0 +1,74 @@
+import time
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from .models import Video
+
+logger = logging.getLogger(__name__)
+
+
+class PlaybackTracker:
+    """
+    When each video was last streamed and how many bytes of it were sent,
+    added up in memory and written at most every PLAYBACK_FLUSH_SECONDS with
+    one UPDATE per video, so Range requests don't each cost a database write.
+    A background thread writes what is left when no more requests come, and
+    the rest is written at exit, so evictions in other processes don't go by
+    plays that were never saved.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._flush_loop, name='playback-flush', daemon=True)
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(settings.PLAYBACK_FLUSH_SECONDS or 1)
+            if self.pending:
+                try:
+                    self.flush()
+                finally:
+                    close_old_connections()
+
+    def played(self, video_id, amount: int = 0):
+        if self.thread is None:
+            self.start()
+        with self.lock:
+            entry = self.pending.get(video_id)
+            if entry is None:
+                entry = self.pending[video_id] = [timezone.now(), 0]
+            else:
+                entry[0] = timezone.now()
+            entry[1] += amount
+
+    def due(self) -> bool:
+        return bool(self.pending) and time.monotonic() - self.flushed_at >= settings.PLAYBACK_FLUSH_SECONDS
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+        for video_id, (played_at, amount) in pending.items():
+            try:
+                Video.objects.filter(pk=video_id).update(
+                    last_played_at=played_at,
+                    bytes_served=F('bytes_served') + amount,
+                )
+            except Exception as e:
+                logger.warning(f"Could not save playback of {video_id}: {e}")
+
+
+playback = PlaybackTracker()
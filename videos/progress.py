@@ -0,0 +1,188 @@
+import time
+import logging
+import threading
+from django.conf import settings
+from django.utils import timezone
+from .models import Video
+from .bandwidth import RateMeter
+
+logger = logging.getLogger(__name__)
+
+
+class Progress:
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.stage = 'downloading'
+        self.downloaded = 0
+        self.expected = 0
+        self.meter = RateMeter(window=10.0)
+        self.transcode_seconds = 0.0
+        self.transcode_duration = 0.0
+        self.transcode_speed = ''
+        self.stream_path = ''
+        self.stream_available = 0
+        self.stream_size = 0
+        self.flushed_at = 0.0
+
+    @property
+    def transcode_percent(self) -> float:
+        if not self.transcode_duration:
+            return 0.0
+        return min(100.0, 100.0 * self.transcode_seconds / self.transcode_duration)
+
+    def as_dict(self) -> dict:
+        rate = self.meter.rate()
+        remaining = max(0, self.expected - self.downloaded)
+        return {
+            'stage': self.stage,
+            'downloaded_bytes': self.downloaded,
+            'expected_bytes': self.expected,
+            'percent': round(100.0 * self.downloaded / self.expected, 2) if self.expected else None,
+            'throughput': round(rate),
+            'eta_seconds': round(remaining / rate) if rate and self.expected else None,
+            'transcode_percent': round(self.transcode_percent, 2),
+            'transcode_speed': self.transcode_speed,
+            'progressive': bool(self.stream_path),
+            'live': True,
+        }
+
+
+class ProgressTracker:
+    """
+    Download/transcode progress kept in memory and written to the Video row
+    at most once every PROGRESS_FLUSH_SECONDS, so SQLite isn't hit for every
+    chunk. Other processes read the flushed copy from the database.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def start(self, video_id, downloaded: int = 0, expected: int = 0):
+        entry = Progress(video_id)
+        entry.downloaded = downloaded
+        entry.expected = expected
+        with self.lock:
+            self.entries[video_id] = entry
+        self.flush(video_id, force=True)
+
+    def finish(self, video_id):
+        self.clear_stream(video_id)
+        with self.lock:
+            self.entries.pop(video_id, None)
+
+    def get(self, video_id):
+        return self.entries.get(video_id)
+
+    def reset(self, video_id, downloaded: int = 0):
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            with self.lock:
+                entry.downloaded = downloaded
+            self.flush(video_id)
+
+    def set_expected(self, video_id, expected: int):
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            entry.expected = expected
+            self.flush(video_id)
+
+    def advance(self, video_id, amount: int):
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return
+        with self.lock:
+            entry.downloaded += amount
+        entry.meter.add(amount)
+        self.flush(video_id)
+
+    def set_stage(self, video_id, stage: str):
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            entry.stage = stage
+            self.flush(video_id, force=True)
+
+    def transcode(self, video_id, seconds: float = None, duration: float = None, speed: str = None):
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return
+        if seconds is not None:
+            entry.transcode_seconds = seconds
+        if duration is not None:
+            entry.transcode_duration = duration
+        if speed is not None:
+            entry.transcode_speed = speed
+        self.flush(video_id)
+
+    def publish_stream(self, video_id, path: str, available: int, size: int = 0):
+        """``available`` bytes from the start of ``path`` can be streamed; ``size`` is the final size if known."""
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return
+        force = path != entry.stream_path or (size and available >= size)
+        entry.stream_path = path
+        entry.stream_available = available
+        entry.stream_size = size
+        self.flush(video_id, force=force)
+
+    def clear_stream(self, video_id):
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            entry.stream_path = ''
+            entry.stream_available = entry.stream_size = 0
+            self.flush(video_id, force=True)
+
+    def stream_source(self, video_id) -> dict | None:
+        """Where an in-flight video can be streamed from, or None."""
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            if not entry.stream_path:
+                return None
+            return {'path': entry.stream_path, 'available': entry.stream_available, 'size': entry.stream_size}
+        row = Video.objects.filter(pk=video_id).values('progressive_path', 'progressive_bytes', 'progressive_size').first()
+        if not row or not row['progressive_path']:
+            return None
+        return {'path': row['progressive_path'], 'available': row['progressive_bytes'], 'size': row['progressive_size']}
+
+    def flush(self, video_id, force: bool = False):
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return
+        now = time.monotonic()
+        if not force and now - entry.flushed_at < settings.PROGRESS_FLUSH_SECONDS:
+            return
+        entry.flushed_at = now
+        try:
+            Video.objects.filter(pk=video_id).update(
+                progress_stage=entry.stage,
+                downloaded_bytes=entry.downloaded,
+                expected_size=entry.expected,
+                transcode_percent=entry.transcode_percent,
+                progressive_path=entry.stream_path,
+                progressive_bytes=entry.stream_available,
+                progressive_size=entry.stream_size,
+                progress_updated_at=timezone.now(),
+            )
+        except Exception as e:
+            logger.warning(f"Could not save progress for {video_id}: {e}")
+
+    def snapshot(self, video) -> dict:
+        """Live progress if this process runs the job, else what was last flushed."""
+        entry = self.entries.get(video.pk)
+        if entry is not None:
+            return entry.as_dict()
+        return {
+            'stage': video.progress_stage,
+            'downloaded_bytes': video.downloaded_bytes,
+            'expected_bytes': video.expected_size,
+            'percent': round(100.0 * video.downloaded_bytes / video.expected_size, 2) if video.expected_size else None,
+            'throughput': None,
+            'eta_seconds': None,
+            'transcode_percent': round(video.transcode_percent, 2),
+            'transcode_speed': '',
+            'progressive': bool(video.progressive_path),
+            'live': False,
+            'updated_at': video.progress_updated_at.isoformat() if video.progress_updated_at else None,
+        }
+
+
+progress = ProgressTracker()
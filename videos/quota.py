@@ -0,0 +1,170 @@
+import os
+import logging
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Count
+from django.db.models.functions import Coalesce
+from .models import Video
+from .playback import playback
+from .segmented import CONTENT_RANGE_RE
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientStorage(Exception):
+    pass
+
+
+class QuotaManager:
+    """
+    Keeps the library's video files, plus the partial downloads on their way
+    into it, under STORAGE_HIGH_WATER of STORAGE_QUOTA_BYTES. Past it, files of the least recently watched
+    completed videos are deleted until usage is back under STORAGE_LOW_WATER;
+    those videos go back to 'pending' and can simply be downloaded again.
+    Pinned videos are never evicted, nor files another video shares (deleting
+    them frees nothing). Does nothing unless STORAGE_QUOTA_BYTES is set.
+    """
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.STORAGE_QUOTA_ENABLED and settings.STORAGE_QUOTA_BYTES)
+
+    def stored_files(self) -> dict:
+        """{(device, inode): size} of the completed videos' files, so hard-linked copies count once."""
+        files = {}
+        names = Video.objects.filter(status='completed').exclude(Q(video_file='') | Q(video_file=None))
+        for name in names.values_list('video_file', flat=True).distinct():
+            try:
+                stat = os.stat(os.path.join(settings.STORAGE_SERVER_PATH, name))
+            except OSError:
+                continue
+            files[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return files
+
+    def staged_bytes(self, video_id=None) -> int:
+        """
+        Bytes partial downloads (all, or ``video_id``'s) already hold on disk.
+        Segmented downloads preallocate their file: only written blocks count.
+        """
+        root = settings.DOWNLOAD_STAGING_PATH
+        if video_id is not None:
+            root = os.path.join(root, str(video_id))
+        total = 0
+        for directory, _, names in os.walk(root):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                total += min(stat.st_size, stat.st_blocks * 512)
+        return total
+
+    def usage(self) -> tuple[int, int]:
+        """(bytes used by the library and partial downloads, STORAGE_QUOTA_BYTES)."""
+        return sum(self.stored_files().values()) + self.staged_bytes(), settings.STORAGE_QUOTA_BYTES
+
+    def candidates(self):
+        """Evictable videos, least recently watched (or, if never, downloaded) first."""
+        return (
+            Video.objects.filter(status='completed', pinned=False)
+            .exclude(Q(video_file='') | Q(video_file=None))
+            .annotate(last_watched=Coalesce('last_played_at', 'created_at'))
+            .order_by('last_watched')
+            .only('id', 'title', 'file_size', 'video_file', 'last_played_at', 'created_at')
+        )
+
+    def eviction_size(self, video: Video, shared_names: set) -> int:
+        """Bytes evicting ``video`` would give back: 0 for a missing file or one that is also someone else's."""
+        if video.video_file.name in shared_names:
+            return 0
+        try:
+            stat = os.stat(video.get_absolute_path())
+        except OSError:
+            return 0
+        return 0 if stat.st_nlink > 1 else stat.st_size
+
+    def ensure_space(self, needed: int = 0, dry_run: bool = False) -> list[Video]:
+        """
+        Make room for ``needed`` more bytes if that would cross the high-water
+        mark. Returns the evicted videos; raises InsufficientStorage, without
+        evicting anything, if evicting can't bring usage down to the
+        low-water mark.
+        """
+        if not self.enabled:
+            return []
+        used, capacity = self.usage()
+        if used + needed <= capacity * settings.STORAGE_HIGH_WATER:
+            return []
+
+        # Recent plays may still be in memory; the order depends on them.
+        playback.flush()
+        shared_names = set(
+            Video.objects.exclude(Q(video_file='') | Q(video_file=None)).values('video_file')
+            .annotate(n=Count('pk')).filter(n__gt=1).values_list('video_file', flat=True)
+        )
+        target = capacity * settings.STORAGE_LOW_WATER
+        plan, freed = [], 0
+        for video in self.candidates():
+            if used - freed + needed <= target:
+                break
+            size = self.eviction_size(video, shared_names)
+            if size:
+                plan.append(video)
+                freed += size
+        if used - freed + needed > target:
+            raise InsufficientStorage(
+                f"Not enough storage: {needed} bytes needed, {used} of {capacity} used "
+                f"and only {freed} could be freed"
+            )
+        if dry_run:
+            return plan
+        return [video for video in plan if self.evict(video)]
+
+    def evict(self, video: Video) -> bool:
+        with transaction.atomic():
+            video = Video.objects.select_for_update().filter(pk=video.pk, status='completed', pinned=False).first()
+            if video is None:
+                return False
+            video.delete_video_file()
+            video.delete_hls_files()
+            video.video_file = None
+            video.hls_renditions = []
+            video.file_size = 0
+            video.status = 'pending'
+            video.progress_stage = ''
+            video.save(update_fields=['video_file', 'hls_renditions', 'file_size', 'status', 'progress_stage'])
+        logger.info(f"Evicted {video.title} to free space, last played {video.last_played_at or 'never'}")
+        return True
+
+    def expected_size(self, url: str) -> int:
+        """Size of ``url`` if the origin tells, else STORAGE_DOWNLOAD_RESERVE_BYTES."""
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=10)
+            if response.ok and response.headers.get('Content-Length'):
+                return int(response.headers['Content-Length'])
+            # Not every origin answers HEAD; ask for the first byte instead.
+            with requests.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=10) as response:
+                match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                if response.status_code == 206 and match:
+                    return int(match.group(3))
+                if response.status_code == 200 and response.headers.get('Content-Length'):
+                    return int(response.headers['Content-Length'])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.info(f"Could not get the size of {url}: {e}")
+        return settings.STORAGE_DOWNLOAD_RESERVE_BYTES
+
+    def preflight(self, video: Video):
+        """
+        Run before a download starts (or resumes): make room for what it has
+        left to write, or raise InsufficientStorage.
+        """
+        if not self.enabled:
+            return
+        # A resumed download's staged bytes are already part of usage().
+        needed = max(0, self.expected_size(video.download_url) - self.staged_bytes(video.pk))
+        evicted = self.ensure_space(needed)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} videos to make room for {video.title}")
+
+
+quota = QuotaManager()
@@ -0,0 +1,85 @@
+import re
+from django.utils.http import parse_http_date_safe
+
+RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def make_etag(file_size: int, mtime_ns: int) -> str:
+    """Strong ETag: a finished file only changes if its size or mtime does."""
+    return f'"{file_size:x}-{mtime_ns:x}"'
+
+
+def if_range_passes(request, etag: str, last_modified: int) -> bool:
+    """
+    RFC 7233 section 3.2: honour Range only if the representation the client
+    holds is still current. ETags use strong comparison, so weak ones never
+    match; dates must equal Last-Modified exactly.
+    """
+    value = request.headers.get('If-Range', '').strip()
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    return parse_http_date_safe(value) == last_modified
+
+
+def parse_range_header(header: str, file_size: int) -> list[tuple[int, int]] | None:
+    """
+    Turn a Range header into a sorted list of inclusive (start, end) pairs,
+    with overlapping and adjacent ranges coalesced.
+
+    Returns None when the header should be ignored (not a bytes range,
+    malformed, or too many ranges) and the whole file served instead.
+    Raises RangeNotSatisfiable when no range overlaps the file.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip().replace(' ', '')
+        if not spec:
+            continue
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            # Suffix range: the final N bytes.
+            suffix = int(last)
+            if suffix == 0 or file_size == 0:
+                continue
+            ranges.append((max(0, file_size - suffix), file_size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= file_size:
+            continue
+        end = min(int(last), file_size - 1) if last else file_size - 1
+        ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+    ranges = coalesce_ranges(ranges)
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def coalesce_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
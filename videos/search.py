@@ -0,0 +1,128 @@
+import re
+import uuid
+import logging
+from django.db import connection, DatabaseError
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete, post_migrate
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'videos_search'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# bm25 column weights: a hit in the title counts ten times one in the description.
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+# Database the index is known to exist in (the test runner, for one, switches databases).
+_ready = None
+
+
+def search_available() -> bool:
+    """Create the FTS5 index on first use; False if this database can't have one."""
+    global _ready
+    if _ready == connection.settings_dict['NAME']:
+        return True
+    if connection.vendor != 'sqlite':
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+            exists = cursor.fetchone() is not None
+            if not exists:
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+                    "video_id UNINDEXED, title, description, "
+                    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+                )
+    except DatabaseError as e:
+        logger.warning(f"Full-text search unavailable: {e}")
+        return False
+    _ready = connection.settings_dict['NAME']
+    if not exists:
+        rebuild_index()
+    return True
+
+
+def rebuild_index():
+    from .models import Video
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (video_id, title, description) VALUES (%s, %s, %s)",
+            [(pk.hex, title, description)
+             for pk, title, description in Video.objects.values_list('pk', 'title', 'description').iterator()],
+        )
+
+
+def index_video(video):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE video_id = %s", [video.pk.hex])
+        cursor.execute(
+            f"INSERT INTO {TABLE} (video_id, title, description) VALUES (%s, %s, %s)",
+            [video.pk.hex, video.title, video.description],
+        )
+
+
+def index_videos(videos):
+    """index_video for rows that were never indexed, e.g. new ones from bulk_create (which sends no signals)."""
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (video_id, title, description) VALUES (%s, %s, %s)",
+            [(video.pk.hex, video.title, video.description) for video in videos],
+        )
+
+
+def unindex_video(video_id):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE video_id = %s", [video_id.hex])
+
+
+def match_expression(query: str) -> str:
+    """Every word has to match, the last one (still being typed) as a prefix too."""
+    tokens = TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return ''
+    terms = [f'"{token}"' for token in tokens[:-1]] + [f'"{tokens[-1]}"*']
+    return ' '.join(terms)
+
+
+def search(query: str, limit: int = 50) -> list[uuid.UUID] | None:
+    """Video ids best match first, or None when there is no index to search."""
+    if not search_available():
+        return None
+    expression = match_expression(query)
+    if not expression:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT video_id FROM {TABLE} WHERE {TABLE} MATCH %s "
+            f"ORDER BY bm25({TABLE}, 0, %s, %s) LIMIT %s",
+            [expression, TITLE_WEIGHT, DESCRIPTION_WEIGHT, limit],
+        )
+        return [uuid.UUID(row[0]) for row in cursor.fetchall()]
+
+
+@receiver(post_save, sender='videos.Video')
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'title', 'description'} & set(update_fields):
+        return
+    index_video(instance)
+
+
+@receiver(post_delete, sender='videos.Video')
+def remove_from_search_index(sender, instance, **kwargs):
+    unindex_video(instance.pk)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    # Along with the tables, rather than inside the first search request's (or test's) transaction.
+    if sender.name == 'videos':
+        search_available()
@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import time
+import logging
+import requests
+import threading
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+REQUEST_TIMEOUT = (30, 300)
+CHUNK_SIZE = 1024 * 1024
+# Segment positions are saved next to the file (at most this often) so a
+# restarted download carries on where each segment stopped.
+STATE_SUFFIX = '.segments'
+STATE_SAVE_SECONDS = 2
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def probe_ranges(session, url: str) -> tuple[int, str] | None:
+    """
+    Ask for the first byte of ``url``. Returns the total size and a validator
+    (strong ETag or Last-Modified, '' if neither) when the origin answers
+    with a proper 206, None when it ignores ranges.
+    """
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code != 206:
+            return None
+        match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        if not match:
+            return None
+        etag = response.headers.get('ETag', '')
+        validator = etag if etag.startswith('"') else response.headers.get('Last-Modified', '')
+        return int(match.group(3)), validator
+
+
+def remove_partial(path: str):
+    """Drop a partial segmented download and its saved positions."""
+    for name in (path, path + STATE_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def split_ranges(size: int, segments: int) -> list[tuple[int, int]]:
+    segments = max(1, min(segments, size))
+    step = size // segments
+    ranges = []
+    for index in range(segments):
+        start = index * step
+        end = size - 1 if index == segments - 1 else start + step - 1
+        ranges.append((start, end))
+    return ranges
+
+
+class SegmentedDownloader:
+    """
+    Fetches one file over several connections at once. The file is split into
+    byte ranges, each written in place into a preallocated ``path``; every
+    range retries on its own and resumes from the last byte it wrote, also
+    across restarts as long as the origin still has the same file.
+    """
+    def __init__(self, url: str, path: str, segments: int, min_segment_size: int = 0, max_retries: int = 5,
+                 cancel_event=None, on_bytes=None, on_size=None, on_contiguous=None):
+        self.url = url
+        self.path = path
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.max_retries = max_retries
+        self.cancel_event = cancel_event
+        self.on_bytes = on_bytes
+        self.on_size = on_size
+        self.on_contiguous = on_contiguous
+        self.ranges = []
+        self.positions = {}
+        self.failed = threading.Event()
+        self.local = threading.local()
+        self.state_path = path + STATE_SUFFIX
+        self.state_lock = threading.Lock()
+        self.saved_at = 0.0
+        self.size = 0
+        self.validator = ''
+
+    def _should_stop(self) -> bool:
+        return self.failed.is_set() or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return session
+
+    def run(self) -> int:
+        """Download the whole file. Raises RangesNotSupported if the origin can't do ranges."""
+        probed = probe_ranges(self._session(), self.url)
+        if probed is None:
+            raise RangesNotSupported(self.url)
+        self.size, self.validator = probed
+        size = self.size
+        if self.on_size is not None:
+            self.on_size(size)
+
+        segments = self.segments
+        if self.min_segment_size:
+            segments = min(segments, max(1, size // self.min_segment_size))
+        ranges = self.ranges = split_ranges(size, segments)
+        self.positions = self._load_state()
+        if self.positions:
+            done = sum(self.positions[start] - start for start, _ in ranges)
+            logger.info(f"Resuming segmented download: {done} of {size} bytes already written")
+        else:
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+
+        logger.info(f"Segmented download: {size} bytes in {len(ranges)} segments")
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix='segment') as pool:
+                futures = [pool.submit(self._fetch_segment, start, end) for start, end in ranges]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # Stop the other segments instead of letting them run on.
+                    self.failed.set()
+                    raise
+        except BaseException:
+            # All segments have stopped; keep what they wrote for the next attempt.
+            self._save_state(force=True)
+            raise
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return size
+
+    def _load_state(self) -> dict:
+        """Positions saved by an earlier run for this same file, or {} to start over."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if (state['url'] != self.url or state['size'] != self.size or state['validator'] != self.validator
+                    or [tuple(r) for r in state['ranges']] != self.ranges or os.path.getsize(self.path) != self.size):
+                return {}
+            positions = {int(start): position for start, position in state['positions'].items()}
+            return {start: min(max(positions.get(start, start), start), end + 1) for start, end in self.ranges}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save_state(self, force: bool = False):
+        now = time.monotonic()
+        with self.state_lock:
+            if not force and now - self.saved_at < STATE_SAVE_SECONDS:
+                return
+            self.saved_at = now
+            state = {
+                'url': self.url,
+                'size': self.size,
+                'validator': self.validator,
+                'ranges': self.ranges,
+                'positions': {str(start): position for start, position in self.positions.items()},
+            }
+            with open(self.state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.state_path + '.tmp', self.state_path)
+
+    def contiguous_bytes(self) -> int:
+        """How many bytes from the start of the file are already written."""
+        for start, end in self.ranges:
+            position = self.positions.get(start, start)
+            if position <= end:
+                return position
+        return self.ranges[-1][1] + 1 if self.ranges else 0
+
+    def _fetch_segment(self, start: int, end: int):
+        position = self.positions.get(start, start)
+        retries = 0
+        while position <= end:
+            if self._should_stop():
+                raise DownloadCancelled()
+            try:
+                headers = {'Range': f'bytes={position}-{end}'}
+                if self.validator:
+                    # A changed file comes back whole (200) instead of mixing into this one.
+                    headers['If-Range'] = self.validator
+                with self._session().get(self.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                    if response.status_code >= 400:
+                        response.raise_for_status()  # retried like a dropped connection
+                    if response.status_code != 206:
+                        raise RangesNotSupported(f"Segment {start}-{end}: HTTP {response.status_code}")
+                    with open(self.path, 'r+b') as f:
+                        f.seek(position)
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            if self._should_stop():
+                                raise DownloadCancelled()
+                            if not chunk:
+                                continue
+                            chunk = chunk[:end - position + 1]
+                            f.write(chunk)
+                            # Saved positions must never run ahead of what the OS has.
+                            f.flush()
+                            position += len(chunk)
+                            self.positions[start] = position
+                            self._save_state()
+                            if self.on_bytes is not None:
+                                self.on_bytes(len(chunk))
+                            if self.on_contiguous is not None:
+                                self.on_contiguous(self.contiguous_bytes())
+                            if position > end:
+                                break
+                if position <= end:
+                    raise requests.exceptions.ConnectionError(f"Segment {start}-{end} ended early at {position}")
+
+            except requests.exceptions.RequestException as e:
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                metrics.download_retries.inc(host=urlparse(self.url).hostname or 'unknown', kind='segment')
+                logger.warning(f"Segment {start}-{end} error: {e}. Retrying ({retries}/{self.max_retries})...")
+                time.sleep(min(2 * retries, 30))
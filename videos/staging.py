@@ -0,0 +1,100 @@
+import os
+import errno
+import shutil
+import hashlib
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def staging_dir(video_id) -> str:
+    """Per-video working directory, so two URLs with the same basename can't clash."""
+    path = os.path.join(settings.DOWNLOAD_STAGING_PATH, str(video_id))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def remove_staging_dir(video_id):
+    path = os.path.join(settings.DOWNLOAD_STAGING_PATH, str(video_id))
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def file_sha256(path: str, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher
+
+
+class HashingWriter:
+    """File wrapper that feeds every written chunk into a sha256."""
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+
+
+def commit_to_storage(field_file, path: str, filename: str) -> str:
+    """
+    Move a finished staging file into the FileField's storage without copying:
+    hard-link it under a free name (which fails instead of clobbering an
+    existing file) and drop the staging name. Falls back to a move when
+    staging and storage are on different filesystems.
+    """
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, filename)
+    while True:
+        name = storage.get_available_name(name, max_length=field_file.field.max_length)
+        destination = storage.path(name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(path, destination)
+            os.remove(path)
+            break
+        except FileExistsError:
+            continue  # Someone took the name in the meantime
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            logger.warning(f"Staging directory is on another filesystem, moving {path} instead")
+            if os.path.exists(destination):
+                continue
+            shutil.move(path, destination)
+            break
+
+    field_file.name = name
+    return name
+
+
+def share_stored_file(field_file, source) -> str:
+    """
+    Point a FileField at the file already stored for another video: a hard
+    link under a name of its own, or, where links aren't possible, the very
+    same name (Video.delete_video_file keeps a file other videos still use).
+    """
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, os.path.basename(source.name))
+    while True:
+        name = storage.get_available_name(name, max_length=field_file.field.max_length)
+        try:
+            os.link(source.path, storage.path(name))
+            break
+        except FileExistsError:
+            continue
+        except OSError as e:
+            logger.warning(f"Could not link {source.name} ({e}), sharing the name instead")
+            name = source.name
+            break
+
+    field_file.name = name
+    return name
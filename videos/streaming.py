@@ -0,0 +1,330 @@
+import os
+import time
+import uuid
+import asyncio
+import aiofiles
+from contextlib import aclosing
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.core.handlers.asgi import ASGIHandler
+from .bandwidth import governor
+from .pacing import stream_ticket
+from .playback import playback
+from . import metrics
+
+PATHSEND = 'http.response.pathsend'
+ZEROCOPYSEND = 'http.response.zerocopysend'
+
+
+def zero_copy_mode(request, partial: bool = False, paced: bool = False) -> str | None:
+    """
+    Pick the ASGI extension the server offers for handing a file off without
+    copying it through Python. ``pathsend`` can only send whole files in one
+    go, so partial (206) and paced responses need ``zerocopysend``
+    (offset/count + sendfile).
+    """
+    if not settings.STREAM_ZERO_COPY:
+        return None
+    scope = getattr(request, 'scope', None) or {}
+    extensions = scope.get('extensions') or {}
+    if ZEROCOPYSEND in extensions:
+        return ZEROCOPYSEND
+    if PATHSEND in extensions and not partial and not paced:
+        return PATHSEND
+    return None
+
+
+class ChunkSizePolicy:
+    """
+    Start with small reads for a quick first byte and double the read size
+    while the client drains each chunk quickly; halve it when it falls behind.
+    """
+    def __init__(self, minimum: int, maximum: int, grow_below: float, shrink_above: float):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.grow_below = grow_below
+        self.shrink_above = shrink_above
+        self.size = minimum
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            minimum=settings.STREAM_CHUNK_MIN,
+            maximum=settings.STREAM_CHUNK_MAX,
+            grow_below=settings.STREAM_CHUNK_GROW_BELOW,
+            shrink_above=settings.STREAM_CHUNK_SHRINK_ABOVE,
+        )
+
+    def update(self, drain_seconds: float) -> int:
+        if drain_seconds < self.grow_below:
+            self.size = min(self.size * 2, self.maximum)
+        elif drain_seconds > self.shrink_above:
+            self.size = max(self.size // 2, self.minimum)
+        return self.size
+
+
+async def file_chunk_generator(file_path: str, start: int, length: int, policy: ChunkSizePolicy | None = None,
+                               pacing: tuple | None = None, video_stream: bool = False):
+    """
+    ``video_stream`` counts it as a video being watched, which holds
+    downloads back (see BandwidthGovernor); images and playlists aren't.
+    """
+    policy = policy or ChunkSizePolicy.from_settings()
+    if video_stream:
+        governor.stream_started()
+    try:
+        async with stream_ticket(pacing) as ticket, aclosing(_read_chunks(file_path, start, length, policy)) as chunks:
+            async for chunk in chunks:
+                if video_stream:
+                    governor.note_stream_activity()
+                yield chunk
+                if ticket is not None:
+                    await ticket.sent(len(chunk))
+    finally:
+        if video_stream:
+            governor.stream_finished()
+
+
+async def _read_chunks(file_path: str, start: int, length: int, policy: ChunkSizePolicy):
+    # Unbuffered, so every read lands straight in the bytes object we yield.
+    async with aiofiles.open(file_path, 'rb', buffering=0) as f:
+        await f.seek(start)
+        remaining = length
+        pending = asyncio.ensure_future(f.read(min(policy.size, remaining)))
+        try:
+            while remaining > 0:
+                chunk = await pending
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if remaining > 0:
+                    # Read the next chunk from disk while this one is being sent.
+                    pending = asyncio.ensure_future(f.read(min(policy.size, remaining)))
+                yielded_at = time.monotonic()
+                yield chunk
+                policy.update(time.monotonic() - yielded_at)
+        finally:
+            # Let an in-flight read finish before the file is closed.
+            if not pending.done():
+                await asyncio.wait([pending])
+
+
+class FileStreamResponse(StreamingHttpResponse):
+    """
+    Streams ``length`` bytes of ``file_path`` starting at ``offset``.
+    When ``zero_copy`` names a server extension, ``ZeroCopyASGIHandler`` sends
+    the file through it; otherwise the chunk generator is used as usual.
+    """
+    metrics_mode = 'generator'
+
+    def __init__(self, file_path: str, offset: int, length: int, zero_copy: str | None = None,
+                 pacing: tuple | None = None, video_stream: bool = False, *args, **kwargs):
+        super().__init__(file_chunk_generator(file_path, offset, length, pacing=pacing, video_stream=video_stream),
+                         *args, **kwargs)
+        self.file_path = file_path
+        self.offset = offset
+        self.length = length
+        self.zero_copy = zero_copy
+        self.pacing = pacing
+        self.video_stream = video_stream
+
+
+async def growing_file_generator(file_path: str, start: int, length: int | None, refresh, pacing: tuple | None = None):
+    """
+    Stream a file a download or transcode is still writing. Reads never go
+    past the bytes ``refresh()`` reports as written; once caught up, wait for
+    the writer. ``length`` None means: until the writer is done with the file.
+    """
+    policy = ChunkSizePolicy.from_settings()
+    end = None if length is None else start + length
+    governor.stream_started()
+    try:
+        async with stream_ticket(pacing) as ticket, aiofiles.open(file_path, 'rb', buffering=0) as f:
+            await f.seek(start)
+            position = start
+            idle = 0.0
+            source = await refresh()
+            while end is None or position < end:
+                if source is None or source['path'] != file_path:
+                    # The writer has moved on (file committed or replaced); what we have open is final.
+                    available, complete = os.fstat(f.fileno()).st_size, True
+                else:
+                    available = source['available']
+                    complete = bool(source['size']) and available >= source['size']
+                limit = available if end is None else min(available, end)
+                if position < limit:
+                    chunk = await f.read(min(policy.size, limit - position))
+                    if chunk:
+                        position += len(chunk)
+                        idle = 0.0
+                        governor.note_stream_activity()
+                        yielded_at = time.monotonic()
+                        yield chunk
+                        policy.update(time.monotonic() - yielded_at)
+                        if ticket is not None:
+                            await ticket.sent(len(chunk))
+                        continue
+                if complete or idle >= settings.PROGRESSIVE_WAIT_SECONDS:
+                    break
+                await asyncio.sleep(settings.PROGRESSIVE_POLL_SECONDS)
+                idle += settings.PROGRESSIVE_POLL_SECONDS
+                source = await refresh()
+    finally:
+        governor.stream_finished()
+
+
+class GrowingFileResponse(StreamingHttpResponse):
+    """Streams part of a file that is still being written, see ``growing_file_generator``."""
+    metrics_mode = 'growing'
+
+    def __init__(self, file_path: str, offset: int, length: int | None, refresh, pacing: tuple | None = None,
+                 *args, **kwargs):
+        super().__init__(growing_file_generator(file_path, offset, length, refresh, pacing), *args, **kwargs)
+
+
+class MultipartRangeResponse(StreamingHttpResponse):
+    """
+    206 multipart/byteranges response for requests asking for several ranges.
+    """
+    metrics_mode = 'multipart'
+
+    def __init__(self, file_path: str, ranges: list[tuple[int, int]], file_size: int, content_type: str,
+                 video_stream: bool = False, *args, **kwargs):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for index, (start, end) in enumerate(ranges):
+            head = (
+                ('' if index == 0 else '\r\n')
+                + f'--{boundary}\r\n'
+                + f'Content-Type: {content_type}\r\n'
+                + f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+            ).encode('latin1')
+            parts.append((head, start, end - start + 1))
+        tail = f'\r\n--{boundary}--\r\n'.encode('latin1')
+
+        super().__init__(
+            self._stream(file_path, parts, tail, video_stream),
+            *args,
+            status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}',
+            **kwargs
+        )
+        self['Content-Length'] = str(sum(len(head) + length for head, _, length in parts) + len(tail))
+
+    @staticmethod
+    async def _stream(file_path, parts, tail, video_stream):
+        for head, start, length in parts:
+            yield head
+            async for chunk in file_chunk_generator(file_path, start, length, video_stream=video_stream):
+                yield chunk
+        yield tail
+
+
+class ZeroCopyASGIHandler(ASGIHandler):
+    # Send the stream reader's chunks as they are instead of re-slicing
+    # (and copying) them into 64 KB messages.
+    chunk_size = 4 * 1024 * 1024
+
+    async def run_get_response(self, request):
+        started = time.perf_counter()
+        response = await super().run_get_response(request)
+        response.started_at = started
+        return response
+
+    async def send_response(self, response, send):
+        mode = getattr(response, 'metrics_mode', None)
+        if mode is None:
+            return await super().send_response(response, send)
+        if getattr(response, 'zero_copy', None) is not None:
+            mode = 'zero_copy'
+        started = getattr(response, 'started_at', None) or time.perf_counter()
+        first_byte = True
+        delivered = 0
+
+        async def measured_send(message):
+            nonlocal first_byte, delivered
+            kind = message['type']
+            if kind == 'http.response.body':
+                sent = len(message.get('body', b''))
+            elif kind == ZEROCOPYSEND:
+                sent = message['count']
+            elif kind == PATHSEND:
+                sent = response.length
+            else:
+                sent = 0
+            if sent and first_byte:
+                first_byte = False
+                metrics.stream_ttfb.observe(time.perf_counter() - started, mode=mode)
+            await send(message)
+            if sent:
+                delivered += sent
+                metrics.stream_bytes.inc(sent, mode=mode)
+
+        metrics.active_streams.inc(mode=mode)
+        try:
+            return await self._send_file_response(response, measured_send)
+        finally:
+            metrics.active_streams.dec(mode=mode)
+            video_id = getattr(response, 'playback_id', None)
+            if video_id is not None:
+                playback.played(video_id, delivered)
+                if playback.due():
+                    await sync_to_async(playback.flush)()
+
+    async def _send_file_response(self, response, send):
+        mode = getattr(response, 'zero_copy', None)
+        if mode is None:
+            return await super().send_response(response, send)
+
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip())
+            )
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+
+        if response.video_stream:
+            governor.stream_started()
+        try:
+            if mode == PATHSEND:
+                await send({'type': PATHSEND, 'path': response.file_path})
+                return
+
+            with open(response.file_path, 'rb') as f:
+                if response.pacing is None:
+                    await send({
+                        'type': ZEROCOPYSEND,
+                        'file': f,
+                        'offset': response.offset,
+                        'count': response.length,
+                    })
+                    return
+                # Paced: hand the file over in slices and let the scheduler space them out.
+                async with stream_ticket(response.pacing) as ticket:
+                    offset, remaining = response.offset, response.length
+                    while remaining > 0:
+                        count = min(settings.STREAM_CHUNK_MAX, remaining)
+                        remaining -= count
+                        await send({
+                            'type': ZEROCOPYSEND,
+                            'file': f,
+                            'offset': offset,
+                            'count': count,
+                            'more_body': remaining > 0,
+                        })
+                        offset += count
+                        await ticket.sent(count)
+        finally:
+            if response.video_stream:
+                governor.stream_finished()
@@ -1,3 +1,1519 @@
-from django.test import TestCase
+import os
+import asyncio
+import shutil
+import hashlib
+import tempfile
+import threading
+from unittest import mock
+from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User, Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase, RequestFactory, AsyncRequestFactory, override_settings
+from django.utils.http import http_date
+from django.utils import timezone
+from .models import Video, VideoStorage, LibraryStats, DownloadJob
+from .jobs import DownloadQueue, DownloadWorkerPool
+from .ranges import RangeNotSatisfiable, parse_range_header, if_range_passes
+from .descriptors import StreamDescriptor, DescriptorCache, descriptors
+from .views import serve_descriptor, serve_file, stream_in_flight
+from .bandwidth import TokenBucket, RateMeter, BandwidthGovernor, governor
+from .progress import progress
+from .transcoder import TranscodeScheduler, TranscodeCancelled
+from .hls import HLS_FILE_RE, ladder_for, master_playlist
+from .media import KEEP, REMUX, AUDIO, TRANSCODE, plan_conversion, conversion_args
+from .pacing import PLAYBACK, DOWNLOAD, MAX_SLEEP_SECONDS, StreamScheduler, fair_shares
+from .streaming import PATHSEND, ZEROCOPYSEND, ChunkSizePolicy, file_chunk_generator, zero_copy_mode
+from .quota import quota, InsufficientStorage
+from .dedupe import normalize_url
+from .importer import import_videos, detect_format, text_rows, csv_rows, jsonl_rows
+from .search import search
+from .manager import video_manager
+from .segmented import SegmentedDownloader, STATE_SUFFIX
+from .playback import playback
+from .metrics import Registry, Counter, Gauge, Histogram
+from .streaming import ZeroCopyASGIHandler
+from benchmarks.common import ASGIClient, http_scope
+from benchmarks.origin import Origin
 
-# Create your tests here.
+
+class RangeHeaderTests(SimpleTestCase):
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range_header('bytes=500-', 1000), [(500, 999)])
+        self.assertEqual(parse_range_header('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), [(0, 999)])
+        self.assertEqual(parse_range_header('bytes=900-5000', 1000), [(900, 999)])
+
+    def test_multiple_ranges_are_sorted_and_coalesced(self):
+        self.assertEqual(parse_range_header('bytes=500-599, 0-99, 50-149, 150-199', 1000), [(0, 199), (500, 599)])
+        self.assertEqual(parse_range_header('bytes=0-0,-1', 1000), [(0, 0), (999, 999)])
+        self.assertEqual(parse_range_header('bytes=0-99,2000-', 1000), [(0, 99)])
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=5000-6000', 'bytes=-0', 'bytes=1000-1100,2000-'):
+            with self.assertRaises(RangeNotSatisfiable, msg=header):
+                parse_range_header(header, 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=-10', 0)
+
+    def test_malformed_headers_are_ignored(self):
+        for header in ('items=0-99', 'bytes=', 'bytes=abc', 'bytes=-', 'bytes=100-50', 'bytes=0-99,x-y', '0-99',
+                       'bytes=' + ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(20))):
+            self.assertIsNone(parse_range_header(header, 1000), header)
+
+    def test_if_range(self):
+        factory = RequestFactory()
+        etag, last_modified = '"3e8-1"', 1_700_000_000
+
+        def passes(value: str) -> bool:
+            return if_range_passes(factory.get('/', HTTP_IF_RANGE=value), etag, last_modified)
+
+        self.assertTrue(if_range_passes(factory.get('/'), etag, last_modified))
+        self.assertTrue(passes(etag))
+        self.assertFalse(passes('"other"'))
+        self.assertFalse(passes(f'W/{etag}'))
+        self.assertTrue(passes(http_date(last_modified)))
+        self.assertFalse(passes(http_date(last_modified - 1)))
+        self.assertFalse(passes('not a date'))
+
+
+class ServeRangeTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.mp4')
+        os.write(fd, bytes(range(256)) * 4)
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.descriptor = StreamDescriptor.from_path(self.path, cacheable=True)
+        self.factory = AsyncRequestFactory()
+
+    async def get(self, **headers):
+        return await serve_descriptor(self.factory.get('/', headers=headers), self.descriptor)
+
+    async def test_range(self):
+        response = await self.get(range='bytes=-24')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1000-1023/1024')
+
+    async def test_unsatisfiable_range(self):
+        response = await self.get(range='bytes=2048-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    async def test_malformed_range_gets_the_whole_file(self):
+        response = await self.get(range='bytes=20-10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+
+    async def test_if_range_mismatch_gets_the_whole_file(self):
+        response = await self.get(range='bytes=0-9', if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = await self.get(range='bytes=0-9', if_range=self.descriptor.etag)
+        self.assertEqual(response.status_code, 206)
+
+    async def test_cache_control(self):
+        response = await self.get()
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(response['ETag'], self.descriptor.etag)
+        with self.settings(STREAM_CACHE_MAX_AGE=60):
+            response = await self.get(range='bytes=0-9')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.descriptor.cacheable = False
+        response = await self.get()
+        self.assertEqual(response['Cache-Control'], 'no-cache, no-store, must-revalidate')
+
+    async def test_if_none_match(self):
+        response = await self.get(if_none_match=self.descriptor.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.descriptor.etag)
+        response = await self.get(if_none_match='"other"')
+        self.assertEqual(response.status_code, 200)
+
+
+
+class SlowFile:
+    """Async file whose reads take a moment, counting the ones still running when it's closed."""
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+        self.reads = []
+        self.finished = 0
+        self.unfinished_at_close = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.unfinished_at_close = len(self.reads) - self.finished
+
+    async def seek(self, position: int):
+        self.position = position
+
+    def read(self, size: int):
+        self.reads.append(size)
+        return self._read(size)
+
+    async def _read(self, size: int) -> bytes:
+        await asyncio.sleep(0.01)
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        self.finished += 1
+        return chunk
+
+
+class ChunkStreamTests(SimpleTestCase):
+    def test_policy_grows_while_drained_quickly_and_shrinks_when_not(self):
+        policy = ChunkSizePolicy(minimum=64, maximum=256, grow_below=0.05, shrink_above=0.5)
+        self.assertEqual(policy.size, 64)
+        self.assertEqual([policy.update(0.01) for _ in range(3)], [128, 256, 256])
+        self.assertEqual(policy.update(0.2), 256)  # between the thresholds: keep
+        self.assertEqual([policy.update(1.0) for _ in range(3)], [128, 64, 64])
+
+    async def test_closing_mid_stream_waits_for_the_read_ahead(self):
+        f = SlowFile(b'x' * 1000)
+        policy = ChunkSizePolicy(minimum=100, maximum=400, grow_below=60, shrink_above=120)
+        with mock.patch('videos.streaming.aiofiles.open', return_value=f):
+            chunks = file_chunk_generator('video.mp4', 0, 1000, policy=policy)
+            self.assertEqual(len(await anext(chunks)), 100)
+            self.assertEqual(len(await anext(chunks)), 100)
+            await chunks.aclose()
+        # Each read ahead is sized before the chunk in hand is drained; the
+        # third was still on its way when the client went away.
+        self.assertEqual(f.reads, [100, 100, 200])
+        self.assertEqual(f.unfinished_at_close, 0)
+
+class DownloadQueueTests(TestCase):
+    def setUp(self):
+        self.queue = DownloadQueue()
+        self.video = Video.objects.create(title='movie', download_url='http://test.local/movie.mp4')
+
+    def expire(self, job: DownloadJob):
+        DownloadJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_leases_a_job_once(self):
+        job = self.queue.enqueue(self.video)
+        self.assertEqual(Video.objects.get(pk=self.video.pk).status, 'downloading')
+        claimed = self.queue.claim('worker-1')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual((claimed.status, claimed.lease_owner, claimed.attempts), ('running', 'worker-1', 1))
+        self.assertIsNone(self.queue.claim('worker-2'))
+
+    def test_claim_takes_the_most_urgent_job(self):
+        self.queue.enqueue(self.video)
+        other = Video.objects.create(title='other', download_url='http://test.local/other.mp4')
+        urgent = self.queue.enqueue(other, priority=DownloadJob.PRIORITY_USER)
+        self.assertEqual(self.queue.claim('worker-1').pk, urgent.pk)
+
+    def test_expired_lease_is_reclaimed(self):
+        self.queue.enqueue(self.video)
+        first = self.queue.claim('worker-1')
+        self.expire(first)
+        second = self.queue.claim('worker-2')
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual((second.lease_owner, second.attempts), ('worker-2', 2))
+        self.assertNotEqual(second.lease_token, first.lease_token)
+
+        # The first worker has lost the job: neither its heartbeat nor its result count.
+        self.assertFalse(self.queue.heartbeat(first))
+        self.queue.finish(first, success=False, error='too late')
+        self.assertEqual(DownloadJob.objects.get(pk=first.pk).status, 'running')
+        self.assertTrue(self.queue.heartbeat(second))
+        self.queue.finish(second, success=True)
+        self.assertEqual(DownloadJob.objects.get(pk=first.pk).status, 'done')
+
+    def test_enqueue_refuses_a_video_with_a_live_job(self):
+        job = self.queue.enqueue(self.video)
+        self.assertIsNone(self.queue.enqueue(self.video))
+        self.queue.claim('worker-1')
+        self.assertIsNone(self.queue.enqueue(self.video))
+        self.assertEqual(DownloadJob.objects.count(), 1)
+
+        # Once the lease runs out the orphaned job is failed and replaced.
+        self.expire(job)
+        replacement = self.queue.enqueue(self.video)
+        self.assertNotEqual(replacement.pk, job.pk)
+        self.assertEqual(DownloadJob.objects.get(pk=job.pk).status, 'failed')
+
+    def test_enqueue_skips_completed_videos(self):
+        Video.set_status(self.video.pk, 'completed')
+        self.assertIsNone(self.queue.enqueue(self.video))
+        self.assertEqual(self.queue.enqueue_many([self.video.pk]), 0)
+
+    @override_settings(DOWNLOAD_MAX_ATTEMPTS=2)
+    def test_job_fails_after_max_attempts(self):
+        self.queue.enqueue(self.video)
+        self.expire(self.queue.claim('worker-1'))
+        job = self.queue.claim('worker-2')
+        self.assertEqual(job.attempts, 2)
+        self.expire(job)
+
+        self.assertIsNone(self.queue.claim('worker-3'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error_message, 'Lease expired too many times')
+        self.assertIsNotNone(job.finished_at)
+
+
+class DownloadWorkerPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = mock.Mock(spec=DownloadQueue, lease_seconds=0.03)
+        self.job = DownloadJob(pk=1, video_id=1)
+
+    def test_finishes_the_job_while_holding_the_lease(self):
+        self.queue.heartbeat.return_value = True
+
+        def handler(job, cancel_event):
+            cancel_event.wait(0.1)
+            return True
+
+        DownloadWorkerPool(self.queue, handler)._run(self.job)
+        self.assertTrue(self.queue.heartbeat.called)
+        self.queue.finish.assert_called_once_with(self.job, True, '')
+
+    def test_lost_lease_cancels_the_handler_and_skips_finish(self):
+        self.queue.heartbeat.return_value = False
+        cancelled = []
+
+        def handler(job, cancel_event):
+            cancelled.append(cancel_event.wait(5))
+            return False
+
+        DownloadWorkerPool(self.queue, handler)._run(self.job)
+        self.assertEqual(cancelled, [True])
+        self.queue.heartbeat.assert_called_once_with(self.job)
+        self.queue.finish.assert_not_called()
+
+    def test_crashed_handler_fails_the_job(self):
+        def handler(job, cancel_event):
+            raise RuntimeError('boom')
+
+        DownloadWorkerPool(self.queue, handler)._run(self.job)
+        self.queue.finish.assert_called_once_with(self.job, False, 'boom')
+
+
+class FakeClock:
+    """Stands in for the time module: monotonic() only moves on sleep() or advance()."""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return 1_700_000_000 + self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class BandwidthTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('videos.bandwidth.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(burst_seconds=0.5)
+        self.assertEqual(bucket.consume(1000, rate=0), 0)
+        self.assertEqual(bucket.consume(1000, rate=1000), 1.0)
+        self.assertEqual(bucket.consume(500, rate=1000), 0.5)
+        # Idle time builds up at most burst_seconds of credit.
+        self.clock.advance(10)
+        self.assertEqual(bucket.consume(500, rate=1000), 0)
+        self.assertEqual(bucket.consume(500, rate=1000), 0.5)
+        self.assertEqual(self.clock.sleeps, [1.0, 0.5, 0.5])
+
+    def test_rate_meter(self):
+        meter = RateMeter(window=5.0, resolution=0.5)
+        meter.add(1000)
+        self.clock.advance(0.2)
+        meter.add(1000)
+        self.assertEqual(len(meter.bins), 1)
+        self.clock.advance(0.8)
+        meter.add(3000)
+        self.assertEqual(meter.rate(), 1000)
+        self.clock.advance(4.5)  # the first bin is out of the window
+        self.assertEqual(meter.rate(), 600)
+        self.assertEqual(meter.total, 5000)
+
+    @override_settings(DOWNLOAD_MAX_RATE=100, DOWNLOAD_RATE_SCHEDULE=[('01:00', '07:00', 0), ('23:00', '01:00', 50)])
+    def test_scheduled_rate(self):
+        def rate_at(hour: int, minute: int = 0) -> int:
+            with mock.patch('videos.bandwidth.timezone', mock.Mock(
+                    localtime=lambda: datetime(2026, 1, 1, hour, minute))):
+                return BandwidthGovernor().scheduled_rate()
+
+        self.assertEqual(rate_at(12), 100)
+        self.assertEqual(rate_at(1), 0)
+        self.assertEqual(rate_at(6, 59), 0)
+        self.assertEqual(rate_at(7), 100)
+        # Wrapping past midnight.
+        self.assertEqual(rate_at(22, 59), 100)
+        self.assertEqual(rate_at(23), 50)
+        self.assertEqual(rate_at(0, 30), 50)
+
+    @override_settings(DOWNLOAD_MAX_RATE=0, DOWNLOAD_RATE_SCHEDULE=[], DOWNLOAD_RATE_WHILE_STREAMING=1000,
+                       STREAM_ACTIVITY_GRACE=10,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_streams_in_another_process_slow_downloads_down(self):
+        web, worker = BandwidthGovernor(), BandwidthGovernor()
+        self.assertEqual(worker.total_rate_limit(), 0)
+        web.stream_started()
+        self.clock.advance(1)
+        self.assertTrue(worker.streaming())
+        self.assertEqual(worker.total_rate_limit(), 1000)
+        web.stream_finished()
+        self.clock.advance(11)
+        self.assertFalse(worker.streaming())
+        self.assertEqual(worker.total_rate_limit(), 0)
+
+
+class GovernedStreamTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'x' * 1000)
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.started = []
+        patcher = mock.patch.object(governor, 'stream_started', lambda: self.started.append(governor.active_streams))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def consume(self, response) -> bytes:
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    @override_settings(STREAM_ZERO_COPY=False)
+    async def test_only_video_streams_hold_downloads_back(self):
+        request = AsyncRequestFactory().get('/')
+        await self.consume(await serve_file(request, self.path, cacheable=False, content_type='image/jpeg'))
+        self.assertEqual(self.started, [])
+        await self.consume(await serve_file(request, self.path, cacheable=True, content_type='video/mp2t',
+                                            video_stream=True))
+        self.assertEqual(len(self.started), 1)
+        ranges = AsyncRequestFactory().get('/', headers={'range': 'bytes=0-9,100-109'})
+        await self.consume(await serve_file(ranges, self.path, cacheable=True, video_stream=True))
+        self.assertEqual(len(self.started), 3)
+
+
+class FairSharesTests(SimpleTestCase):
+    def test_split_by_weight(self):
+        self.assertEqual(fair_shares(900, {'a': 1, 'b': 2}, {'a': 1000, 'b': 1000}), {'a': 300, 'b': 600})
+
+    def test_capped_leftover_goes_to_the_others_by_weight(self):
+        shares = fair_shares(1000, {'a': 1, 'b': 1, 'c': 3}, {'a': 100, 'b': 1000, 'c': 1000})
+        self.assertEqual(shares, {'a': 100, 'b': 225, 'c': 675})
+        shares = fair_shares(1000, {'a': 1, 'b': 1}, {'a': 100, 'b': 200})
+        self.assertEqual(shares, {'a': 100, 'b': 200})
+
+    def test_zero_weights(self):
+        # Nobody else: they split everything evenly.
+        self.assertEqual(fair_shares(1000, {'a': 0, 'b': 0}, {'a': 1000, 'b': 1000}), {'a': 500, 'b': 500})
+        # Someone who can use it all leaves them nothing...
+        self.assertEqual(fair_shares(1000, {'a': 1, 'b': 0}, {'a': 2000, 'b': 2000}), {'a': 1000, 'b': 0})
+        # ...and someone capped leaves them the rest.
+        self.assertEqual(fair_shares(1000, {'a': 1, 'b': 0}, {'a': 400, 'b': 2000}), {'a': 400, 'b': 600})
+
+
+@override_settings(STREAM_TOTAL_RATE=0, STREAM_PACING_MULTIPLE=2.0, STREAM_PACING_READAHEAD_SECONDS=1,
+                   STREAM_DOWNLOAD_WEIGHT=0.25, STREAM_DOWNLOAD_RATE_WHILE_PLAYING=4000)
+class StreamSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = StreamScheduler()
+        # A clock that only moves when a paced stream sleeps.
+        self.clock = 0.0
+        self.sleeps = []
+
+        async def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.clock += seconds
+
+        for target, replacement in (('videos.pacing.time', mock.Mock(monotonic=lambda: self.clock)),
+                                    ('videos.pacing.asyncio', mock.Mock(sleep=sleep))):
+            patcher = mock.patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_playback_is_paced_after_the_read_ahead(self):
+        async with self.scheduler.stream('tv', PLAYBACK, byte_rate=1000) as ticket:
+            await ticket.sent(600)
+            self.assertEqual((ticket.paced, ticket.rate), (False, 0))
+            await ticket.sent(600)
+            self.assertEqual((ticket.paced, ticket.rate), (True, 2000))
+            self.assertAlmostEqual(self.clock, 0.3)  # the chunk that went past the read-ahead
+
+            for _ in range(10):
+                await ticket.sent(1000)
+        self.assertAlmostEqual(self.clock, 5.3)
+
+    async def test_sleeps_in_steps_and_follows_a_new_rate(self):
+        async with self.scheduler.stream('tv', DOWNLOAD) as ticket:
+            ticket.rate = 1
+
+            async def sleep(seconds):
+                self.clock += seconds
+                if len(self.sleeps) == 2:
+                    ticket.rate = 1000
+                self.sleeps.append(seconds)
+
+            with mock.patch('videos.pacing.asyncio', mock.Mock(sleep=sleep)):
+                await ticket.sent(1000)
+        self.assertEqual(self.sleeps[:3], [MAX_SLEEP_SECONDS] * 3)
+        self.assertLess(self.clock, 5)
+
+    async def test_downloads_are_held_back_while_something_plays(self):
+        async with self.scheduler.stream('pc', DOWNLOAD) as first, self.scheduler.stream('pc', DOWNLOAD) as second:
+            self.assertEqual((first.rate, second.rate), (0, 0))
+            async with self.scheduler.stream('tv', PLAYBACK, byte_rate=1000) as playing:
+                self.assertEqual((first.rate, second.rate, playing.rate), (2000, 2000, 0))
+            self.assertEqual((first.rate, second.rate), (0, 0))
+
+    @override_settings(STREAM_TOTAL_RATE=3000, STREAM_DOWNLOAD_RATE_WHILE_PLAYING=0)
+    async def test_uplink_is_split_per_client_first(self):
+        async with (self.scheduler.stream('tv', PLAYBACK) as tv, self.scheduler.stream('pc', PLAYBACK) as pc,
+                    self.scheduler.stream('pc', PLAYBACK) as other):
+            self.assertEqual((tv.rate, pc.rate, other.rate), (1500, 750, 750))
+            # A grab weighs a quarter of a playback stream.
+            async with self.scheduler.stream('pc', DOWNLOAD) as grab:
+                self.assertEqual((tv.rate, pc.rate, grab.rate), (1714, 571, 142))
+
+    @override_settings(STREAM_TOTAL_RATE=3000, STREAM_DOWNLOAD_WEIGHT=0)
+    async def test_zero_download_weight(self):
+        async with self.scheduler.stream('pc', DOWNLOAD) as grab:
+            self.assertEqual(grab.rate, 3000)
+
+    async def test_may_limit(self):
+        self.assertFalse(self.scheduler.may_limit(None))
+        self.assertTrue(self.scheduler.may_limit(('tv', PLAYBACK, 1000)))
+        self.assertFalse(self.scheduler.may_limit(('tv', PLAYBACK, 0)))
+        self.assertFalse(self.scheduler.may_limit(('pc', DOWNLOAD, 1000)))
+        async with self.scheduler.stream('tv', PLAYBACK, byte_rate=1000):
+            self.assertTrue(self.scheduler.may_limit(('pc', DOWNLOAD, 1000)))
+        with self.settings(STREAM_TOTAL_RATE=3000):
+            self.assertTrue(self.scheduler.may_limit(('tv', PLAYBACK, 0)))
+
+    @override_settings(STREAM_ZERO_COPY=True, STREAM_SCHEDULING=True)
+    async def test_whole_files_that_cannot_be_limited_use_pathsend(self):
+        fd, path = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        async def zero_copy(byte_rate: int) -> str | None:
+            request = AsyncRequestFactory().get('/')
+            request.scope['extensions'] = {PATHSEND: {}}
+            descriptor = StreamDescriptor.from_path(path, cacheable=True, byte_rate=byte_rate)
+            response = await serve_descriptor(request, descriptor, ('tv', PLAYBACK, byte_rate))
+            return response.zero_copy
+
+        self.assertEqual(await zero_copy(0), PATHSEND)
+        self.assertIsNone(await zero_copy(1000))
+
+
+def ffprobe_json(format_name: str, video: dict | None = None, audio: dict | None = None, *extra: dict) -> dict:
+    """What `ffprobe -show_format -show_streams -print_format json` prints, trimmed to what we read."""
+    streams = []
+    if video is not None:
+        streams.append({'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High', 'level': 40,
+                        'pix_fmt': 'yuv420p', 'width': 1280, 'height': 720, 'disposition': {'attached_pic': 0},
+                        **video})
+    if audio is not None:
+        streams.append({'index': len(streams), 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, **audio})
+    streams.extend(extra)
+    return {'streams': streams, 'format': {'format_name': format_name, 'duration': '60.0', 'bit_rate': '2000000'}}
+
+
+MP4 = 'mov,mp4,m4a,3gp,3g2,mj2'
+MKV = 'matroska,webm'
+
+
+class ConversionPlanTests(SimpleTestCase):
+    cases = [
+        ('h264/aac mp4 plays as is', 'a.mp4', ffprobe_json(MP4, {}, {}), KEEP),
+        ('m4v too', 'a.m4v', ffprobe_json(MP4, {}, {}), KEEP),
+        ('silent h264 mp4', 'a.mp4', ffprobe_json(MP4, {}), KEEP),
+        ('h264/mp3 mp4', 'a.mp4', ffprobe_json(MP4, {}, {'codec_name': 'mp3'}), KEEP),
+        ('h264 mkv needs a new container', 'a.mkv', ffprobe_json(MKV, {}, {}), REMUX),
+        ('mp4 named .mov', 'a.mov', ffprobe_json(MP4, {}, {}), REMUX),
+        ('h264 mkv with ac3 audio', 'a.mkv', ffprobe_json(MKV, {}, {'codec_name': 'ac3', 'channels': 6}), AUDIO),
+        ('h264 mp4 with dts audio', 'a.mp4', ffprobe_json(MP4, {}, {'codec_name': 'dts'}), AUDIO),
+        ('hevc', 'a.mp4', ffprobe_json(MP4, {'codec_name': 'hevc', 'profile': 'Main'}, {}), TRANSCODE),
+        ('h264 High 10', 'a.mkv', ffprobe_json(MKV, {'profile': 'High 10', 'pix_fmt': 'yuv420p10le'}, {}), TRANSCODE),
+        ('h264 level 5.1', 'a.mp4', ffprobe_json(MP4, {'level': 51}, {}), TRANSCODE),
+        ('h264 4:4:4', 'a.mp4', ffprobe_json(MP4, {'pix_fmt': 'yuv444p'}, {}), TRANSCODE),
+        ('vp8 webm plays as is', 'a.webm', ffprobe_json(MKV, {'codec_name': 'vp8', 'profile': ''},
+                                                         {'codec_name': 'vorbis'}), KEEP),
+        ('vp9 webm', 'a.webm', ffprobe_json(MKV, {'codec_name': 'vp9', 'profile': ''}, {'codec_name': 'opus'}),
+         TRANSCODE),
+        ('audio only', 'a.mp4', ffprobe_json(MP4, None, {}), TRANSCODE),
+        ('cover art is not the video', 'a.mkv', ffprobe_json(
+            MKV, None, {}, {'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p',
+                            'disposition': {'attached_pic': 1}}), TRANSCODE),
+        ('not probed, mp4', 'a.mp4', None, KEEP),
+        ('not probed, mkv', 'a.mkv', None, TRANSCODE),
+    ]
+
+    def test_plan_conversion(self):
+        for name, path, info, expected in self.cases:
+            with self.subTest(name):
+                self.assertEqual(plan_conversion(path, info), expected)
+
+    def test_conversion_args(self):
+        mapping = ['-map', '0:v:0', '-map', '0:a:0?']
+        faststart = ['-movflags', '+faststart']
+        aac = ffprobe_json(MKV, {}, {})
+        ac3 = ffprobe_json(MKV, {'codec_name': 'hevc'}, {'codec_name': 'ac3'})
+
+        self.assertEqual(conversion_args(REMUX, aac), mapping + ['-c:v', 'copy', '-c:a', 'copy'] + faststart)
+        self.assertEqual(conversion_args(AUDIO, ac3), mapping + ['-c:v', 'copy', '-c:a', 'aac'] + faststart)
+        encode = ['-c:v', 'libx264', '-profile:v', 'high', '-level', '4.1', '-pix_fmt', 'yuv420p']
+        self.assertEqual(conversion_args(TRANSCODE, aac), mapping + encode + ['-c:a', 'copy'] + faststart)
+        self.assertEqual(conversion_args(TRANSCODE, ac3), mapping + encode + ['-c:a', 'aac'] + faststart)
+        self.assertEqual(conversion_args(TRANSCODE, None), mapping + encode + ['-c:a', 'aac'] + faststart)
+        self.assertEqual(conversion_args(REMUX, aac, fragmented=True)[-2:],
+                         ['-movflags', 'frag_keyframe+empty_moov+default_base_moof'])
+
+
+class FakeProcess:
+    """What TranscodeScheduler needs of a Popen; the output ends once ``release`` is set."""
+    def __init__(self, command, release: threading.Event):
+        self.command = command
+        self.release = release
+        self.pid = 0
+        self.stderr = []
+
+    @property
+    def stdout(self):
+        self.release.wait(5)
+        return []
+
+    def poll(self):
+        return 0 if self.release.is_set() else None
+
+    def kill(self):
+        self.release.set()
+
+
+@override_settings(TRANSCODE_THREADS=2, TRANSCODE_NICE=10, TRANSCODE_IONICE_CLASS=2, TRANSCODE_IONICE_LEVEL=7)
+@mock.patch('videos.transcoder.shutil.which', lambda name: f'/usr/bin/{name}')
+class TranscodeSchedulerTests(SimpleTestCase):
+    command = ['ffmpeg', '-y', '-i', 'in.mkv', '-c:v', 'libx264', 'out.mp4']
+
+    def setUp(self):
+        self.scheduler = TranscodeScheduler()
+        self.started = []
+        self.running = 0
+        self.most_running = 0
+        self.releases = {}
+        self.lock = threading.Lock()
+
+        def popen(command, **kwargs):
+            with self.lock:
+                self.started.append(command[-1])
+                self.running += 1
+                self.most_running = max(self.most_running, self.running)
+            return FakeProcess(command, self.releases.setdefault(command[-1], threading.Event()))
+
+        def reap(process):
+            with self.lock:
+                self.running -= 1
+            return 0, None
+
+        for target, replacement in (('videos.transcoder.subprocess.Popen', popen), ('videos.transcoder.reap', reap)):
+            patcher = mock.patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def submit(self, name: str, priority: int = 0):
+        self.releases.setdefault(name, threading.Event())
+        return self.scheduler.submit(name, ['ffmpeg', '-i', 'in.mkv', name], priority=priority)
+
+    def wait_started(self, count: int):
+        for _ in range(500):
+            if len(self.started) >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail(f"only {self.started} started")
+
+    def test_budgeted_command(self):
+        self.assertEqual(self.scheduler._budgeted(self.command), [
+            'ionice', '-c', '2', '-n', '7', 'nice', '-n', '10',
+            'ffmpeg', '-y', '-i', 'in.mkv', '-c:v', 'libx264', '-threads', '2', 'out.mp4',
+        ])
+        with self.settings(TRANSCODE_IONICE_CLASS=3, TRANSCODE_NICE=0, TRANSCODE_THREADS=0):
+            self.assertEqual(self.scheduler._budgeted(self.command), ['ionice', '-c', '3'] + self.command)
+        with self.settings(TRANSCODE_IONICE_CLASS=None):
+            probe = ['ffprobe', '-v', 'error', 'in.mkv']
+            self.assertEqual(self.scheduler._budgeted(probe), ['nice', '-n', '10'] + probe)
+
+    def test_missing_tools_are_skipped(self):
+        with mock.patch('videos.transcoder.shutil.which', lambda name: None):
+            self.assertEqual(self.scheduler._budgeted(self.command)[:7],
+                             ['ffmpeg', '-y', '-i', 'in.mkv', '-c:v', 'libx264', '-threads'])
+
+    @override_settings(TRANSCODE_MAX_JOBS=1)
+    def test_waiting_jobs_run_by_priority_then_in_order(self):
+        first = self.submit('first')
+        self.wait_started(1)
+        jobs = [self.submit('low', 0), self.submit('high', 10), self.submit('normal', 5), self.submit('high-2', 10)]
+        dropped = self.submit('dropped', 20)
+        self.assertEqual(self.scheduler.status('normal'), {'state': 'queued', 'priority': 5, 'position': 4})
+        self.assertTrue(self.scheduler.cancel('dropped'))
+        self.assertEqual(self.scheduler.status('normal')['position'], 3)
+
+        for event in self.releases.values():
+            event.set()
+        for job in [first] + jobs:
+            self.assertTrue(job.wait(5))
+        self.assertEqual(self.started, ['first', 'high', 'high-2', 'normal', 'low'])
+        self.assertEqual(dropped.state, 'cancelled')
+        self.assertEqual(self.most_running, 1)
+
+    @override_settings(TRANSCODE_MAX_JOBS=2)
+    def test_at_most_max_jobs_run_at_once(self):
+        jobs = [self.submit(f'job-{i}') for i in range(4)]
+        self.wait_started(2)
+        threading.Event().wait(0.05)
+        self.assertEqual(len(self.started), 2)
+        for event in self.releases.values():
+            event.set()
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+            self.assertEqual(job.returncode, 0)
+        self.assertEqual(self.most_running, 2)
+
+    @override_settings(TRANSCODE_MAX_JOBS=1)
+    def test_run_cancels_its_job_when_asked(self):
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(TranscodeCancelled):
+            self.scheduler.run('cancelled', ['ffmpeg', '-i', 'in.mkv', 'cancelled'], cancel_event=cancel)
+        self.assertIsNone(self.scheduler.status('cancelled'))
+
+
+class StorageTestCase(TestCase):
+    """A throwaway STORAGE_SERVER_PATH per test, so nothing touches the real library."""
+    def setUp(self):
+        self.storage = tempfile.mkdtemp(prefix='streamer-test-')
+        self.addCleanup(shutil.rmtree, self.storage, ignore_errors=True)
+        override = override_settings(
+            STORAGE_SERVER_PATH=self.storage,
+            DOWNLOAD_STAGING_PATH=os.path.join(self.storage, 'staging'),
+            HLS_ROOT=os.path.join(self.storage, 'hls'),
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        # VideoStorage reads STORAGE_SERVER_PATH once, when models.py is imported.
+        storage = mock.patch.object(Video._meta.get_field('video_file'), 'storage', VideoStorage())
+        storage.start()
+        self.addCleanup(storage.stop)
+
+    def make_video(self, name: str, size: int, **fields) -> Video:
+        os.makedirs(os.path.join(self.storage, 'videos'), exist_ok=True)
+        with open(os.path.join(self.storage, 'videos', name), 'wb') as f:
+            f.write(b'\0' * size)
+        video = Video(title=name, download_url=f'http://test.local/{name}', status='completed',
+                      file_size=size, **fields)
+        video.video_file.name = f'videos/{name}'
+        video.save()
+        return video
+
+    def watched(self, video: Video, days_ago: int):
+        Video.objects.filter(pk=video.pk).update(last_played_at=timezone.now() - timedelta(days=days_ago))
+
+
+@override_settings(STORAGE_QUOTA_ENABLED=True, STORAGE_QUOTA_BYTES=1000,
+                   STORAGE_HIGH_WATER=0.9, STORAGE_LOW_WATER=0.8)
+class QuotaTests(StorageTestCase):
+    def test_evicts_least_recently_watched_down_to_low_water(self):
+        videos = [self.make_video(f'{i}.mp4', 250) for i in range(4)]
+        for days_ago, video in zip((1, 4, 3, 2), videos):
+            self.watched(video, days_ago)
+
+        evicted = quota.ensure_space(100)
+
+        self.assertEqual([video.pk for video in evicted], [videos[1].pk, videos[2].pk])
+        self.assertFalse(os.path.exists(os.path.join(self.storage, 'videos', '1.mp4')))
+        self.assertEqual(Video.objects.get(pk=videos[1].pk).status, 'pending')
+        self.assertEqual(Video.objects.get(pk=videos[0].pk).status, 'completed')
+
+    def test_nothing_evicted_when_low_water_cannot_be_reached(self):
+        self.make_video('pinned.mp4', 800, pinned=True)
+        small = self.make_video('small.mp4', 150)
+
+        with self.assertRaises(InsufficientStorage):
+            quota.ensure_space(50)
+
+        self.assertEqual(Video.objects.get(pk=small.pk).status, 'completed')
+        self.assertTrue(os.path.exists(small.get_absolute_path()))
+
+    def test_hard_linked_files_count_once_and_are_not_evicted(self):
+        original = self.make_video('a.mp4', 400)
+        copy = Video.objects.create(title='copy', download_url='http://test.local/b.mp4', status='completed',
+                                    file_size=400, video_file='videos/b.mp4')
+        os.link(original.get_absolute_path(), copy.get_absolute_path())
+        other = self.make_video('c.mp4', 400)
+
+        self.assertEqual(quota.usage(), (800, 1000))
+        self.watched(original, 3)
+        self.watched(copy, 3)
+        self.watched(other, 1)
+        self.assertEqual(quota.ensure_space(200), [other])
+
+    def stage(self, video: Video, size: int):
+        os.makedirs(os.path.join(self.storage, 'staging', str(video.pk)), exist_ok=True)
+        with open(os.path.join(self.storage, 'staging', str(video.pk), 'movie.mp4.part'), 'wb') as f:
+            f.write(b'\0' * size)
+
+    def test_partial_downloads_count_as_used(self):
+        self.make_video('a.mp4', 300)
+        other = Video.objects.create(title='other', download_url='http://test.local/other.mp4')
+        self.stage(other, 200)
+        self.assertEqual(quota.usage(), (500, 1000))
+        self.assertEqual(quota.staged_bytes(other.pk), 200)
+
+    @mock.patch('videos.quota.QuotaManager.expected_size', return_value=600)
+    def test_resumed_download_reserves_only_what_is_left(self, expected_size):
+        kept = self.make_video('a.mp4', 300)
+        resumed = Video.objects.create(title='resumed', download_url='http://test.local/resumed.mp4')
+        self.stage(resumed, 500)
+
+        quota.preflight(resumed)  # 300 + 500 staged + 100 to go, right at high water
+        self.assertEqual(Video.objects.get(pk=kept.pk).status, 'completed')
+
+        # Another download's partial file pushes it over.
+        self.stage(Video.objects.create(title='other', download_url='http://test.local/other.mp4'), 100)
+        quota.preflight(resumed)
+        self.assertEqual(Video.objects.get(pk=kept.pk).status, 'pending')
+
+    def test_dry_run_deletes_nothing(self):
+        video = self.make_video('a.mp4', 950)
+        self.assertEqual(quota.ensure_space(dry_run=True), [video])
+        self.assertTrue(os.path.exists(video.get_absolute_path()))
+
+    @override_settings(STORAGE_QUOTA_BYTES=0)
+    def test_off_without_a_quota(self):
+        self.make_video('a.mp4', 5000)
+        self.assertFalse(quota.enabled)
+        self.assertEqual(quota.ensure_space(10 ** 12), [])
+
+
+@override_settings(HLS_ENABLED=False)
+class DownloadSaveTests(StorageTestCase):
+    def test_finishing_a_download_keeps_changes_made_meanwhile(self):
+        original = self.make_video('a.mp4', 100)
+        video = Video.objects.create(title='copy', download_url=original.download_url, status='downloading')
+        # While the download runs: pinned in the admin, played, renamed.
+        Video.objects.filter(pk=video.pk).update(pinned=True, bytes_served=42, title='Renamed')
+
+        self.assertTrue(video_manager._adopt_stored_file(video, original, 'test.local'))
+
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual(video.status, 'completed')
+        self.assertEqual(video.file_size, 100)
+        self.assertTrue(video.pinned)
+        self.assertEqual(video.bytes_served, 42)
+        self.assertEqual(video.title, 'Renamed')
+
+
+class PlaybackTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        # As django.test.Client does: the handler must not close the test's connection.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        playback.flush()
+
+    async def stream(self, video: Video, byte_range: str) -> dict:
+        client = ASGIClient(ZeroCopyASGIHandler())
+        try:
+            scope = http_scope(f'/video/{video.id}/stream/', headers=[('Range', byte_range)])
+            return await client.request(scope)
+        finally:
+            client.close()
+
+    @override_settings(PLAYBACK_FLUSH_SECONDS=0)
+    async def test_bytes_sent_are_saved_when_the_response_ends(self):
+        video = await sync_to_async(self.make_video)('a.mp4', 5000)
+        self.assertEqual((await self.stream(video, 'bytes=0-999'))['bytes'], 1000)
+
+        await video.arefresh_from_db()
+        self.assertEqual(video.bytes_served, 1000)
+        self.assertIsNotNone(video.last_played_at)
+        self.assertEqual(playback.pending, {})
+
+    @override_settings(PLAYBACK_FLUSH_SECONDS=3600)
+    async def test_plays_wait_in_memory_until_flushed(self):
+        video = await sync_to_async(self.make_video)('a.mp4', 5000)
+        await self.stream(video, 'bytes=0-99')
+        self.assertEqual((await Video.objects.aget(pk=video.pk)).bytes_served, 0)
+
+        await sync_to_async(playback.flush)()
+        self.assertEqual((await Video.objects.aget(pk=video.pk)).bytes_served, 100)
+
+
+
+class ZeroCopyTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        self.video = self.make_video('a.mp4', 5000)
+        self.path = self.video.get_absolute_path()
+
+    def test_mode_follows_the_advertised_extensions(self):
+        factory = RequestFactory()
+        cases = [
+            ({}, False, None),
+            ({PATHSEND: {}}, False, PATHSEND),
+            ({PATHSEND: {}}, True, None),
+            ({ZEROCOPYSEND: {}}, False, ZEROCOPYSEND),
+            ({ZEROCOPYSEND: {}}, True, ZEROCOPYSEND),
+            ({PATHSEND: {}, ZEROCOPYSEND: {}}, False, ZEROCOPYSEND),
+        ]
+        for extensions, partial, expected in cases:
+            with self.subTest(extensions=list(extensions), partial=partial):
+                request = factory.get('/')
+                request.scope = {'extensions': extensions}
+                self.assertEqual(zero_copy_mode(request, partial=partial), expected)
+                self.assertEqual(zero_copy_mode(request, paced=True), expected if expected != PATHSEND else None)
+        self.assertIsNone(zero_copy_mode(factory.get('/')))
+        request = factory.get('/')
+        request.scope = {'extensions': {ZEROCOPYSEND: {}}}
+        with self.settings(STREAM_ZERO_COPY=False):
+            self.assertIsNone(zero_copy_mode(request))
+
+    async def stream(self, extensions: dict, byte_range: str | None = None) -> list[dict]:
+        messages = []
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        done = asyncio.Event()
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        headers = [('Range', byte_range)] if byte_range else []
+        scope = http_scope(f'/video/{self.video.pk}/stream/', headers=headers, extensions=extensions)
+        try:
+            await ZeroCopyASGIHandler()(scope, receive, send)
+        finally:
+            done.set()
+        return messages
+
+    def body(self, messages: list[dict]) -> bytes:
+        self.assertEqual({m['type'] for m in messages[1:]}, {'http.response.body'})
+        return b''.join(m.get('body', b'') for m in messages[1:])
+
+    async def test_pathsend_sends_whole_files(self):
+        messages = await self.stream({PATHSEND: {}})
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(messages[1:], [{'type': PATHSEND, 'path': self.path}])
+
+        # A range can't go through pathsend: it falls back to the chunk reader.
+        messages = await self.stream({PATHSEND: {}}, 'bytes=100-199')
+        self.assertEqual(messages[0]['status'], 206)
+        self.assertEqual(self.body(messages), b'\0' * 100)
+
+    async def test_zerocopysend_sends_the_requested_range(self):
+        for byte_range, status, offset, count in [(None, 200, 0, 5000), ('bytes=100-199', 206, 100, 100)]:
+            with self.subTest(byte_range=byte_range):
+                messages = await self.stream({ZEROCOPYSEND: {}}, byte_range)
+                self.assertEqual(messages[0]['status'], status)
+                self.assertEqual(len(messages), 2)
+                self.assertEqual(messages[1]['type'], ZEROCOPYSEND)
+                self.assertEqual((messages[1]['offset'], messages[1]['count']), (offset, count))
+                self.assertEqual(messages[1]['file'].name, self.path)
+
+    async def test_no_extension_streams_the_body(self):
+        messages = await self.stream({})
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(len(self.body(messages)), 5000)
+        messages = await self.stream({}, 'bytes=-10')
+        self.assertEqual(messages[0]['status'], 206)
+        self.assertEqual(len(self.body(messages)), 10)
+
+class NormalizeUrlTests(TestCase):
+    def test_same_link_written_differently(self):
+        self.assertEqual(
+            normalize_url('HTTP://Example.COM:80/a/b.mp4?b=2&a=1&utm_source=x&fbclid=y#frag'),
+            'http://example.com/a/b.mp4?a=1&b=2',
+        )
+        self.assertEqual(normalize_url('https://example.com:443'), 'https://example.com/')
+        self.assertEqual(normalize_url('https://example.com/v.mp4?ref=home'), 'https://example.com/v.mp4')
+
+    def test_keeps_what_tells_files_apart(self):
+        self.assertEqual(normalize_url('http://example.com:8080/A.mp4'), 'http://example.com:8080/A.mp4')
+        for key in ('reference', 'refid', 'refresh_token', 'utm', 'id'):
+            self.assertNotEqual(normalize_url(f'http://example.com/get?{key}=1'),
+                                normalize_url(f'http://example.com/get?{key}=2'), key)
+
+
+@override_settings(IMPORT_BATCH_SIZE=2)
+class ImportTests(TestCase):
+    def test_skips_urls_already_in_the_library(self):
+        Video.objects.create(title='old', download_url='http://example.com/old.mp4')
+        report = import_videos([
+            'http://EXAMPLE.com/old.mp4?utm_source=mail',
+            'http://example.com/new.mp4 New one',
+            'http://example.com/old.mp4?reference=2',
+        ], download=False)
+
+        self.assertEqual(report.created, 2)
+        self.assertEqual(report.rejected, [(1, 'http://EXAMPLE.com/old.mp4?utm_source=mail', "already in the library")])
+        self.assertEqual(Video.objects.get(download_url='http://example.com/new.mp4').title, 'New one')
+
+    def test_skips_urls_repeated_in_the_list(self):
+        report = import_videos([
+            'url,title',
+            'http://example.com/a.mp4,First',
+            'http://example.com/b.mp4,Other',
+            'http://example.com/a.mp4#again,Second',
+            'not a url,Broken',
+        ], name='list.csv', download=False)
+
+        self.assertEqual(report.created, 2)
+        self.assertEqual(report.duplicates, 1)
+        self.assertEqual([(number, reason) for number, _, reason in report.rejected],
+                         [(4, "same URL as line 2"), (5, "not a valid http(s) URL")])
+        self.assertEqual(Video.objects.get(download_url='http://example.com/a.mp4').title, 'First')
+
+    def test_imported_videos_are_indexed_and_queued(self):
+        report = import_videos(['{"url": "http://example.com/a.mp4", "title": "Quiet Harbour"}'])
+        self.assertEqual((report.created, report.queued), (1, 1))
+        video = Video.objects.get()
+        self.assertEqual(video.status, 'downloading')
+        self.assertEqual(video.download_jobs.get().status, 'queued')
+        self.assertEqual(search('harbour'), [video.pk])
+
+
+class ImportParserTests(SimpleTestCase):
+    def test_detect_format(self):
+        self.assertEqual(detect_format('list.csv', 'http://a'), 'csv')
+        self.assertEqual(detect_format('list.ndjson', 'http://a'), 'jsonl')
+        self.assertEqual(detect_format('list.txt', '{"url": 1}'), 'text')
+        self.assertEqual(detect_format('', '{"url": "http://a"}'), 'jsonl')
+        self.assertEqual(detect_format('', 'http://a,Title'), 'csv')
+        self.assertEqual(detect_format('', 'http://a Title'), 'text')
+
+    def test_text(self):
+        rows = list(text_rows(['# my list', '', 'http://a.test/1.mp4  First film ', 'http://a.test/2.mp4']))
+        self.assertEqual(rows, [
+            (3, {'url': 'http://a.test/1.mp4', 'title': 'First film'}, None),
+            (4, {'url': 'http://a.test/2.mp4', 'title': ''}, None),
+        ])
+
+    def test_csv(self):
+        rows = list(csv_rows(['http://a.test/1.mp4,"Film, one",About it', ',,']))
+        self.assertEqual(rows, [
+            (1, {'url': 'http://a.test/1.mp4', 'title': 'Film, one', 'description': 'About it'}, None),
+        ])
+        rows = list(csv_rows(['Title,Download_URL', 'Two,http://a.test/2.mp4']))
+        self.assertEqual(rows, [(2, {'title': 'Two', 'download_url': 'http://a.test/2.mp4',
+                                     'url': 'http://a.test/2.mp4'}, None)])
+
+    def test_jsonl(self):
+        rows = list(jsonl_rows([
+            '{"download_url": "http://a.test/1.mp4", "title": "One"}',
+            '"http://a.test/2.mp4"',
+            '{"url": ',
+            '[1, 2]',
+        ]))
+        self.assertEqual(rows[0], (1, {'download_url': 'http://a.test/1.mp4', 'title': 'One',
+                                       'url': 'http://a.test/1.mp4'}, None))
+        self.assertEqual(rows[1], (2, {'url': 'http://a.test/2.mp4'}, None))
+        self.assertEqual(rows[2][0], 3)
+        self.assertTrue(rows[2][2].startswith('not JSON'))
+        self.assertEqual(rows[3], (4, '[1, 2]', 'not a JSON object'))
+
+    def test_rejected_rows(self):
+        report = import_videos([
+            '{"url": "ftp://a.test/1.mp4"}',
+            '{"title": "no url"}',
+            '{"url": "http://a.test/' + 'x' * 2000 + '"}',
+            'oops',
+        ], format='jsonl', download=False)
+        self.assertEqual((report.rows, report.created), (4, 0))
+        reasons = [reason for _, _, reason in report.rejected]
+        self.assertEqual(reasons[:3], ["not a valid http(s) URL"] * 3)
+        self.assertTrue(reasons[3].startswith('not JSON'))
+
+
+class ImportViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('staff', password='password', is_staff=True)
+        self.user.user_permissions.add(Permission.objects.get(codename='view_video'))
+        self.client.force_login(self.user)
+
+    def upload(self, content: str, name: str = 'list.txt'):
+        return self.client.post('/admin/videos/video/import/', {
+            'file': SimpleUploadedFile(name, content.encode()),
+            'format': '',
+            'download': '',
+        })
+
+    def test_needs_add_permission(self):
+        self.assertEqual(self.client.get('/admin/videos/video/import/').status_code, 403)
+        self.assertEqual(self.upload('http://a.test/1.mp4').status_code, 403)
+        self.assertFalse(Video.objects.exists())
+        self.assertNotContains(self.client.get('/admin/videos/video/'), 'Import list')
+
+    def test_imports_an_upload(self):
+        self.user.user_permissions.add(Permission.objects.get(codename='add_video'))
+        Video.objects.create(title='old', download_url='http://a.test/old.mp4')
+        self.assertContains(self.client.get('/admin/videos/video/'), 'Import list')
+        self.assertEqual(self.client.get('/admin/videos/video/import/').status_code, 200)
+
+        response = self.upload('url,title\nhttp://a.test/new.mp4,New\nhttp://a.test/old.mp4,Again\n', 'list.csv')
+        self.assertRedirects(response, '/admin/videos/video/', fetch_redirect_response=False)
+        self.assertEqual(Video.objects.get(download_url='http://a.test/new.mp4').status, 'pending')
+        self.assertEqual(Video.objects.count(), 2)
+        messages = [str(message) for message in response.wsgi_request._messages]
+        self.assertTrue(messages[0].startswith('Imported 1 videos (0 queued) from 2 rows'))
+        self.assertEqual(messages[1], 'Line 3: already in the library: http://a.test/old.mp4')
+
+
+class LibraryStatsTests(StorageTestCase):
+    def assertStatsMatchVideos(self):
+        counted = {status: entry for status, entry in LibraryStats.totals()['by_status'].items() if entry['videos']}
+        actual = {
+            row['status']: {'videos': row['videos'], 'total_size': row['total_size']}
+            for row in Video.objects.order_by().values('status').annotate(videos=Count('pk'), total_size=Sum('file_size'))
+        }
+        self.assertEqual(counted, actual)
+
+    def test_create_save_and_delete(self):
+        video = self.make_video('a.mp4', 300)
+        Video.objects.create(title='b', download_url='http://test.local/b.mp4')
+        self.assertStatsMatchVideos()
+
+        video.status = 'error'
+        video.file_size = 100
+        video.save()
+        self.assertStatsMatchVideos()
+        Video.set_status(video.pk, 'pending')
+        self.assertStatsMatchVideos()
+
+        Video.objects.get(pk=video.pk).delete()
+        self.assertStatsMatchVideos()
+
+    def test_bulk_enqueue(self):
+        videos = [Video.objects.create(title=str(i), download_url=f'http://test.local/{i}.mp4', status=status)
+                  for i, status in enumerate(('pending', 'error', 'completed', 'pending'))]
+        self.assertEqual(video_manager.download_videos([video.pk for video in videos]), 3)
+        self.assertStatsMatchVideos()
+        self.assertEqual(video_manager.download_videos([video.pk for video in videos]), 0)
+        self.assertStatsMatchVideos()
+
+    def test_import(self):
+        import_videos([f'http://test.local/{i}.mp4' for i in range(5)], download=False)
+        import_videos([f'http://test.local/{i}.mp4' for i in range(3, 8)])
+        self.assertStatsMatchVideos()
+
+    def test_admin_delete_files(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@test.local', 'password'))
+        videos = [self.make_video('a.mp4', 300), self.make_video('b.mp4', 500)]
+        self.client.post('/admin/videos/video/', {
+            'action': 'delete_files_selected',
+            '_selected_action': [str(video.pk) for video in videos],
+        })
+        self.assertEqual(set(Video.objects.values_list('status', 'file_size')), {('pending', 0)})
+        self.assertStatsMatchVideos()
+
+
+@override_settings(VIDEO_LIST_PAGE_SIZE=2)
+class ListPageTests(TestCase):
+    def setUp(self):
+        for i in range(6):
+            Video.objects.create(title=f'video {i}', download_url=f'http://test.local/{i}.mp4',
+                                 status='completed' if i % 2 else 'pending')
+
+    def test_later_pages_keep_the_status_filter(self):
+        response = self.client.get('/', {'status': 'completed'})
+        self.assertContains(response, 'data-page-url="/api/videos/?status=completed"')
+        self.assertEqual({video.status for video in response.context['videos']}, {'completed'})
+
+        page = self.client.get('/api/videos/', {'status': 'completed', 'after': response.context['next_cursor']}).json()
+        self.assertEqual([video['status'] for video in page['videos']], ['completed'])
+        self.assertIsNone(page['next'])
+
+    def test_unfiltered_pages_cover_the_library(self):
+        titles, after = [], ''
+        while True:
+            page = self.client.get('/api/videos/', {'status': '', 'after': after}).json()
+            titles += [video['title'] for video in page['videos']]
+            if not page['next']:
+                break
+            after = page['next']
+        self.assertEqual(sorted(titles), [f'video {i}' for i in range(6)])
+
+
+@override_settings(DOWNLOAD_SEGMENTS=4, DOWNLOAD_SEGMENT_MIN_SIZE=1, PROGRESSIVE_STREAMING=False,
+                   HLS_ENABLED=False, DOWNLOAD_DEDUPE=False)
+@mock.patch('videos.segmented.time.sleep')
+class DownloadTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = tempfile.mkdtemp(prefix='streamer-origin-')
+        self.addCleanup(shutil.rmtree, self.files, ignore_errors=True)
+        self.data = os.urandom(4 * 1024 * 1024 + 123)
+        with open(os.path.join(self.files, 'movie.mp4'), 'wb') as f:
+            f.write(self.data)
+
+    def download(self, origin: Origin) -> Video:
+        video = Video.objects.create(title='movie', download_url=origin.url('movie.mp4'), status='downloading')
+        self.assertTrue(video_manager._download_thread(video))
+        return Video.objects.get(pk=video.pk)
+
+    def assertStored(self, video: Video):
+        self.assertEqual(video.status, 'completed')
+        with open(video.get_absolute_path(), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(video.file_size, len(self.data))
+        self.assertEqual(video.source_checksum, hashlib.sha256(self.data).hexdigest())
+
+    def test_segmented(self, sleep):
+        with Origin(self.files) as origin:
+            video = self.download(origin)
+        self.assertStored(video)
+        # The range probe, the segments, then the single stream's resume finding nothing left (416).
+        self.assertEqual(origin.requests, 1 + 4 + 1)
+        self.assertEqual(os.listdir(os.path.join(self.storage, 'staging')), [])
+
+    def test_single_stream_without_ranges_or_length(self, sleep):
+        with Origin(self.files, ranges=False, content_length=False) as origin:
+            video = self.download(origin)
+        self.assertStored(video)
+        self.assertEqual(origin.requests, 2)
+
+    def test_failed_and_cut_off_segments_are_retried(self, sleep):
+        # Request 1 is the range probe: one segment gets a 503, another is cut off.
+        with Origin(self.files, fail_requests={2}, drop_requests={3}, seed=1) as origin:
+            video = self.download(origin)
+        self.assertStored(video)
+        self.assertEqual(origin.requests, 1 + 4 + 2 + 1)
+
+    @override_settings(PROGRESSIVE_STREAMING=True, PROGRESSIVE_PROBE_BYTES=1)
+    @mock.patch('videos.segmented.CHUNK_SIZE', 64 * 1024)
+    def test_segments_probe_for_progressive_streaming_once(self, sleep):
+        probes = []
+
+        def probe(path):
+            probes.append(path)
+            threading.Event().wait(0.05)  # long enough for the other segments to catch up
+            return None
+
+        with mock.patch('videos.manager.probe', probe), Origin(self.files) as origin:
+            video = self.download(origin)
+        self.assertStored(video)
+        # Once while the segments come in, once more for the conversion plan.
+        self.assertEqual([path.endswith('.part') for path in probes], [True, False])
+
+    @mock.patch('videos.segmented.CHUNK_SIZE', 64 * 1024)
+    @mock.patch('videos.segmented.STATE_SAVE_SECONDS', 0)
+    def test_restart_resumes_segments(self, sleep):
+        path = os.path.join(self.storage, 'movie.part')
+        cancel = threading.Event()
+        written = []
+
+        def on_bytes(amount):
+            written.append(amount)
+            if sum(written) >= 1024 * 1024:
+                cancel.set()
+
+        with Origin(self.files, bandwidth=4 * 1024 * 1024) as origin:
+            with self.assertRaises(Exception):
+                SegmentedDownloader(origin.url('movie.mp4'), path, segments=4, cancel_event=cancel,
+                                    on_bytes=on_bytes).run()
+            self.assertTrue(os.path.exists(path + STATE_SUFFIX))
+            first_run = origin.bytes_sent
+
+            SegmentedDownloader(origin.url('movie.mp4'), path, segments=4).run()
+            second_run = origin.bytes_sent - first_run
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(path + STATE_SUFFIX))
+        self.assertLess(second_run, len(self.data) - 512 * 1024)
+
+
+@override_settings(PROGRESSIVE_STREAMING=True, PROGRESSIVE_POLL_SECONDS=0.01, PROGRESSIVE_WAIT_SECONDS=30,
+                   STREAM_SCHEDULING=False)
+class GrowingStreamTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.video = Video.objects.create(title='movie', download_url='http://test.local/movie.mp4',
+                                          status='downloading')
+        self.path = os.path.join(self.storage, 'movie.mp4')
+        self.data = os.urandom(3000)
+        self.written = 0
+        progress.start(self.video.pk)
+        self.addCleanup(progress.finish, self.video.pk)
+
+    async def write(self, end: int, size: int = 0):
+        with open(self.path, 'ab') as f:
+            f.write(self.data[self.written:end])
+        self.written = end
+        await sync_to_async(progress.publish_stream)(self.video.pk, self.path, end, size)
+
+    async def get(self, **headers):
+        return await stream_in_flight(AsyncRequestFactory().get('/', headers=headers), self.video)
+
+    async def read(self, response, writes) -> bytes:
+        """The whole body, making the next of ``writes`` each time the reader catches up."""
+        writes = list(writes)
+        received = b''
+        async for chunk in response.streaming_content:
+            received += chunk
+            if writes and len(received) >= self.written:
+                await self.write(*writes.pop(0))
+        return received
+
+    async def test_stream_ends_when_the_final_size_is_published(self):
+        await self.write(1000)
+        response = await self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Length'))
+
+        # Well within PROGRESSIVE_WAIT_SECONDS: the stream ends on the final size, not a timeout.
+        body = await asyncio.wait_for(self.read(response, [(2000,), (3000, 3000)]), timeout=5)
+        self.assertEqual(body, self.data)
+
+    async def test_range_past_the_written_bytes_waits_for_them(self):
+        await self.write(1000, 3000)
+        response = await self.get(range='bytes=2000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2000-2999/3000')
+
+        async def writer():
+            await asyncio.sleep(0.05)
+            await self.write(2500, 3000)
+            await asyncio.sleep(0.05)
+            await self.write(3000, 3000)
+
+        task = asyncio.ensure_future(writer())
+        body = await asyncio.wait_for(self.read(response, []), timeout=5)
+        await task
+        self.assertEqual(body, self.data[2000:])
+
+    async def test_not_playable_before_anything_is_published(self):
+        response = await self.get()
+        self.assertEqual(response.status_code, 404)
+
+
+class DescriptorCacheTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        descriptors.clear()
+        self.addCleanup(descriptors.clear)
+        self.video = self.make_video('a.mp4', 100)
+        self.clock = FakeClock()
+        patcher = mock.patch('videos.descriptors.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def descriptor(self) -> StreamDescriptor:
+        return StreamDescriptor.from_path(self.video.get_absolute_path(), cacheable=True)
+
+    def rewrite(self, size: int):
+        with open(self.video.get_absolute_path(), 'wb') as f:
+            f.write(b'\1' * size)
+
+    @override_settings(STREAM_DESCRIPTOR_CACHE_SIZE=2)
+    def test_least_recently_used_is_dropped(self):
+        cache = DescriptorCache()
+        first, second, third = self.descriptor(), self.descriptor(), self.descriptor()
+        cache.put('a', first)
+        cache.put('b', second)
+        self.assertIs(cache.get('a'), first)
+        cache.put('c', third)
+        self.assertIsNone(cache.get('b'))
+        self.assertIs(cache.get('a'), first)
+        self.assertIs(cache.get('c'), third)
+
+    def test_dropped_when_the_video_is_saved_or_deleted(self):
+        descriptors.put(self.video.pk, self.descriptor())
+        self.video.title = 'renamed'
+        self.video.save()
+        self.assertIsNone(descriptors.get(self.video.pk))
+
+        descriptors.put(self.video.pk, self.descriptor())
+        self.video.delete()
+        self.assertIsNone(descriptors.get(self.video.pk))
+
+    @override_settings(STREAM_DESCRIPTOR_REVALIDATE_SECONDS=5)
+    def test_revalidated_on_disk_after_a_while(self):
+        descriptor = self.descriptor()
+        self.clock.advance(6)
+        self.assertTrue(descriptor.still_valid())
+
+        # Within the window the file isn't looked at.
+        self.rewrite(200)
+        self.clock.advance(4)
+        self.assertTrue(descriptor.still_valid())
+        self.clock.advance(2)
+        self.assertFalse(descriptor.still_valid())
+
+        descriptor = self.descriptor()
+        os.remove(self.video.get_absolute_path())
+        self.clock.advance(6)
+        self.assertFalse(descriptor.still_valid())
+
+    async def stream(self) -> tuple[str, bytes]:
+        response = await self.async_client.get(f'/video/{self.video.pk}/stream/')
+        return response['ETag'], b''.join([chunk async for chunk in response.streaming_content])
+
+    @override_settings(STREAM_DESCRIPTOR_REVALIDATE_SECONDS=5)
+    async def test_stream_serves_the_new_file(self):
+        etag, body = await self.stream()
+        self.assertEqual(body, b'\0' * 100)
+        self.assertIsNotNone(descriptors.get(self.video.pk))
+
+        # Rewritten in place, same size: the mtime gives it away once revalidated.
+        self.rewrite(100)
+        os.utime(self.video.get_absolute_path(), ns=(10 ** 9, 10 ** 9))
+        self.assertEqual((await self.stream())[0], etag)
+        self.clock.advance(6)
+        new_etag, body = await self.stream()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(body, b'\1' * 100)
+
+        # Another file for the video: the save drops the cached one straight away.
+        with open(os.path.join(self.storage, 'videos', 'b.mp4'), 'wb') as f:
+            f.write(b'\2' * 50)
+        self.video.video_file.name = 'videos/b.mp4'
+        await sync_to_async(self.video.save)()
+        self.assertEqual((await self.stream())[1], b'\2' * 50)
+
+
+class HLSTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.video = Video.objects.create(title='movie', download_url='http://test.local/movie.mp4',
+                                          status='completed', hls_renditions=[{'name': '360p'}])
+        rendition = os.path.join(self.storage, 'hls', str(self.video.pk), '360p')
+        os.makedirs(rendition)
+        for name in ('index.m3u8', 'segment_00000.ts'):
+            with open(os.path.join(rendition, name), 'w') as f:
+                f.write(name)
+        # Files a crafted name could reach if it got past the checks.
+        with open(os.path.join(self.storage, 'hls', str(self.video.pk), 'secret.ts'), 'w') as f:
+            f.write('secret')
+        with open(os.path.join(self.storage, 'secret.ts'), 'w') as f:
+            f.write('secret')
+
+    def get(self, path: str):
+        return self.client.get(f'/video/{self.video.pk}/hls/{path}')
+
+    def test_rendition_files(self):
+        self.assertEqual(self.get('360p/index.m3u8').status_code, 200)
+        self.assertEqual(self.get('360p/segment_00000.ts').status_code, 200)
+        self.assertEqual(self.get('360p/missing.ts').status_code, 404)
+        self.assertEqual(self.get('720p/index.m3u8').status_code, 404)
+
+    def test_traversal_is_refused(self):
+        for path in ('360p/../secret.ts', '360p/..%2Fsecret.ts', '360p/..%2F..%2F..%2Fsecret.ts',
+                     '../360p/index.m3u8', '..%2F360p/index.m3u8', '360p/segment_00000.ts/../../',
+                     '360p/.ts', '360p/index.m3u8%0A', '360p/index.m3u8%00', '360p/secret.mp4'):
+            with self.subTest(path):
+                self.assertEqual(self.get(path).status_code, 404)
+
+    def test_file_name_pattern(self):
+        for name in ('index.m3u8', 'segment_00001.ts'):
+            self.assertTrue(HLS_FILE_RE.match(name), name)
+        for name in ('../x.ts', 'a/b.ts', 'x.ts\n', '.ts', 'x.ts.mp4', 'x.TS', ''):
+            self.assertFalse(HLS_FILE_RE.match(name), name)
+
+    def test_ladder_never_goes_above_the_source(self):
+        def heights(source_height):
+            info = None if source_height is None else ffprobe_json(MP4, {'height': source_height})
+            return [rendition['height'] for rendition in ladder_for(info)]
+
+        self.assertEqual(heights(1080), [360, 480, 720])
+        self.assertEqual(heights(720), [360, 480, 720])
+        self.assertEqual(heights(600), [360, 480])
+        self.assertEqual(heights(240), [360])  # too small for any: the smallest still gets made
+        self.assertEqual(heights(None), [360, 480, 720])
+
+    def test_master_playlist(self):
+        renditions = [
+            {'name': '720p', 'width': 1280, 'height': 720, 'bandwidth': 2890800, 'codecs': 'avc1.4d401f,mp4a.40.2'},
+            {'name': '360p', 'width': 640, 'height': 360, 'bandwidth': 875600, 'codecs': 'avc1.42e01e,mp4a.40.2'},
+        ]
+        self.assertEqual(master_playlist(renditions, lambda name: f'/hls/{name}/index.m3u8'), (
+            '#EXTM3U\n'
+            '#EXT-X-VERSION:3\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=875600,RESOLUTION=640x360,CODECS="avc1.42e01e,mp4a.40.2"\n'
+            '/hls/360p/index.m3u8\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=2890800,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"\n'
+            '/hls/720p/index.m3u8\n'
+        ))
+
+
+class AdminSearchTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@test.local', 'password'))
+        Video.objects.create(title='Winter Garden', download_url='http://mirror-one.test/films/a.mp4')
+        Video.objects.create(title='Summer Road', description='garden party',
+                             download_url='http://mirror-two.test/films/b.mp4')
+
+    def search(self, term: str) -> set:
+        response = self.client.get('/admin/videos/video/', {'q': term})
+        return {video.title for video in response.context['cl'].result_list}
+
+    def test_words_match_titles_and_descriptions(self):
+        self.assertEqual(self.search('garden'), {'Winter Garden', 'Summer Road'})
+        self.assertEqual(self.search('wint'), {'Winter Garden'})
+
+    def test_hosts_and_url_fragments_still_match(self):
+        self.assertEqual(self.search('mirror-two'), {'Summer Road'})
+        self.assertEqual(self.search('films/a.mp4'), {'Winter Garden'})
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        # Metrics made here go into their own registry, not the one /metrics serves.
+        self.registry = Registry()
+        patcher = mock.patch('videos.metrics.registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counters_and_gauges(self):
+        requests = Counter('test_requests_total', "Requests served", ['path'])
+        requests.inc(path='/a "quoted"\\path\nnext')
+        requests.inc(2, path='/b')
+        Gauge('test_queue_depth', "Jobs waiting", collect=lambda: 3)
+        self.assertEqual(self.registry.render(), (
+            '# HELP test_requests_total Requests served\n'
+            '# TYPE test_requests_total counter\n'
+            'test_requests_total{path="/a \\"quoted\\"\\\\path\\nnext"} 1\n'
+            'test_requests_total{path="/b"} 2\n'
+            '# HELP test_queue_depth Jobs waiting\n'
+            '# TYPE test_queue_depth gauge\n'
+            'test_queue_depth 3\n'
+        ))
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = Histogram('test_seconds', "Latency", ['mode'], buckets=(1, 0.5))
+        for value in (0.2, 0.5, 0.7, 3):
+            latency.observe(value, mode='x')
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'test_seconds_bucket{mode="x",le="0.5"} 2',
+            'test_seconds_bucket{mode="x",le="1.0"} 3',
+            'test_seconds_bucket{mode="x",le="+Inf"} 4',
+            'test_seconds_sum{mode="x"} 4.4',
+            'test_seconds_count{mode="x"} 4',
+        ])
@@ -0,0 +1,212 @@
+import os
+import time
+import heapq
+import shutil
+import logging
+import itertools
+import threading
+import subprocess
+from collections import deque
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeCancelled(Exception):
+    pass
+
+
+class TranscodeJob:
+    def __init__(self, key, command, priority, on_stdout=None, on_stderr=None, kind='transcode'):
+        self.key = key
+        self.command = command
+        self.priority = priority
+        self.kind = kind
+        self.on_stdout = on_stdout
+        self.on_stderr = on_stderr
+        self.state = 'queued'
+        self.process = None
+        self.returncode = None
+        self.stderr_tail = deque(maxlen=50)
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def wait(self, timeout=None) -> bool:
+        return self.done.wait(timeout)
+
+    @property
+    def stderr(self) -> str:
+        return ''.join(self.stderr_tail)
+
+
+class TranscodeScheduler:
+    """
+    Runs ffmpeg jobs for the whole process: at most TRANSCODE_MAX_JOBS at a
+    time, each limited to TRANSCODE_THREADS encoder threads and started under
+    nice/ionice so encoding can't starve the web process serving streams.
+    Waiting jobs are taken highest priority first, then in submission order.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.threads = []
+
+    def _ensure_workers(self):
+        while len(self.threads) < settings.TRANSCODE_MAX_JOBS:
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name=f'transcode-worker-{len(self.threads)}',
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, command: list[str], priority: int = 0, on_stdout=None, on_stderr=None,
+               kind: str = 'transcode') -> TranscodeJob:
+        job = TranscodeJob(key, command, priority, on_stdout, on_stderr, kind)
+        with self.available:
+            self._ensure_workers()
+            self.jobs[key] = job
+            heapq.heappush(self.heap, (-priority, next(self.counter), job))
+            self.available.notify()
+        logger.info(f"Transcode queued for {key} (priority {priority}, {self.queue_length()} waiting)")
+        return job
+
+    def run(self, key, command: list[str], priority: int = 0, on_stdout=None, on_stderr=None, cancel_event=None,
+            kind: str = 'transcode') -> TranscodeJob:
+        """Submit a job and block until it finishes; cancel it if ``cancel_event`` is set meanwhile."""
+        job = self.submit(key, command, priority, on_stdout, on_stderr, kind)
+        while not job.wait(1.0):
+            if cancel_event is not None and cancel_event.is_set():
+                self.cancel(key)
+        if job.cancelled:
+            raise TranscodeCancelled(key)
+        return job
+
+    def cancel(self, key) -> bool:
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return False
+            job.cancelled = True
+            process = job.process
+            if job.state == 'queued':
+                # Dropped lazily when a worker pops it.
+                job.state = 'cancelled'
+                job.done.set()
+                self.jobs.pop(key, None)
+        if process is not None and process.poll() is None:
+            logger.info(f"Cancelling transcode for {key}")
+            process.kill()
+        return True
+
+    def queue_length(self) -> int:
+        return sum(1 for _, _, job in self.heap if job.state == 'queued')
+
+    def status(self, key) -> dict | None:
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return None
+            info = {'state': job.state, 'priority': job.priority}
+            if job.state == 'queued':
+                waiting = sorted(entry for entry in self.heap if entry[2].state == 'queued')
+                info['position'] = next(i for i, entry in enumerate(waiting) if entry[2] is job) + 1
+            return info
+
+    def _worker_loop(self):
+        while True:
+            with self.available:
+                while not self.heap:
+                    self.available.wait()
+                _, _, job = heapq.heappop(self.heap)
+                if job.state != 'queued':
+                    continue
+                job.state = 'running'
+            try:
+                self._execute(job)
+            except Exception as e:
+                logger.error(f"Transcode for {job.key} failed to run: {e}")
+                job.stderr_tail.append(str(e))
+                job.returncode = -1
+            finally:
+                with self.lock:
+                    job.state = 'cancelled' if job.cancelled else 'done'
+                    if self.jobs.get(job.key) is job:
+                        del self.jobs[job.key]
+                job.done.set()
+
+    def _execute(self, job):
+        command = self._budgeted(job.command)
+        started = time.monotonic()
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors='replace',
+        )
+        with self.lock:
+            job.process = process
+            cancelled = job.cancelled
+        if cancelled:
+            process.kill()
+
+        def read_stderr():
+            for line in process.stderr:
+                job.stderr_tail.append(line)
+                if job.on_stderr is not None:
+                    job.on_stderr(line)
+
+        stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+        stderr_reader.start()
+        for line in process.stdout:
+            if job.on_stdout is not None:
+                job.on_stdout(line)
+        job.returncode, usage = reap(process)
+        stderr_reader.join()
+
+        metrics.ffmpeg_wall_seconds.observe(time.monotonic() - started, kind=job.kind)
+        if usage is not None:
+            metrics.ffmpeg_cpu_seconds.observe(usage.ru_utime + usage.ru_stime, kind=job.kind)
+        result = 'cancelled' if job.cancelled else 'ok' if job.returncode == 0 else 'failed'
+        metrics.ffmpeg_jobs.inc(kind=job.kind, result=result)
+
+    def _budgeted(self, command: list[str]) -> list[str]:
+        """Add the per-job thread limit and run under nice/ionice where available."""
+        command = list(command)
+        if command and os.path.basename(command[0]).startswith('ffmpeg') and settings.TRANSCODE_THREADS:
+            # As an output option, right before the output file, it caps the encoder.
+            command[-1:-1] = ['-threads', str(settings.TRANSCODE_THREADS)]
+        prefix = []
+        if os.name == 'posix':
+            if settings.TRANSCODE_IONICE_CLASS is not None and shutil.which('ionice'):
+                prefix += ['ionice', '-c', str(settings.TRANSCODE_IONICE_CLASS)]
+                if settings.TRANSCODE_IONICE_CLASS == 2:
+                    prefix += ['-n', str(settings.TRANSCODE_IONICE_LEVEL)]
+            if settings.TRANSCODE_NICE and shutil.which('nice'):
+                prefix += ['nice', '-n', str(settings.TRANSCODE_NICE)]
+        return prefix + command
+
+
+def reap(process: subprocess.Popen):
+    """
+    Wait for ``process``; returns its exit code and its resource usage (None
+    where wait4 isn't available). nice/ionice exec ffmpeg, so it's ffmpeg's.
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped by a poll() from cancel().
+        return process.wait(), None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+scheduler = TranscodeScheduler()
@@ -5,8 +5,17 @@ from . import views
 
 urlpatterns = [
     path('', views.video_list, name='video_list'),
+    path('api/videos/', views.video_list_api, name='video_list_api'),
+    path('api/stats/', views.library_stats, name='library_stats'),
+    path('api/search/', views.search_videos, name='search_videos'),
+    path('api/streams/', views.stream_rates, name='stream_rates'),
+    path('metrics', views.metrics_view, name='metrics'),
     path('video/<uuid:video_id>/', views.video_detail, name='video_detail'),
     path('video/<uuid:video_id>/stream/', views.stream_video, name='stream_video'),
+    path('video/<uuid:video_id>/thumbnail/', views.video_thumbnail, name='video_thumbnail'),
+    path('video/<uuid:video_id>/sprite/', views.video_sprite, name='video_sprite'),
+    path('video/<uuid:video_id>/hls/master.m3u8', views.hls_master, name='hls_master'),
+    path('video/<uuid:video_id>/hls/<str:rendition>/<str:filename>', views.hls_file, name='hls_file'),
     path('video/<uuid:video_id>/delete/', 
         views.delete_video, 
         name='delete_video'),
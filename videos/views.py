@@ -1,35 +1,142 @@
 import os
+import uuid
 import asyncio
-import aiofiles
 import mimetypes
 from django.conf import settings
-from django.db.models import Sum
+from django.db.models import Q
 from django.contrib import messages
 from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
+from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.http import StreamingHttpResponse, HttpResponse, HttpRequest, JsonResponse
-from .models import Video
+from .models import Video, LibraryStats
 from .manager import video_manager
+from .bandwidth import governor
+from .progress import progress
+from .playback import playback
+from .descriptors import StreamDescriptor, descriptors
+from .search import search
+from .hls import HLS_FILE_RE, hls_dir, master_playlist
+from . import metrics
+from .pacing import PLAYBACK, DOWNLOAD, stream_scheduler
+from .ranges import RangeNotSatisfiable, if_range_passes, parse_range_header
+from .streaming import FileStreamResponse, GrowingFileResponse, MultipartRangeResponse, zero_copy_mode
+
+
+# What list.html and video_card.html use; the rest of the row stays in the database.
+LIST_FIELDS = (
+    'id', 'title', 'status', 'duration', 'file_size', 'thumbnail',
+    'progressive_path', 'hls_renditions', 'created_at',
+)
 
 
 async def a_path_exists(path: str) -> bool:
     return await sync_to_async(os.path.exists)(path)
 
+def set_no_cache_headers(response: HttpResponse):
+    response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response['Pragma'] = 'no-cache'
+    response['Expires'] = '0'
+
+def set_stream_cache_headers(response: HttpResponse, cacheable: bool, etag: str, last_modified: int):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if cacheable:
+        # Proxies may keep a copy, but the URL outlives the file (deleted files,
+        # quota eviction, re-download, re-transcode): revalidate with the ETag.
+        if settings.STREAM_CACHE_MAX_AGE:
+            patch_cache_control(response, public=True, max_age=settings.STREAM_CACHE_MAX_AGE)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+    else:
+        set_no_cache_headers(response)
+
+def encode_cursor(video: Video) -> str:
+    return f"{video.created_at.isoformat()}_{video.id}"
+
+def decode_cursor(cursor: str) -> tuple | None:
+    created_at, _, video_id = cursor.rpartition('_')
+    try:
+        return parse_datetime(created_at), uuid.UUID(video_id)
+    except ValueError:
+        return None
+
+async def video_page(request: HttpRequest) -> tuple[list[Video], str | None]:
+    """
+    One page of the library, newest first, continuing after the ``after``
+    cursor (created_at + id of the last card shown) instead of an OFFSET.
+    """
+    videos = Video.objects.only(*LIST_FIELDS).order_by('-created_at', '-id')
+    status = request.GET.get('status')
+    if status in dict(Video.STATUS_CHOICES):
+        videos = videos.filter(status=status)
+    cursor = decode_cursor(request.GET.get('after', ''))
+    if cursor and cursor[0]:
+        created_at, video_id = cursor
+        videos = videos.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=video_id))
+
+    page_size = settings.VIDEO_LIST_PAGE_SIZE
+    page = [video async for video in videos[:page_size + 1]]
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size], next_cursor
+
 async def video_list(request: HttpRequest) -> HttpResponse:
-    videos = Video.objects.all().order_by('-created_at')
-    total_videos = await videos.acount()
-    completed_videos = await videos.filter(status='completed').acount()
-    total_size_task = await videos.aaggregate(total=Sum('file_size'))
-    videos = [video async for video in videos]
+    videos, next_cursor = await video_page(request)
+    totals = await sync_to_async(LibraryStats.totals)()
     context = {
         'videos': videos,
-        'total_videos': total_videos,
-        'completed_videos': completed_videos,
-        'total_size': total_size_task['total'] or 0,
+        'next_cursor': next_cursor,
+        # Later pages are fetched from the API with the same filter.
+        'status': request.GET.get('status', ''),
+        'total_videos': totals['total_videos'],
+        'completed_videos': totals['completed_videos'],
+        'total_size': totals['total_size'] or 0,
         'user': await request.auser()
     }
     return render(request, './list.html', context)
 
+async def library_stats(request: HttpRequest) -> JsonResponse:
+    return JsonResponse(await sync_to_async(LibraryStats.totals)())
+
+async def video_list_api(request: HttpRequest) -> JsonResponse:
+    """The next page of cards for the list page to append as the user scrolls."""
+    videos, next_cursor = await video_page(request)
+    return JsonResponse({
+        'videos': [card_json(video) for video in videos],
+        'next': next_cursor,
+    })
+
+async def search_videos(request: HttpRequest) -> JsonResponse:
+    """Best matches for ``q`` over titles and descriptions, as cards for the list page."""
+    query = request.GET.get('q', '').strip()[:200]
+    ids = await sync_to_async(search)(query, settings.SEARCH_RESULTS_LIMIT)
+    videos = Video.objects.only(*LIST_FIELDS)
+    if ids is None:
+        # No FTS5 in this SQLite build.
+        matches = videos.filter(Q(title__icontains=query) | Q(description__icontains=query))
+        results = [video async for video in matches[:settings.SEARCH_RESULTS_LIMIT]] if query else []
+    else:
+        found = {video.pk: video async for video in videos.filter(pk__in=ids)}
+        results = [found[pk] for pk in ids if pk in found]
+    return JsonResponse({
+        'query': query,
+        'videos': [card_json(video) for video in results],
+    })
+
+def card_json(video: Video) -> dict:
+    return {
+        'id': str(video.id),
+        'title': video.title,
+        'status': video.status,
+        'duration': video.duration,
+        'file_size': video.file_size,
+        'html': render_to_string('video_card.html', {'video': video}),
+    }
+
 async def video_detail(request: HttpRequest, video_id: int) -> JsonResponse:
     try:
         video = await Video.objects.aget(id=video_id)
@@ -39,41 +146,129 @@ async def video_detail(request: HttpRequest, video_id: int) -> JsonResponse:
         'id': video.id or '', 
         'title': video.title or '',
         'description': video.description or '',
+        'duration': video.duration,
+        'thumbnail': reverse('video_thumbnail', args=[video.id]) if video.thumbnail else None,
+        'sprite': reverse('video_sprite', args=[video.id]) if video.sprite else None,
+        'sprite_info': video.sprite_info,
     })
-async def stream_video(request: HttpRequest, video_id: int) -> HttpResponse | StreamingHttpResponse:
+
+async def video_thumbnail(request: HttpRequest, video_id: int) -> HttpResponse | StreamingHttpResponse:
+    return await serve_image(video_id, 'thumbnail', request)
+
+async def video_sprite(request: HttpRequest, video_id: int) -> HttpResponse | StreamingHttpResponse:
+    return await serve_image(video_id, 'sprite', request)
+
+async def serve_image(video_id: int, field: str, request: HttpRequest) -> HttpResponse | StreamingHttpResponse:
     try:
         video = await Video.objects.aget(id=video_id)
     except Video.DoesNotExist: return HttpResponse("Video not found", status=404)
-    
-    if not video.video_file:
-        return HttpResponse("Video file not found", status=404)
-    
-    file_path = await sync_to_async(video.get_absolute_path)()
-    
+    image = getattr(video, field)
+    if not image:
+        return HttpResponse("No image", status=404)
+    file_path = os.path.join(settings.STORAGE_SERVER_PATH, image.name)
     if not await a_path_exists(file_path):
-        return HttpResponse("Video file not found on storage server")
+        return HttpResponse("Image not found on storage server", status=404)
+    # Same URL after re-extraction, so let clients revalidate (a cheap 304).
+    return await serve_file(request, file_path, cacheable=False, content_type='image/jpeg')
+async def stream_video(request: HttpRequest, video_id: int) -> HttpResponse | StreamingHttpResponse:
+    await note_playback(video_id)
+    # Seeking players send many Range requests; after the first one the
+    # file is known and only re-stat'ed now and then.
+    descriptor = descriptors.get(video_id)
+    if descriptor is None or not await sync_to_async(descriptor.still_valid)():
+        descriptors.invalidate(video_id)
+        try:
+            video = await Video.objects.aget(id=video_id)
+        except Video.DoesNotExist: return HttpResponse("Video not found", status=404)
+        
+        if not video.video_file:
+            if video.status == 'downloading' and settings.PROGRESSIVE_STREAMING:
+                response = await stream_in_flight(request, video)
+                response.playback_id = video_id
+                return response
+            return HttpResponse("Video file not found", status=404)
+        
+        file_path = await sync_to_async(video.get_absolute_path)()
+        
+        if not await a_path_exists(file_path):
+            return HttpResponse("Video file not found on storage server")
+        
+        descriptor = await sync_to_async(StreamDescriptor.from_path)(
+            file_path, video.status == 'completed', byte_rate=video.byte_rate,
+        )
+        descriptors.put(video_id, descriptor)
+    
+    response = await serve_descriptor(request, descriptor, stream_pacing(request, descriptor.byte_rate),
+                                      video_stream=True)
+    response.playback_id = video_id
+    if 'download' in request.GET and response.status_code in (200, 206):
+        response['Content-Disposition'] = f'attachment; filename="{descriptor.filename}"'
     
-    file_size = os.path.getsize(file_path)
-    content_type, encoding = mimetypes.guess_type(file_path)
-    content_type = content_type or 'video/mp4'
+    return response
+
+async def note_playback(video_id):
+    playback.played(video_id)
+    if playback.due():
+        await sync_to_async(playback.flush)()
+
+async def serve_file(request: HttpRequest, file_path: str, cacheable: bool, content_type: str | None = None,
+                     video_stream: bool = False) -> HttpResponse | StreamingHttpResponse:
+    """Serve a file from storage with conditional requests, byte ranges and cache headers."""
+    descriptor = await sync_to_async(StreamDescriptor.from_path)(file_path, cacheable, content_type)
+    return await serve_descriptor(request, descriptor, video_stream=video_stream)
+
+def stream_pacing(request: HttpRequest, byte_rate: int) -> tuple | None:
+    """Who is asking and for what, for the stream scheduler; None when scheduling is off."""
+    if not settings.STREAM_SCHEDULING:
+        return None
+    kind = DOWNLOAD if 'download' in request.GET else PLAYBACK
+    return request.META.get('REMOTE_ADDR') or 'unknown', kind, byte_rate
+
+async def serve_descriptor(request: HttpRequest, descriptor: StreamDescriptor, pacing: tuple | None = None,
+                           video_stream: bool = False) -> HttpResponse | StreamingHttpResponse:
+    """``video_stream``: a video being watched, which holds downloads back while it plays."""
+    file_path = descriptor.path
+    file_size = descriptor.size
+    last_modified = descriptor.mtime
+    etag = descriptor.etag
+    content_type = descriptor.content_type
+    cacheable = descriptor.cacheable
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        metrics.stream_requests.inc(source='file', kind='not_modified')
+        set_stream_cache_headers(not_modified, cacheable, etag, last_modified)
+        return not_modified
+
+    ranges = None
     range_header = request.headers.get('Range', '').strip()
-    async def stream(file_path, start, length):
-        async for chunk in file_chunk_generator(file_path, start, length):
-            yield chunk
+    if range_header and if_range_passes(request, etag, last_modified):
+        try:
+            ranges = parse_range_header(range_header, file_size)
+        except RangeNotSatisfiable:
+            metrics.stream_requests.inc(source='file', kind='unsatisfiable')
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{file_size}'
+            return response
 
-    
-    if range_header.startswith('bytes='):
-        range_bytes = range_header[6:].split('-')
-        start = int(range_bytes[0]) if range_bytes[0] else 0
-        end = int(range_bytes[1]) if range_bytes[1] and range_bytes[1] else file_size - 1
-        
-        if start >= file_size:
-            return HttpResponse(status=416)
-        
-        end = min(end, file_size - 1)
+    metrics.stream_requests.inc(source='file', kind=range_kind(ranges))
+    if not ranges:
+        response = FileStreamResponse(
+            file_path, 0, file_size,
+            zero_copy=zero_copy_mode(request, paced=stream_scheduler.may_limit(pacing)),
+            pacing=pacing,
+            video_stream=video_stream,
+            content_type=content_type
+        )
+        response['Content-Length'] = str(file_size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
         length = end - start + 1
-        response = StreamingHttpResponse(
-            stream(file_path, start, length),
+        response = FileStreamResponse(
+            file_path, start, length,
+            zero_copy=zero_copy_mode(request, partial=True),
+            pacing=pacing,
+            video_stream=video_stream,
             status=206,
             content_type=content_type
         )
@@ -81,34 +276,112 @@ async def stream_video(request: HttpRequest, video_id: int) -> HttpResponse | St
         response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
         response['Content-Length'] = str(length)
     else:
-        response = StreamingHttpResponse(
-            stream(file_path, 0, file_size),
-            content_type=content_type
-        )
-        response['Content-Length'] = str(file_size)
+        response = MultipartRangeResponse(file_path, ranges, file_size, content_type, video_stream)
 
     response['Accept-Ranges'] = 'bytes'
-    response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response['Pragma'] = 'no-cache'
-    response['Expires'] = '0'
-    if 'download' in request.GET:
-        response['Content-Disposition'] = f'attachment; filename="{os.path.basename(file_path)}"'
-    
+    set_stream_cache_headers(response, cacheable, etag, last_modified)
     return response
 
-async def file_chunk_generator(file_path: str, start: int, length: int, chunk_size: int=8192):
-    async with aiofiles.open(file_path, 'rb') as f:
-        await f.seek(start)
-        remaining = length
-        
-        while remaining > 0:
-            read_size = min(chunk_size, remaining)
-            chunk = await f.read(read_size)
-            if not chunk:
+def range_kind(ranges: list | None) -> str:
+    if not ranges:
+        return 'full'
+    return 'range' if len(ranges) == 1 else 'multirange'
+
+async def hls_master(request: HttpRequest, video_id: int) -> HttpResponse:
+    try:
+        video = await Video.objects.aget(id=video_id)
+    except Video.DoesNotExist: return HttpResponse("Video not found", status=404)
+    if not video.hls_renditions:
+        return HttpResponse("No HLS renditions for this video", status=404)
+
+    playlist = master_playlist(
+        video.hls_renditions,
+        lambda name: reverse('hls_file', args=[video.id, name, 'index.m3u8']),
+    )
+    response = HttpResponse(playlist, content_type='application/vnd.apple.mpegurl')
+    # Re-packaging rewrites it, so always revalidate.
+    set_no_cache_headers(response)
+    return response
+
+async def hls_file(request: HttpRequest, video_id: int, rendition: str, filename: str) -> HttpResponse | StreamingHttpResponse:
+    """A rendition's media playlist or one of its segments."""
+    try:
+        video = await Video.objects.aget(id=video_id)
+    except Video.DoesNotExist: return HttpResponse("Video not found", status=404)
+    if rendition not in {r['name'] for r in video.hls_renditions} or not HLS_FILE_RE.match(filename):
+        return HttpResponse("Not found", status=404)
+
+    file_path = os.path.join(hls_dir(video.id), rendition, filename)
+    if not await a_path_exists(file_path):
+        return HttpResponse("Not found", status=404)
+    if filename.endswith('.ts'):
+        await note_playback(video.id)
+        response = await serve_file(request, file_path, cacheable=True, content_type='video/mp2t',
+                                    video_stream=True)
+        response.playback_id = video.id
+        return response
+    # Playlists are rewritten by re-packaging; segments keep their content.
+    return await serve_file(request, file_path, cacheable=False, content_type='application/vnd.apple.mpegurl')
+
+async def stream_in_flight(request: HttpRequest, video: Video) -> HttpResponse | StreamingHttpResponse:
+    """
+    Play a video that is still downloading or converting, from the file being
+    written. With a known final size, ranges are answered in full and the
+    response waits for missing bytes; otherwise they are clamped to what's
+    been written so far.
+    """
+    async def refresh():
+        return await sync_to_async(progress.stream_source)(video.id)
+
+    source = await refresh()
+    if source is None or not await a_path_exists(source['path']):
+        return HttpResponse("Video is not playable yet", status=404)
+
+    file_path = source['path']
+    size = source['size']
+    content_type = mimetypes.guess_type(file_path)[0] or 'video/mp4'
+
+    ranges = None
+    range_header = request.headers.get('Range', '').strip()
+    if range_header:
+        waited = 0.0
+        while True:
+            try:
+                ranges = parse_range_header(range_header, size or source['available'])
                 break
-            remaining -= len(chunk)
-            await asyncio.sleep(0.0001)  
-            yield chunk
+            except RangeNotSatisfiable:
+                if size or waited >= settings.PROGRESSIVE_WAIT_SECONDS:
+                    metrics.stream_requests.inc(source='in_flight', kind='unsatisfiable')
+                    response = HttpResponse(status=416)
+                    if size:
+                        response['Content-Range'] = f'bytes */{size}'
+                    return response
+            # Asked for bytes past the write position: give the writer a moment.
+            await asyncio.sleep(settings.PROGRESSIVE_POLL_SECONDS)
+            waited += settings.PROGRESSIVE_POLL_SECONDS
+            source = await refresh()
+            if source is None or source['path'] != file_path:
+                return HttpResponse("Video moved, try again", status=503, headers={'Retry-After': '1'})
+        if ranges and len(ranges) > 1:
+            ranges = None  # Not worth a multipart response for a file in flux
+
+    metrics.stream_requests.inc(source='in_flight', kind=range_kind(ranges))
+    # Counted in the fair share, but not paced: it can't run ahead of the writer anyway.
+    pacing = stream_pacing(request, 0)
+    if not ranges:
+        response = GrowingFileResponse(file_path, 0, size or None, refresh, pacing, content_type=content_type)
+        if size:
+            response['Content-Length'] = str(size)
+    else:
+        start, end = ranges[0]
+        length = end - start + 1
+        response = GrowingFileResponse(file_path, start, length, refresh, pacing, status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size or "*"}'
+        response['Content-Length'] = str(length)
+
+    response['Accept-Ranges'] = 'bytes'
+    set_no_cache_headers(response)
+    return response
 
 async def delete_video(request: HttpRequest, video_id: int) -> HttpResponse:
     user = await request.auser()
@@ -150,11 +423,33 @@ async def check_download_status(request: HttpRequest, video_id: int) -> HttpResp
         'video_id': str(video.id),
         'title': video.title,
         'database_status': video.status,
-        'thread_status': status_info.get('status'),
-        'thread_alive': status_info.get('thread_alive', False),
+        'job_status': status_info.get('job_status'),
+        'job_alive': status_info.get('job_alive', False),
+        'job_attempts': status_info.get('attempts'),
+        'job_worker': status_info.get('worker'),
         'file_status': file_status,
         'download_url': video.download_url,
         'created_at': video.created_at.isoformat(),
         'updated_at': video.updated_at.isoformat(),
         'error_message': video.error_message,
-    })
\ No newline at end of file
+        'progress': progress.snapshot(video),
+        'transcode': status_info.get('transcode'),
+        'bandwidth': governor.snapshot(),
+    })
+async def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Prometheus scrape endpoint, for METRICS_ALLOWED_IPS and staff users."""
+    if not settings.METRICS_ENABLED:
+        return HttpResponse("Not found", status=404)
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        user = await request.auser()
+        if not user.is_staff:
+            return HttpResponse("Forbidden", status=403)
+    body = await sync_to_async(metrics.registry.render)()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+async def stream_rates(request: HttpRequest) -> JsonResponse:
+    """What every client is being sent right now, for staff."""
+    user = await request.auser()
+    if not user.is_staff:
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    return JsonResponse({'clients': stream_scheduler.snapshot()})